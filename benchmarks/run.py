@@ -0,0 +1,167 @@
+'''
+Offline benchmarks for cfnbot. Runs parse_specfile and StackSet deploy/delete on
+synthetic specfiles against benchmarks.fake_aws, and prints machine-readable results.
+
+    $ python -m benchmarks.run --stacks 40 --shape chain --shape fanout -p 1 -p 8
+'''
+import json
+import logging
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# never talk to the real thing, whatever the environment says.
+os.environ.update({
+    'AWS_ACCESS_KEY_ID': 'benchmark',
+    'AWS_SECRET_ACCESS_KEY': 'benchmark',
+    'AWS_DEFAULT_REGION': 'us-east-1',
+})
+for v in ['AWS_PROFILE', 'AWS_SESSION_TOKEN']:
+    os.environ.pop(v, None)
+
+import click
+
+from cfnbot import cache, clients, localcache, minify, package, throttle, trace, waiter
+from cfnbot.cfnbot import forget_uploads, forget_validations
+from cfnbot.cli import parse_specfile
+
+from . import specs
+from .fake_aws import FakeAWS
+
+
+def _fresh(fake, directory):
+    '''Starts a scenario from nothing: no clients, caches, limiters or measurements.'''
+    clients.reset()
+    cache.reset()
+    throttle.reset()
+    trace.reset()
+    forget_uploads()
+    forget_validations()
+    minify.forget()
+    package.forget()
+    localcache.settings['dir'] = os.path.join(directory, 'cache')
+    fake.install(clients.session())
+
+def _phase(fake, fn):
+    '''Runs fn, returning its wall time, outcome, API calls made and peak traced memory.'''
+    before = dict(fake.calls)
+    tracemalloc.start()
+    start = time.time()
+    r = fn()
+    wall = time.time() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    calls = {k: v - before.get(k, 0) for k, v in fake.calls.items() if v - before.get(k, 0)}
+    return r, {
+        'wall_seconds': round(wall, 3),
+        'api_calls': sum(calls.values()),
+        'api_calls_by_operation': calls,
+        'peak_traced_bytes': peak,
+    }
+
+def scenario(directory, shape, n, max_parallel, fake_args, template_size, plan=False):
+    fake = FakeAWS(**fake_args)
+    _fresh(fake, directory)
+    specfile = specs.write(directory, shape, n, template_size)
+    result = {'shape': shape, 'stacks': n, 'max_parallel': max_parallel, 'template_size': template_size}
+
+    def _parse():
+        with open(specfile) as f:
+            return parse_specfile(f, None)
+
+    ss, result['parse'] = _phase(fake, _parse)
+    plan_id = None
+    if plan:
+        # plan against a fresh parse, like a separate `cfnbot plan` run would.
+        plan_id = 'benchmark'
+        r, result['plan'] = _phase(fake, lambda: _parse().plan(max_parallel=max_parallel, plan_id=plan_id))
+        result['plan']['ok'] = all(r.values())
+    r, result['deploy'] = _phase(fake, lambda: ss.deploy(max_parallel=max_parallel, plan_id=plan_id))
+    result['deploy']['ok'] = bool(r)
+
+    # a second, fresh parse: everything is already up, so this is the no-op path.
+    ss = _parse()
+    r, result['redeploy'] = _phase(fake, lambda: ss.deploy(max_parallel=max_parallel))
+    result['redeploy']['ok'] = bool(r)
+
+    r, result['delete'] = _phase(fake, lambda: ss.delete(max_parallel=max_parallel))
+    result['delete']['success_ratio'] = r
+
+    result['throttled_calls'] = fake.throttled
+    result['api_summary'] = trace.summary()['api']
+    return result
+
+
+@click.command()
+@click.option('-n', '--stacks', type=click.IntRange(min=1), default=20, help='Stacks per specfile.')
+@click.option('--shape', 'shapes', type=click.Choice(specs.SHAPES), multiple=True, help='Dependency shape. Repeat for more.')
+@click.option('-p', '--max-parallel', 'parallelism', type=click.IntRange(min=1), multiple=True, help='Parallelism levels to try.')
+@click.option('--latency', type=click.FLOAT, default=0.02, help='Seconds added to every API call.')
+@click.option('--op-duration', type=click.FLOAT, default=0.5, help='Seconds each create/update/delete takes.')
+@click.option('--throttle-rate', type=click.FLOAT, default=0.0, help='Chance of any call being throttled.')
+@click.option('--max-tps', type=click.INT, default=None, help='Throttle everything above this many calls per second.')
+@click.option('--fail', 'fail_stacks', multiple=True, help='Stack names whose create/update should fail.')
+@click.option('--template-size', type=click.INT, default=0, help='Pad templates to this many bytes. Over 51200 goes through S3.')
+@click.option('--rate', type=click.FLOAT, default=100.0, help="Starting rate for cfnbot's own rate limiter, calls/s.")
+@click.option('--poll-delay', type=click.FLOAT, default=0.1, help='Waiter delay before the first poll.')
+@click.option('--max-poll-delay', type=click.FLOAT, default=0.5, help='Waiter delay cap.')
+@click.option('--minify', 'minify_templates', is_flag=True, default=False, help='Minify templates over the inline limit.')
+@click.option('--plan', is_flag=True, default=False, help='Plan change sets first and deploy from them.')
+@click.option('-o', '--out', type=click.File('w'), default='-', help='Where to write results, stdout by default.')
+@click.option('-v', '--verbose', is_flag=True, default=False, help='Show cfnbot logging on stderr.')
+def main(stacks, shapes, parallelism, latency, op_duration, throttle_rate, max_tps, fail_stacks, template_size,
+         rate, poll_delay, max_poll_delay, minify_templates, plan, out, verbose):
+    '''Benchmarks cfnbot against a local fake of CloudFormation and S3.'''
+    # keep stdout for results.
+    root = logging.getLogger()
+    for h in list(root.handlers):
+        root.removeHandler(h)
+    root.addHandler(logging.StreamHandler(sys.stderr))
+    root.setLevel(logging.INFO if verbose else logging.ERROR)
+
+    waiter.settings['delay'] = poll_delay
+    minify.settings['enabled'] = minify_templates
+    waiter.settings['max_delay'] = max_poll_delay
+    # everything here runs faster than real life, so the limiter has to keep up.
+    throttle.settings['rate'] = rate
+    throttle.settings['max_rate'] = max(rate, throttle.settings['max_rate'])
+    throttle.settings['burst'] = max(int(rate), throttle.settings['burst'])
+    throttle.settings['base_delay'] = min(throttle.settings['base_delay'], poll_delay)
+    fake_args = {
+        'latency': latency,
+        'op_duration': op_duration,
+        'throttle_rate': throttle_rate,
+        'max_tps': max_tps,
+        'fail_stacks': fail_stacks,
+    }
+
+    results = []
+    for shape in shapes or ['chain', 'fanout', 'diamond']:
+        for p in parallelism or [1, 8]:
+            directory = tempfile.mkdtemp(prefix='cfnbot-benchmark-')
+            try:
+                results.append(scenario(directory, shape, stacks, p, fake_args, template_size, plan))
+            finally:
+                shutil.rmtree(directory, ignore_errors=True)
+            r = results[-1]
+            click.echo('{:<10} p={:<3} deploy {:>7.2f}s  redeploy {:>6.2f}s  delete {:>7.2f}s  calls {}'.format(
+                shape, p, r['deploy']['wall_seconds'], r['redeploy']['wall_seconds'], r['delete']['wall_seconds'],
+                r['parse']['api_calls'] + r['deploy']['api_calls'] + r['redeploy']['api_calls'] + r['delete']['api_calls']),
+                err=True)
+
+    json.dump({
+        'settings': dict(fake_args, stacks=stacks, template_size=template_size, fail_stacks=list(fail_stacks),
+                         rate=rate, poll_delay=poll_delay, max_poll_delay=max_poll_delay, plan=plan,
+                         minify=minify_templates),
+        'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'results': results,
+    }, out, indent=2, sort_keys=True)
+    out.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+'''Synthetic specfiles and templates with a chosen dependency shape.'''
+import os
+
+import yaml
+
+SHAPES = ['independent', 'chain', 'fanout', 'diamond']
+
+
+def dependencies(shape, n):
+    '''{stack index: [indexes it takes outputs from]} for n stacks.'''
+    if shape == 'independent':
+        return {i: [] for i in range(n)}
+    if shape == 'chain':
+        return {i: [i - 1] if i else [] for i in range(n)}
+    if shape == 'fanout':
+        return {i: [0] if i else [] for i in range(n)}
+    if shape == 'diamond':
+        # one root, n-2 stacks in the middle, one stack at the bottom taking everything.
+        deps = {i: [0] if i else [] for i in range(n - 1)}
+        deps[n - 1] = list(range(1, n - 1)) if n > 2 else [0]
+        return deps
+    raise ValueError('Unknown shape: {}. Pick one of {}.'.format(shape, ', '.join(SHAPES)))
+
+def template(inputs, size=0):
+    '''A small template taking the given parameters, padded with comments up to size bytes.'''
+    t = yaml.safe_dump({
+        'AWSTemplateFormatVersion': '2010-09-09',
+        'Parameters': {p: {'Type': 'String'} for p in inputs},
+        'Resources': {'Resource': {'Type': 'AWS::CloudFormation::WaitConditionHandle'}},
+        'Outputs': {'Out': {'Value': 'x'}},
+    }, default_flow_style=False)
+    if len(t) < size:
+        t += '\n'.join(['# padding ' + 'x' * 60] * ((size - len(t)) // 71 + 1)) + '\n'
+    return t
+
+def write(directory, shape, n, template_size=0, bucket='cfnbot-benchmark'):
+    '''Writes templates and a specfile for n stacks into directory. Returns the specfile path.'''
+    deps = dependencies(shape, n)
+    stacks = []
+    for i in range(n):
+        name = 'Stack{:04d}'.format(i)
+        inputs = ['In{}'.format(d) for d in deps[i]]
+        path = os.path.join(directory, '{}.yml'.format(name))
+        with open(path, 'w') as f:
+            f.write(template(inputs, template_size))
+        stacks.append({
+            'StackName': name,
+            'TemplatePath': path,
+            'Parameters': {'In{}'.format(d): 'cfnbotOutputs.Stack{:04d}.Out'.format(d) for d in deps[i]},
+            'OutputChecks': ['Out'],
+            'Tags': {'benchmark': shape},
+        })
+
+    specfile = os.path.join(directory, 'specfile.yml')
+    with open(specfile, 'w') as f:
+        yaml.safe_dump({'Default': {'TemplateBucket': bucket, 'Stacks': stacks}}, f, default_flow_style=False)
+    return specfile
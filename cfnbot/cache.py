@@ -0,0 +1,133 @@
+import logging
+import threading
+import time
+from . import state
+from .clients import client, profile_name
+
+logger = logging.getLogger()
+
+DEFAULT_TTL = 60
+
+
+def _does_not_exist(e, stackname):
+    '''True if a ClientError is describe_stacks saying the stack isn't there.'''
+    try:
+        return e.response['Error']['Message'] == 'Stack with id {} does not exist'.format(stackname)
+    except (AttributeError, KeyError):
+        return False
+
+
+class StackCache:
+    '''
+    Run-scoped view of describe_stacks. One paginated sweep fills it for every stack
+    in the account/region, after which lookups are answered from memory until an
+    entry is older than ttl seconds or has been invalidated. Stacks missing from a
+    fresh sweep are known not to exist, so they don't cost a call either.
+
+    With the state store on, a sweep starts from what earlier runs saw and only
+    describes the stacks list_stacks says have moved since.
+    '''
+    def __init__(self, profile=None, region=None, ttl=DEFAULT_TTL):
+        self.profile = profile
+        self.region = region
+        self.ttl = ttl
+        self._stacks = {}
+        self._swept_at = None
+        self._lock = threading.RLock()
+
+    @property
+    def cfn(self):
+        return client('cloudformation', self.profile, self.region)
+
+    def _fresh(self, t):
+        return t is not None and time.time() - t < self.ttl
+
+    def sweep(self):
+        '''Describes every stack in one paginated pass. Returns the number found.'''
+        st = state.store()
+        found = state.revalidate(self.cfn, self.profile, self.region, st) if st else None
+        if found is None:
+            found = {}
+            for page in self.cfn.get_paginator('describe_stacks').paginate():
+                for s in page['Stacks']:
+                    found[s['StackName']] = s
+            if st:
+                st.save(self.profile, self.region, found.values(), replace=True)
+        now = time.time()
+        with self._lock:
+            self._stacks = {k: (now, v) for k, v in found.items()}
+            self._swept_at = now
+        logger.debug('Stack cache filled with {} stacks.'.format(len(found)))
+        return len(found)
+
+    def ensure_swept(self):
+        '''Sweeps, unless there's been a sweep in the last ttl seconds.'''
+        with self._lock:
+            fresh = self._fresh(self._swept_at)
+        if not fresh:
+            self.sweep()
+
+    def get(self, stackname):
+        '''
+        Returns the describe_stacks entry for a stack, or None if it doesn't exist.
+        Barfs if things explode.
+        '''
+        with self._lock:
+            if stackname in self._stacks and self._fresh(self._stacks[stackname][0]):
+                return self._stacks[stackname][1]
+            if stackname not in self._stacks and self._fresh(self._swept_at):
+                return None
+
+        try:
+            stacks = self.cfn.describe_stacks(StackName=stackname)['Stacks']
+        except Exception as e:
+            # remember to raise on actual errors
+            if not _does_not_exist(e, stackname):
+                raise
+            stacks = []
+
+        if len(stacks) > 1:
+            logger.error('describe_stack returned too many stacks. i don\'t know what to do with all these.')
+            raise Exception('describe_stack returned too many stacks')
+
+        s = stacks[0] if stacks else None
+        self.put(stackname, s)
+        return s
+
+    def put(self, stackname, description):
+        '''Records what we know about a stack, eg: the last thing a waiter saw.'''
+        with self._lock:
+            self._stacks[stackname] = (time.time(), description)
+        st = state.store()
+        if st and description is None:
+            st.forget(self.profile, self.region, [stackname])
+        elif st and not description['StackStatus'].endswith('_IN_PROGRESS'):
+            # stacks still moving will have moved again by the next run anyway.
+            st.save(self.profile, self.region, [description])
+
+    def invalidate(self, stackname=None):
+        '''Forgets one stack, or everything if no name is given.'''
+        with self._lock:
+            if stackname is None:
+                self._stacks = {}
+                self._swept_at = None
+            else:
+                # a fresh sweep would otherwise claim the stack doesn't exist.
+                self._stacks[stackname] = (None, None)
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+def stack_cache(profile=None, region=None):
+    '''The StackCache for a profile/region, made on first use.'''
+    key = (profile_name(profile), region)
+    with _caches_lock:
+        if key not in _caches:
+            _caches[key] = StackCache(*key)
+        return _caches[key]
+
+def reset():
+    '''Drops every StackCache.'''
+    with _caches_lock:
+        _caches.clear()
@@ -1,15 +1,28 @@
-import boto3
 import yaml
 import json
+import hashlib
 import logging
 import os
 import inspect
-import random
+import copy
+import threading
+import time
 import botocore.exceptions
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from . import events, journal, localcache, minify, package, schedule, uploads
+from .cache import stack_cache
+from .changeset import BLOCKED, FAILED, PLANNED, UNCHANGED, ChangeSetResult, change_set_name, new_plan_id, wait_for_change_set
+from .clients import client, size_pool
+from .graph import is_output_ref, parse_output_ref, reverse, run_graph
+from .outputs import OutputIndex
+from .trace import span, traced
+from .waiter import WaitResult, new_request_token, wait_for_stack
 
 
 logger = logging.getLogger()
-cfn = boto3.client('cloudformation')
+FINGERPRINT_TAG = 'cfnbot:fingerprint'
+# statuses a stack can sit in quietly after a deploy that went (or was put back) the way we asked.
+SETTLED_STATUSES = ['CREATE_COMPLETE', 'UPDATE_COMPLETE', 'UPDATE_ROLLBACK_COMPLETE', 'IMPORT_COMPLETE']
 
 ### because i'm a space cadet, the parameter list:
 # StackName: string, starts with a letter, alphanum+hyphen, max 128 chars.
@@ -42,32 +55,38 @@ cfn = boto3.client('cloudformation')
 # StackPolicyURL: optional string. StackPolicyBody too long? put it on S3.
 # Tags: optional list of dicts, { 'Key': 'string', 'Value': 'string' }
 
+MAX_TEMPLATE_BODY = 51200
+
 ### checks
 def is_over_50kb(path):
-    '''Checks to see if the cfn template is too big to send via the API'''
+    '''Checks to see if the cfn template is too big to send via the API, minified if need be'''
     if not os.path.isfile(path):
         raise Exception('Path specified does not lead to a valid file: {}'.format(path))
-    if os.path.getsize(path) > 51200:
+    if len(template_body(path)) > MAX_TEMPLATE_BODY:
         logger.debug('File is over the AWS limit of 51,200 bytes.')
         return True
     return False
 
-def stack_exists(stackname):
+def stack_exists(stackname, profile=None, region=None):
     '''Returns true if a stack exists, false if it doesn't, barfs if things explode.'''
-    try:
-        cfn.describe_stacks(StackName=stackname)
-        logger.debug('{} already exists.'.format(stackname))
-        return True
-    except Exception as e:
-        # remember to raise on actual errors
-        if 'Error' not in e.response.keys():
-            raise(e)
-        if e.response['Error']['Message'] != 'Stack with id {} does not exist'.format(stackname):
-            raise(e)
+    if stack_cache(profile, region).get(stackname) is None:
         logger.debug("describe_stacks sez that the stack doesn't exist.")
         return False
+    logger.debug('{} already exists.'.format(stackname))
+    return True
 
 ### helpers
+def template_body(path):
+    '''
+    What actually gets sent for a template: the file as it is, or a minified copy
+    if it's too big for the API and minifying is turned on.
+    '''
+    with open(path, 'rb') as f:
+        body = f.read()
+    if len(body) > MAX_TEMPLATE_BODY and minify.settings['enabled']:
+        return minify.minified(body, path)
+    return body
+
 def clean_path(path):
     path = os.path.expanduser(path)
     path = os.path.expandvars(path)
@@ -75,15 +94,106 @@ def clean_path(path):
     path = os.path.abspath(path)
     return path
 
-def upload_template(path, bucket):
-    k = os.path.basename(path)
-    o = boto3.resource('s3').Object(bucket,k).put_object(Body=open(path,'r'))
-    return boto3.client('s3').generate_presigned_url(
+def forget_uploads():
+    '''Forgets which templates are known to be in S3, eg: when switching accounts.'''
+    uploads.forget()
+
+def template_key(body, path):
+    return uploads.template_key(hashlib.sha256(body).hexdigest(), path)
+
+def upload_template(path, bucket, profile=None, region=None):
+    '''
+    Puts a template in S3 under a content-hash key, unless it's already there.
+    Returns a presigned URL for it.
+    '''
+    with span('upload_template', path=path):
+        return _upload_template(path, bucket, profile, region)
+
+def _upload_template(path, bucket, profile, region):
+    s3 = client('s3', profile, region)
+    body = template_body(path)
+    k = template_key(body, path)
+
+    if uploads.ensure(s3, bucket, k, lambda: s3.put_object(Bucket=bucket, Key=k, Body=body)):
+        logger.debug('Uploaded {} to s3://{}/{}'.format(path, bucket, k))
+    else:
+        logger.debug('{} is already in s3://{}/{}, skipping upload.'.format(path, bucket, k))
+
+    return s3.generate_presigned_url(
         'get_object',
         Params={'Bucket': bucket, 'Key': k},
         ExpiresIn=120
     )
 
+# template sha256: {parameter: has a default}, for templates validated during this run
+_validated = {}
+_validated_lock = threading.Lock()
+
+def forget_validations():
+    with _validated_lock:
+        _validated.clear()
+
+def declared_parameters(path, bucket=None, profile=None, region=None):
+    '''
+    {parameter: has a default} for every parameter a template declares, according to
+    validate_template. Results are kept by template hash, for the run and in the local
+    cache, so a template is only validated once. Barfs if the template is no good.
+    '''
+    with open(path, 'rb') as f:
+        body = f.read()
+    key = hashlib.sha256(body).hexdigest()
+    with _validated_lock:
+        if key in _validated:
+            return _validated[key]
+
+    declared = localcache.read_json('validated', '{}.json'.format(key))
+    if declared is None:
+        with span('validate_template', path=path):
+            declared = _validate_template(path, bucket, profile, region)
+        localcache.write_json(declared, 'validated', '{}.json'.format(key))
+    with _validated_lock:
+        _validated[key] = declared
+    return declared
+
+def _validate_template(path, bucket, profile, region):
+    if is_over_50kb(path):
+        if not bucket:
+            raise Exception('{} cannot be uploaded to S3 because a TemplateBucket was not specified'.format(path))
+        args = {'TemplateURL': upload_template(path, bucket, profile, region)}
+    else:
+        args = {'TemplateBody': template_body(path).decode('utf-8')}
+    r = client('cloudformation', profile, region).validate_template(**args)
+    return {p['ParameterKey']: 'DefaultValue' in p for p in r.get('Parameters', [])}
+
+def parameter_problems(stack, declared):
+    '''Ways a stack's parameters don't line up with what its template declares.'''
+    problems = []
+    for k in stack.parameters.keys():
+        if k not in declared:
+            problems.append('{} sets {}, which {} does not declare.'.format(stack.name, k, stack.template_path))
+    for k, has_default in declared.items():
+        if not has_default and k not in stack.parameters:
+            problems.append('{} has no value for {}, which has no default in {}.'.format(stack.name, k, stack.template_path))
+    return problems
+
+def fingerprint(template_path, parameters, tags, settings):
+    '''
+    Stable hash of everything cfnbot sends for a stack: the template bytes and the
+    resolved parameters, tags and extra settings.
+    '''
+    h = hashlib.sha256()
+    with open(template_path, 'rb') as f:
+        h.update(f.read())
+    h.update(json.dumps([parameters, tags, settings], sort_keys=True, default=str).encode('utf-8'))
+    return h.hexdigest()
+
+def deployed_fingerprint(description):
+    '''The fingerprint tag on a describe_stacks entry, if there is one.'''
+    for t in (description or {}).get('Tags', []):
+        if t['Key'] == FINGERPRINT_TAG:
+            return t['Value']
+    return None
+
 def maybe_log_an_error(e):
     '''log an error, maybe'''
     try:
@@ -92,62 +202,100 @@ def maybe_log_an_error(e):
     except:
         return None
 
-def _describe_stacks(n):
+def _describe_stacks(n, profile=None, region=None):
     try:
-        stacks = cfn.describe_stacks(StackName=n)['Stacks']
+        s = stack_cache(profile, region).get(n)
     except Exception as e:
         logger.error('describe_stack failed while looking for outputs.')
         maybe_log_an_error(e)
         return None
 
-    if len(stacks) > 1 or len(stacks) == 0:
-        logger.error('describe_stack returned too many stacks. i don\'t know what to do with all these.')
-        raise Exception('describe_stack returned too many stacks')
+    if not s:
+        logger.error('describe_stack returned no stacks for {}.'.format(n))
+        return None
 
-    return stacks
+    return [s]
 
-def _waiter(waiter_status, stackname):
+def _waiter(waiter_status, stackname, profile=None, region=None, token=None):
+    '''Waits on a stack operation. Returns a WaitResult, which is truthy on success.'''
+    cache = stack_cache(profile, region)
     try:
-        waiter = cfn.get_waiter(waiter_status)
-        waiter.wait(StackName=stackname)
-        logger.debug('Success! {} obtained.'.format(waiter_status))
+        with span('wait', stack=stackname, waiter=waiter_status):
+            return wait_for_stack(client('cloudformation', profile, region), stackname, waiter_status, cache, token)
     except Exception as e:
-        logger.debug("The {} waiter reported an error.".format(waiter_status))
-        return False
-    return True
+        logger.error("The {} waiter reported an error.".format(waiter_status))
+        maybe_log_an_error(e)
+        cache.invalidate(stackname)
+        return WaitResult(False, reason=str(e))
 
 
 ### the meat
 class Stack:
-    def __init__(self, name, template_path, template_bucket=None, parameters=None, output_checks=None, tags=None, settings=None):
+    def __init__(self, name, template_path, template_bucket=None, parameters=None, output_checks=None, tags=None, settings=None, profile=None, region=None, logical_name=None):
         self.name = name
+        self.logical_name = logical_name if logical_name else name
         self.template_path = template_path
         self.template_bucket = template_bucket
         self.parameters = parameters if parameters else {}
         self.output_checks = output_checks if output_checks else []
-        self.tags = tags if tags else []
+        self.tags = tags if tags else {}
         self.settings = settings if settings else {}
-        self._status = None
-        self._outputs = None
+        self.profile = profile
+        self.region = region
+        self._output_refs = {}
+        self.packaged_path = None   # the template with local paths swapped for S3, if it had any
+        self.packaged_settings = {} # settings which pointed at local files, pointing at S3 instead
+        self.operation = None       # what the last deploy or delete ended up doing: CREATE, UPDATE or DELETE
+        self.request_token = None   # the ClientRequestToken of the last operation started, to pick out its events
+
+    def __str__(self):
+        return self.name
+
+    # attributes which make up a stack as far as the specfile is concerned.
+    SPEC_ATTRS = ['name', 'template_path', 'template_bucket', 'parameters', 'output_checks', 'tags', 'settings', 'profile', 'region', 'logical_name']
+
+    def to_dict(self):
+        return {k: getattr(self, k) for k in self.SPEC_ATTRS}
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(**{k: d.get(k) for k in cls.SPEC_ATTRS})
 
     @property
-    def status(self):
-        if self._status:
-            return self._status
+    def cfn(self):
+        return client('cloudformation', self.profile, self.region)
+
+    @property
+    def body_path(self):
+        '''The template that actually gets sent, packaged or not.'''
+        return self.packaged_path or self.template_path
+
+    @property
+    def sent_settings(self):
+        return dict(self.settings, **self.packaged_settings)
+
+    @property
+    def _cache(self):
+        return stack_cache(self.profile, self.region)
 
-        stacks = _describe_stacks(self.name)
+    @property
+    def output_refs(self):
+        '''{parameter: reference} for parameters which take another stack's output.'''
+        refs = {k: v for k, v in self.parameters.items() if is_output_ref(v)}
+        refs.update(self._output_refs)
+        return refs
+
+    @property
+    def status(self):
+        stacks = _describe_stacks(self.name, self.profile, self.region)
         if not stacks:
-            self._status = None
+            return None
 
         s = stacks[0]
         if 'StackStatus' not in s.keys():
             logger.warning("describe_stacks didn't return a StackStatus, but also didn't fail.")
-            self._status = None
-        else:
-            self._status = s['StackStatus']
-
-        return self._status
-
+            return None
+        return s['StackStatus']
 
     @property
     def outputs(self):
@@ -155,10 +303,7 @@ class Stack:
             logger.debug('No output_checks specified.')
             return []
 
-        if self._outputs:
-            return self._outputs
-
-        stacks = _describe_stacks(self.name)
+        stacks = _describe_stacks(self.name, self.profile, self.region)
         if not stacks:
             logger.warning('describe_stacks returned no stacks at all.')
             return None
@@ -169,75 +314,140 @@ class Stack:
             logger.debug(s)
             return None
 
-        self._outputs = {i['OutputKey']: i['OutputValue'] for i in s['Outputs']}
-        return self._outputs
+        return {i['OutputKey']: i['OutputValue'] for i in s['Outputs']}
+
+    def refresh_status(self):
+        logger.debug('refreshing status...')
+        self._cache.invalidate(self.name)
+        return self.status
 
-    def refresh_status(self,outputs=True,Status=True):
-        if status and self._status:
-            logger.debug('refreshing status...')
-            o = copy(self._status)
-            self._status = None
-            return self.status
+    def refresh_outputs(self):
+        logger.debug('refreshing outputs...')
+        self._cache.invalidate(self.name)
+        return self.outputs
 
-    def refresh_outputs(self,outputs=True,Status=True):
-        if outputs and self._outputs:
-            logger.debug('refreshing outputs...')
-            o = copy(self._outputs)
-            self._outputs = None
-            return self.outputs
+    def wait_for(self, waiter_status):
+        '''Waits on the operation just started, noting which one it was.'''
+        self.operation = waiter_status.split('_')[1].upper()   # stack_create_complete: CREATE
+        events.emit(events.STACK_OPERATION, operation=self.operation, **events.stack_fields(self))
+        return _waiter(waiter_status, self.name, self.profile, self.region, self.request_token)
 
+    @traced('delete')
     def delete(self):
         '''Burn it to the ground. Returns True/False.'''
-        if not stack_exists(self.name):
+        self.operation = None
+        if not stack_exists(self.name, self.profile, self.region):
             logger.debug("stack_exists reports that {} doesn't exist. Skipping delete.".format(self.name))
             return True
 
         try:
-            cfn.delete_stack(StackName=self.name)
+            self.request_token = new_request_token()
+            self.cfn.delete_stack(StackName=self.name, ClientRequestToken=self.request_token)
+            self._cache.invalidate(self.name)
             waiter_status='stack_delete_complete'
         except Exception as e:
             logger.error('delete_stack failed on {}'.format(self.name))
             maybe_log_an_error(e)
             return False
 
-        return _waiter(waiter_status, self.name)
+        return self.wait_for(waiter_status)
 
 
-    def deploy(self,stackset=None):
+    @property
+    def fingerprint(self):
+        return fingerprint(self.body_path, self.parameters, self.tags, self.sent_settings)
+
+    def is_unchanged(self):
+        '''
+        True if the stack is settled and was last deployed from exactly what we'd send
+        now, according to the fingerprint tag in the stack cache.
+        '''
+        s = self._cache.get(self.name)
+        if not s or s.get('StackStatus') not in SETTLED_STATUSES:
+            return False
+        return deployed_fingerprint(s) == self.fingerprint
+
+    def adopt(self, stackset):
+        '''Picks up the stackset's name prefix, connection settings and template bucket.'''
+        # stacks from a specfile come prefixed already, only ever prefix a name once.
+        if stackset.name != "Default" and self.name == self.logical_name:
+            self.name = "{}-{}".format(stackset.name, self.name)
+            logger.info('Stack name updated to {}'.format(self.name))
+        self.profile = self.profile or stackset.profile
+        self.region = self.region or stackset.region
+        if stackset.template_bucket and not self.template_bucket:
+            self.template_bucket = stackset.template_bucket
+            logger.debug('Inherited template_bucket: {}'.format(self.template_bucket))
+
+    def resolve_outputs(self, stackset):
+        '''
+        Swaps cfnbotOutputs references in the parameters for the real values, all in
+        one go through the stackset's output index. Barfs if one is missing. Works
+        from the original references every time, so calling it again after the
+        stacks it takes outputs from have been deployed picks up their new values.
+        '''
+        refs = self.output_refs
+        if not refs:
+            return
+        logger.debug('{} output references found, checking the stackset.'.format(len(refs)))
+        values = stackset.output_index.resolve(set(refs.values()))
+        for k, v in refs.items():
+            logger.debug('value for {} found: {}'.format(v, values[v]))
+            self._output_refs[k] = v
+            self.parameters[k] = values[v]
+
+    @traced('deploy')
+    def deploy(self,stackset=None,force=False,plan_id=None):
         '''
         Perform a Create or an Update on the stack. If a stackset is provided, its
-        bits will be incorporated automagically. Returns True/False.
+        bits will be incorporated automagically. Stacks which haven't changed since
+        the last deploy are left alone unless force is set. With a plan_id, the
+        change set made by that plan is executed if it's still good. Returns True/False.
         '''
-        # adopt the global settings as needed...
-        if stackset:
-            if stackset.name != "Default":
-                self.name = "{}-{}".format(stackset.name, self.name)
-                logger.info('Stack name updated to {}'.format(self.name))
-            if stackset.template_bucket and not self.template_bucket:
-                self.template_bucket = stackset.template_bucket
-                logger.debug('Inherited template_bucket: {}'.format(self.template_bucket))
-
-        # fetch parameter outputs
+        self.operation = None
         if stackset:
-            for k,v in self.parameters.items():
-                if v.startswith('cfnbotOutputs'):
-                    logger.debug('output reference found, checking stackset for {}.'.format(v))
-                    o = stackset.get_output(v)
-                    if o:
-                        logger.debug('value for {} found: {}'.format(v,o))
-                        self.parameters[k] = o
-                        logger.debug('Parameter "{}" updated.'.format(k))
+            self.adopt(stackset)
+            self.resolve_outputs(stackset)
+
+        if plan_id and (force or not self.is_unchanged()):
+            r = self.execute_change_set(change_set_name(plan_id))
+            if r is not None:
+                return r
+
+        # made by a plan that never went ahead. only a change set can create it now.
+        if self.is_in_review():
+            cs = self.create_change_set(change_set_name(new_plan_id()))
+            if cs.status != PLANNED:
+                logger.error('Unable to make a change set to create {}: {}'.format(self.name, cs.reason or cs.status))
+                return False
+            return self.execute_change_set(cs.name)
+
+        # a create that failed leaves an empty stack behind which can only be deleted.
+        replaced = False
+        if (self._cache.get(self.name) or {}).get('StackStatus') == 'ROLLBACK_COMPLETE':
+            logger.warning('{} never got created properly, deleting what is left of it first.'.format(self.name))
+            if not self.delete():
+                return False
+            replaced = True
 
         # create or update
-        if stack_exists(self.name):
+        if stack_exists(self.name, self.profile, self.region):
+            if not force and self.is_unchanged():
+                logger.info("{} is unchanged since it was last deployed, skipping.".format(self.name))
+                return True
+
             waiter_status = None
             try:
-                cfn.update_stack(**self.generate_cfn_args())
+                self.request_token = new_request_token()
+                self.cfn.update_stack(ClientRequestToken=self.request_token, **self.generate_cfn_args())
+                self._cache.invalidate(self.name)
                 logger.info('Updating {}...'.format(self.name))
                 waiter_status = 'stack_update_complete'
             except botocore.exceptions.ClientError as e:
                 if e.response['Error']['Message'] != "No updates are to be performed.":
+                    logger.error('update_stack failed.')
                     maybe_log_an_error(e)
+                    return False
                 logger.info("No updates required for {}".format(self.name))
                 return True
             except Exception as e:
@@ -246,7 +456,9 @@ class Stack:
                 return False
         else:
             try:
-                cfn.create_stack(**self.generate_cfn_args())
+                self.request_token = new_request_token()
+                self.cfn.create_stack(ClientRequestToken=self.request_token, **self.generate_cfn_args())
+                self._cache.invalidate(self.name)
                 logger.info('Creating {}...'.format(self.name))
                 waiter_status = 'stack_create_complete'
             except Exception as e:
@@ -255,23 +467,130 @@ class Stack:
                 return False
 
         # wait for status
-        return _waiter(waiter_status, self.name)
+        r = self.wait_for(waiter_status)
+        if replaced:
+            self.operation = schedule.REPLACE
+        return r
+
+    def is_in_review(self):
+        '''True if the stack only exists as a change set waiting to create it.'''
+        return (self._cache.get(self.name) or {}).get('StackStatus') == 'REVIEW_IN_PROGRESS'
+
+    @traced('plan')
+    def plan(self, stackset=None, plan_id=None, force=False):
+        '''
+        Creates a change set for the stack, named after plan_id, and waits for
+        CloudFormation to work out what it would do. Output references use whatever
+        is deployed right now. Returns a ChangeSetResult.
+        '''
+        if stackset:
+            self.adopt(stackset)
+            for v in self.output_refs.values():
+                d = stackset.find_stack(parse_output_ref(v)[0])
+                if d and d is not self and (not stack_exists(d.name, d.profile, d.region) or d.is_in_review()):
+                    return ChangeSetResult(self.name, BLOCKED, reason='Needs outputs from {}, which is not up yet.'.format(d.name))
+            try:
+                self.resolve_outputs(stackset)
+            except Exception as e:
+                return ChangeSetResult(self.name, BLOCKED, reason=str(e))
+
+        if not force and self.is_unchanged():
+            return ChangeSetResult(self.name, UNCHANGED)
+        return self.create_change_set(change_set_name(plan_id or new_plan_id()))
+
+    def change_set_args(self, name, change_set_type):
+        '''generate_cfn_args, less anything create_change_set doesn't take.'''
+        args = self.generate_cfn_args()
+        members = self.cfn.meta.service_model.operation_model('CreateChangeSet').input_shape.members
+        for k in list(args.keys()):
+            if k not in members:
+                logger.warning('Change sets do not support {}, leaving it out for {}.'.format(k, self.name))
+                del args[k]
+        args['ChangeSetName'] = name
+        args['ChangeSetType'] = change_set_type
+        return args
+
+    def create_change_set(self, name):
+        '''Creates a change set and waits for it to be worked out. Returns a ChangeSetResult.'''
+        s = self._cache.get(self.name)
+        change_set_type = 'CREATE' if not s or s.get('StackStatus') == 'REVIEW_IN_PROGRESS' else 'UPDATE'
+        try:
+            args = self.change_set_args(name, change_set_type)
+            try:
+                self.cfn.create_change_set(**args)
+            except botocore.exceptions.ClientError as e:
+                if e.response['Error']['Code'] != 'AlreadyExistsException':
+                    raise
+                # same plan id as an earlier run, so this one replaces it.
+                logger.debug('Replacing change set {} on {}.'.format(name, self.name))
+                self.cfn.delete_change_set(StackName=self.name, ChangeSetName=name)
+                self.cfn.create_change_set(**args)
+            self._cache.invalidate(self.name)
+            logger.info('Creating change set {} for {}...'.format(name, self.name))
+            with span('wait_change_set', stack=self.name):
+                r = wait_for_change_set(self.cfn, self.name, name, change_set_type)
+        except Exception as e:
+            logger.error('create_change_set failed for {}.'.format(self.name))
+            return ChangeSetResult(self.name, FAILED, name, change_set_type, reason=maybe_log_an_error(e) or str(e))
 
+        if r.status == FAILED:
+            logger.error('Change set {} for {} failed: {}'.format(name, self.name, r.reason))
+        elif r.status != PLANNED:
+            # empty change sets only get in the way, tidy them up.
+            try:
+                self.cfn.delete_change_set(StackName=self.name, ChangeSetName=name)
+            except Exception as e:
+                logger.debug('Unable to delete empty change set {} for {}: {}'.format(name, self.name, e))
+        return r
+
+    def execute_change_set(self, name):
+        '''
+        Executes a change set made by plan, as long as it is still exactly what we'd
+        send now. Returns a WaitResult, or None if there's no usable change set and
+        the stack should be deployed the usual way.
+        '''
+        try:
+            cs = self.cfn.describe_change_set(StackName=self.name, ChangeSetName=name)
+        except botocore.exceptions.ClientError as e:
+            logger.debug('No change set {} for {}, deploying it the usual way: {}'.format(name, self.name, e))
+            return None
+
+        if cs['Status'] != 'CREATE_COMPLETE' or cs.get('ExecutionStatus') != 'AVAILABLE':
+            logger.warning('Change set {} for {} is {}/{}, deploying it the usual way.'.format(
+                name, self.name, cs['Status'], cs.get('ExecutionStatus')))
+            return None
+        if deployed_fingerprint(cs) != self.fingerprint:
+            logger.warning('{} has changed since change set {} was made, deploying it the usual way.'.format(self.name, name))
+            return None
+
+        waiter_status = 'stack_create_complete' if self.is_in_review() else 'stack_update_complete'
+        try:
+            self.request_token = new_request_token()
+            self.cfn.execute_change_set(StackName=self.name, ChangeSetName=name, ClientRequestToken=self.request_token)
+            self._cache.invalidate(self.name)
+            logger.info('Executing change set {} on {}...'.format(name, self.name))
+        except Exception as e:
+            logger.error('execute_change_set failed on {}.'.format(self.name))
+            maybe_log_an_error(e)
+            return False
+
+        return self.wait_for(waiter_status)
+
+    @traced('generate_cfn_args')
     def generate_cfn_args(self):
         '''CloudFormation API arguments for a stack.'''
         args = {}
         args['StackName'] = self.name
 
         # check template size, upload if necessary
-        if is_over_50kb(self.template_path):
-            logger.warning('{} is larger than 51,200 bytes, uploading to S3...')
+        if is_over_50kb(self.body_path):
+            logger.warning('{} is larger than 51,200 bytes, uploading to S3...'.format(self.template_path))
             if not self.template_bucket:
-                raise Exception('{} cannot be uploaded to S3 because a TemplateBucket was not specified')
-            args['TemplateURL'] = upload_template(self.template_path, self.template_bucket)
+                raise Exception('{} cannot be uploaded to S3 because a TemplateBucket was not specified'.format(self.template_path))
+            args['TemplateURL'] = upload_template(self.body_path, self.template_bucket, self.profile, self.region)
             logger.debug('Template uploaded. Presigned url valid for 120s: {}'.format(args['TemplateURL']))
         else:
-            with open(self.template_path,'r') as f:
-                args['TemplateBody'] = f.read()
+            args['TemplateBody'] = template_body(self.body_path).decode('utf-8')
 
         # parse parameters
         args['Parameters'] = [{'ParameterKey': k, 'ParameterValue': v} for k, v in self.parameters.items()]
@@ -285,9 +604,11 @@ class Stack:
                 raise Exception('Tag value must be a string. Found: {}'.format(type(v)))
             logger.debug('Adding tag: {}: {}'.format(k,v))
             args['Tags'].append({'Key': k, 'Value': v})
+        if FINGERPRINT_TAG not in self.tags:
+            args['Tags'].append({'Key': FINGERPRINT_TAG, 'Value': self.fingerprint})
 
         # parse extra settings
-        for k, v in self.settings.items():
+        for k, v in self.sent_settings.items():
             if k in args.keys():
                 raise Exception('{} already present in CloudFomration API arguments list! Cowardly refusing to overwrite it.')
             logger.debug('Adding extra setting: {}: {}'.format(k,v))
@@ -297,37 +618,492 @@ class Stack:
 
 
 class StackSet:
-    def __init__(self, name='Default', profile='default', stacks=None):
+    def __init__(self, name='Default', profile='default', stacks=None, template_bucket=None, region=None, targets=None):
         self.name = name
         self.profile = profile
+        self.region = region
         self.stacks = stacks if stacks else []
+        self.template_bucket = template_bucket
+        self.targets = targets if targets else []
+        self.timings = {}
+        self.known_outputs = {}
+        self.siblings = {}      # other stacksets in the specfile: {name: {'profile': ..., 'region': ...}}
+        self.workdir = None     # where the run was asked for, if not here. eg: a daemon's client.
+        self._index = None
+
+    @property
+    def output_index(self):
+        if self._index is None:
+            self._index = OutputIndex(self)
+        return self._index
 
-    def deploy(self):
-        '''Creates or Updates all stacks in the stackset. Returns (successes/total)'''
+    @property
+    def outputs(self):
+        '''{stack name: {OutputKey: OutputValue}} for every stack in the stackset that's up.'''
+        r = {}
         for s in self.stacks:
-            if not s.deploy(self):
-                return False
+            o = self.output_index.outputs_of(s)
+            if o is not None:
+                r[s.name] = o
+        return r
+
+    def deploy(self, max_parallel=1, force=False, plan_id=None, validate=True, only=None, resume=False):
+        '''
+        Creates or Updates all stacks in the stackset. A stack starts as soon as every
+        stack it takes outputs from is up, with at most max_parallel going at once.
+        With a plan_id, change sets made by that plan are executed where they're
+        still good. Unless validate is off, nothing is touched until every template
+        has passed validation. If only is a set of stack names, every other stack is
+        skipped without a single call.
+
+        How each stack went is kept in a journal. With resume, stacks the last run
+        finished are skipped, outputs and all, as long as they haven't changed since.
+        Returns True/False.
+        '''
+        todo = [s for s in self.stacks if only is None or s.name in only]
+        if not todo:
+            logger.info('Nothing to deploy.')
+            return True
+        if len(todo) < len(self.stacks):
+            logger.info('Deploying {} of {} stacks: {}'.format(len(todo), len(self.stacks), ', '.join(s.name for s in todo)))
+        start = time.time()
+
+        j = journal.for_stackset(self)
+        done = {}
+        if resume and not localcache.settings['enabled']:
+            logger.warning('The local cache is off, so there is no journal to resume from. Deploying everything.')
+        elif resume:
+            done = j.load()
+            logger.info('Resuming: the journal has {} stacks deployed.'.format(
+                len([e for e in done.values() if e['state'] == journal.DEPLOYED])))
+        else:
+            j.clear()
+
+        def _deploy(s):
+            if s not in todo:
+                logger.debug('Skipping {}.'.format(s.name))
+                return True
+            sched.start(s)
+            events.emit(events.STACK_STARTED, **events.stack_fields(s))
+            r = False
+            try:
+                r = _deploy_stack(s)
+                return r
+            finally:
+                verb = 'Failed to deploy' if not r else ('Deployed' if s.operation else 'Skipped')
+                self.log_progress(sched, s, bool(r), verb, len(todo))
+
+        def _deploy_stack(s):
+            n = s.name
+            if not force and n in done and self.resume_stack(s, done[n]):
+                events.emit(events.STACK_OUTPUTS, outputs=self.known_outputs[n], **events.stack_fields(s))
+                return True
+            try:
+                r = s.deploy(self, force, plan_id)
+            except Exception:
+                j.record(n, journal.FAILED)
+                raise
+            if not r:
+                j.record(n, journal.FAILED)
+                return r
+            self.known_outputs.pop(n, None)
+            outputs = self.output_index.outputs_of(s) or {}
+            j.record(n, journal.DEPLOYED, s.fingerprint, outputs)
+            events.emit(events.STACK_OUTPUTS, outputs=outputs, **events.stack_fields(s))
+            return r
+
+        expected = {}
+        def _expected(s):
+            if s not in expected:
+                expected[s] = _expect(s)
+            return expected[s]
+
+        def _expect(s):
+            if s not in todo or (not force and done.get(s.name, {}).get('state') == journal.DEPLOYED):
+                return None
+            if not stack_exists(s.name, s.profile, s.region):
+                return schedule.CREATE
+            if (s._cache.get(s.name) or {}).get('StackStatus') == 'ROLLBACK_COMPLETE':
+                return schedule.REPLACE
+            if force:
+                return schedule.MAYBE_UPDATE
+            try:
+                # outputs as they are now. they only change if a stack they come from does.
+                s.resolve_outputs(self)
+            except Exception:
+                return schedule.UPDATE
+            if not s.is_unchanged():
+                return schedule.UPDATE
+            if any(_expected(d) for d in deps.get(s, ())):
+                return schedule.MAYBE_UPDATE
+            return None
+
+        self.share_connection_settings()
+        self._index = None
+        size_pool(max_parallel)
+        if not self.package_templates(max_parallel, todo):
+            return False
+        if validate and not self.validate_templates(max_parallel, todo):
+            return False
+        stack_cache(self.profile, self.region).sweep()
+        if not self.upload_templates(max_parallel, todo):
+            return False
+        deps = self.dependencies()
+        sched = schedule.Schedule(self.stacks, deps, _expected, max_parallel)
+        self.log_start('deploy', sched, todo)
+        r = run_graph(self.stacks, deps, _deploy, max_parallel, priority=sched.priority)
+        sched.save()
+        ok = len(r) == len(self.stacks) and all(r.values())
+        events.emit(events.RUN_FINISHED, command='deploy', stackset=self.name, profile=self.profile, region=self.region,
+                    ok=ok, seconds=round(time.time() - start, 2), timings=self.rounded_timings())
+        return ok
+
+    def log_start(self, command, sched, todo):
+        '''Logs when the run should be done, if there's anything to go on.'''
+        eta = sched.eta() if sched.known else None
+        if eta is not None:
+            logger.info('Expecting the {} to take about {:.0f}s, done around {}.'.format(command, eta, schedule.clock(eta)))
+        events.emit(events.RUN_STARTED, command=command, stackset=self.name, profile=self.profile, region=self.region,
+                    stacks=[s.name for s in todo], eta=round(eta, 2) if eta is not None else None)
+
+    def rounded_timings(self):
+        return {n: round(t, 2) for n, t in self.timings.items()}
+
+    def log_progress(self, sched, s, ok, verb, total):
+        '''Notes how long a stack took and logs how far along the run is.'''
+        took, count, left = sched.finish(s, s.operation, ok)
+        self.timings[s.name] = took
+        eta = sched.eta() if left else 0.0
+        logger.info('{} {} in {:.1f}s. {}/{} stacks done ({:.0%}){}'.format(
+            verb, s.name, took, count, total, float(count) / total, ', {}.'.format(sched.describe(eta)) if left else '.'))
+        events.emit(events.STACK_FINISHED, ok=bool(ok), operation=s.operation, skipped=bool(ok) and not s.operation,
+                    seconds=round(took, 2), done=count, total=total, eta=round(eta, 2), **events.stack_fields(s))
+
+    def resume_stack(self, s, entry):
+        '''
+        True if the journal says a stack was deployed exactly as it would be now, in
+        which case its recorded outputs are taken as they are and nothing is called.
+        '''
+        if entry['state'] != journal.DEPLOYED:
+            return False
+        try:
+            s.resolve_outputs(self)
+        except Exception as e:
+            logger.debug('Unable to resolve outputs for {} from the journal: {}'.format(s.name, e))
+            return False
+        if s.fingerprint != entry['fingerprint']:
+            logger.info('{} changed since it was last deployed, deploying it again.'.format(s.name))
+            return False
+        logger.info('{} was already deployed, skipping.'.format(s.name))
+        self.known_outputs[s.name] = entry['outputs']
         return True
 
-    def delete(self):
-        '''Burns all stacks in the stackset. Returns (successes/total)'''
-        r = []
+    def plan(self, max_parallel=1, plan_id=None, force=False, validate=True):
+        '''
+        Creates a change set for every stack, up to max_parallel at once, and waits
+        on them together. Stacks that need outputs which don't exist yet are left to
+        be worked out at deploy time. Returns {stack: ChangeSetResult} in stack order.
+        '''
+        plan_id = plan_id or new_plan_id()
+        self.share_connection_settings()
+        self._index = None
+        size_pool(max_parallel)
+        if not self.package_templates(max_parallel):
+            return {s: ChangeSetResult(s.name, FAILED, reason='Templates could not be packaged.') for s in self.stacks}
+        if validate and not self.validate_templates(max_parallel):
+            return {s: ChangeSetResult(s.name, FAILED, reason='Failed validation.') for s in self.stacks}
+        stack_cache(self.profile, self.region).sweep()
+        if not self.upload_templates(max_parallel):
+            return {s: ChangeSetResult(s.name, FAILED, reason='Templates could not be uploaded.') for s in self.stacks}
+
+        results = {}
+        with ThreadPoolExecutor(max_workers=max(1, max_parallel)) as pool:
+            futures = {pool.submit(s.plan, self, plan_id, force): s for s in self.stacks}
+            for f in as_completed(futures):
+                s = futures[f]
+                try:
+                    results[s] = f.result()
+                except Exception as e:
+                    logger.error('Planning {} blew up: {}'.format(s.name, e))
+                    results[s] = ChangeSetResult(s.name, FAILED, reason=str(e))
+                r = results[s]
+                events.emit(events.STACK_PLANNED, status=r.status, change_set=r.name, change_set_type=r.change_set_type,
+                            changes=r.changes, reason=r.reason, **events.stack_fields(s))
+        return {s: results[s] for s in self.stacks}
+
+    def delete(self, max_parallel=1):
+        '''
+        Burns all stacks in the stackset. Stacks go before the stacks they take outputs
+        from, unrelated stacks can go at the same time. A stack whose consumers failed
+        to delete is left alone and counted as a failure. Returns (successes/total)
+        '''
+        if not self.stacks:
+            return 1.0
+        start = time.time()
+
+        def _delete(s):
+            sched.start(s)
+            events.emit(events.STACK_STARTED, **events.stack_fields(s))
+            r = s.delete()
+            self.log_progress(sched, s, r, 'Deleted' if r else 'Failed to delete', len(self.stacks))
+            return r
+
+        def _expected(s):
+            return schedule.DELETE if stack_exists(s.name, s.profile, s.region) else None
+
+        self.share_connection_settings()
+        self._index = None
+        size_pool(max_parallel)
+        stack_cache(self.profile, self.region).sweep()
+        deps = reverse(self.stacks, self.dependencies())
+        sched = schedule.Schedule(self.stacks, deps, _expected, max_parallel)
+        self.log_start('delete', sched, self.stacks)
+        r = run_graph(self.stacks, deps, _delete, max_parallel, keep_going=True, priority=sched.priority)
+        sched.save()
+        ratio = float(len([i for i in r.values() if i])) / float(len(self.stacks))
+        events.emit(events.RUN_FINISHED, command='delete', stackset=self.name, profile=self.profile, region=self.region,
+                    ok=ratio == 1, seconds=round(time.time() - start, 2), timings=self.rounded_timings())
+        return ratio
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'profile': self.profile,
+            'region': self.region,
+            'template_bucket': self.template_bucket,
+            'targets': [list(t) for t in self.targets],
+            'siblings': self.siblings,
+            'stacks': [s.to_dict() for s in self.stacks],
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        ss = cls(
+            name=d['name'],
+            profile=d['profile'],
+            region=d['region'],
+            template_bucket=d['template_bucket'],
+            targets=[tuple(t) for t in d['targets']],
+            stacks=[Stack.from_dict(s) for s in d['stacks']],
+        )
+        ss.siblings = d.get('siblings') or {}
+        return ss
+
+    def __deepcopy__(self, memo):
+        '''Everything but the output index, which holds a lock and is rebuilt when it's next needed.'''
+        ss = self.__class__.__new__(self.__class__)
+        memo[id(self)] = ss
+        for k, v in self.__dict__.items():
+            setattr(ss, k, None if k == '_index' else copy.deepcopy(v, memo))
+        return ss
+
+    def for_target(self, profile, region):
+        '''
+        A copy of the stackset, stacks and all, pointed at another profile/region.
+        Leave either one as None to keep the stackset's.
+        '''
+        ss = copy.deepcopy(self)
+        ss.profile = profile or self.profile
+        ss.region = region or self.region
+        ss.targets = []
+        ss.known_outputs = {}
+        for s in ss.stacks:
+            s.profile = ss.profile
+            s.region = ss.region
+        return ss
+
+    def fan_out(self, action, max_targets=1, max_failures=1):
+        '''
+        Runs action(stackset) against a copy of the stackset for every (profile, region)
+        in self.targets, up to max_targets at once. action should return something
+        truthy on success. Once max_failures targets have failed, no new targets are
+        started. Returns {(profile, region): result}, None for targets never started.
+        '''
+        results = {t: None for t in self.targets}
+        pending = list(self.targets)
+        running = {}
+        failures = 0
+
+        def _run(t):
+            start = time.time()
+            r = action(self.for_target(*t))
+            took = time.time() - start
+            logger.info('Target {}/{} {} in {:.1f}s.'.format(
+                t[0] or 'default', t[1] or 'default', 'succeeded' if r else 'failed', took))
+            events.emit(events.TARGET_FINISHED, stackset=self.name, profile=t[0], region=t[1], ok=bool(r), seconds=round(took, 2))
+            return r
+
+        with ThreadPoolExecutor(max_workers=max(1, max_targets)) as pool:
+            while pending or running:
+                while pending and len(running) < max_targets and failures < max_failures:
+                    t = pending.pop(0)
+                    running[pool.submit(_run, t)] = t
+                if not running:
+                    break
+                done, _ = wait(list(running.keys()), return_when=FIRST_COMPLETED)
+                for f in done:
+                    t = running.pop(f)
+                    try:
+                        results[t] = f.result()
+                    except Exception as e:
+                        logger.error('Target {}/{} blew up: {}'.format(t[0] or 'default', t[1] or 'default', e))
+                        results[t] = False
+                        events.emit(events.TARGET_FINISHED, stackset=self.name, profile=t[0], region=t[1], ok=False, error=str(e))
+                    if not results[t]:
+                        failures += 1
+
+        if pending:
+            logger.error('Hit {} failed targets, {} targets were not started.'.format(failures, len(pending)))
+        return results
+
+    def share_connection_settings(self):
+        '''Stacks without a profile or region of their own use the stackset's.'''
         for s in self.stacks:
-            r.append(s.delete())
-        return float(len([i for i in r if i])) / float(len(r))
+            s.profile = s.profile or self.profile
+            s.region = s.region or self.region
+
+    def package_templates(self, max_parallel=1, stacks=None):
+        '''
+        Uploads the local code, files and nested templates that the stacks' templates
+        (and StackPolicyURL settings) point at, up to max_parallel at a time, and
+        points each stack at its packaged template. Unchanged artifacts aren't built
+        or uploaded again. Returns True/False.
+        '''
+        if not package.settings['enabled']:
+            return True
+        stacks = self.stacks if stacks is None else stacks
+        packagers = {}
+        for s in stacks:
+            bucket = s.template_bucket or self.template_bucket
+            packagers.setdefault((bucket, s.profile, s.region), []).append(s)
+
+        base = self.workdir or os.getcwd()
+        ok = True
+        for (bucket, profile, region), group in packagers.items():
+            p = package.Packager(bucket, profile, region, max_parallel)
+            try:
+                artifacts = p.artifacts(set(s.template_path for s in group))
+                if artifacts:
+                    logger.info('Packaging {} artifacts...'.format(len(artifacts)))
+                p.upload(artifacts)
+                for s in group:
+                    s.packaged_path = p.template(s.template_path)
+                    for k in package.PACKAGEABLE_SETTINGS:
+                        if package.is_local(s.settings.get(k)):
+                            if not bucket:
+                                raise Exception('{} of {} points at a local file, but a TemplateBucket was not specified.'.format(k, s.name))
+                            s.packaged_settings[k] = p.setting(s.settings[k], base)
+            except Exception as e:
+                logger.error('Unable to package templates.')
+                if not maybe_log_an_error(e):
+                    logger.error(e)
+                ok = False
+        return ok
+
+    def upload_templates(self, max_parallel=1, stacks=None):
+        '''
+        Gets every template that's too big to send inline into S3 before any stack is
+        touched, up to max_parallel uploads at a time. Returns True/False.
+        '''
+        todo = set()
+        for s in (self.stacks if stacks is None else stacks):
+            bucket = s.template_bucket or self.template_bucket
+            if bucket and is_over_50kb(s.body_path):
+                # the bucket belongs to the stack's account, so it's the stack's credentials that go.
+                todo.add((s.body_path, bucket, s.profile, s.region))
+        if not todo:
+            return True
+
+        logger.info('Uploading {} templates to S3...'.format(len(todo)))
+        ok = True
+        with ThreadPoolExecutor(max_workers=max(1, max_parallel)) as pool:
+            futures = {pool.submit(upload_template, p, b, profile, region): p for p, b, profile, region in todo}
+            for f in as_completed(futures):
+                try:
+                    f.result()
+                except Exception as e:
+                    logger.error('Unable to upload {}.'.format(futures[f]))
+                    maybe_log_an_error(e)
+                    ok = False
+        return ok
+
+    def validate_templates(self, max_parallel=1, stacks=None):
+        '''
+        Runs every distinct template through validate_template, up to max_parallel at
+        once, and checks each stack's parameters against what its template declares.
+        Templates already validated in an earlier run are taken from the local cache.
+        Returns True/False.
+        '''
+        # identical templates only need validating once, whatever they're called, using
+        # the first stack's credentials since its bucket might be in its own account.
+        stacks = self.stacks if stacks is None else stacks
+        hashes = {}
+        todo = {}
+        for s in stacks:
+            if s.body_path not in hashes:
+                with open(s.body_path, 'rb') as f:
+                    hashes[s.body_path] = hashlib.sha256(f.read()).hexdigest()
+            todo.setdefault(hashes[s.body_path], (s.body_path, s.template_bucket or self.template_bucket, s.profile, s.region))
+
+        declared = {}
+        ok = True
+        with ThreadPoolExecutor(max_workers=max(1, max_parallel)) as pool:
+            futures = {pool.submit(declared_parameters, p, b, profile, region): (h, p) for h, (p, b, profile, region) in todo.items()}
+            for f in as_completed(futures):
+                h, p = futures[f]
+                try:
+                    declared[h] = f.result()
+                except Exception as e:
+                    logger.error('{} failed validation.'.format(p))
+                    if not maybe_log_an_error(e):
+                        logger.error(e)
+                    ok = False
+
+        for s in stacks:
+            if hashes[s.body_path] not in declared:
+                continue
+            for p in parameter_problems(s, declared[hashes[s.body_path]]):
+                logger.error(p)
+                ok = False
+        if ok:
+            logger.debug('{} templates passed validation.'.format(len(todo)))
+        return ok
+
+    def find_stack(self, name):
+        '''Looks a stack up by the name used in output references.'''
+        return self.output_index.find_stack(name)
+
+    def dependencies(self):
+        '''
+        Maps each stack to the set of stacks it needs outputs from, going by the
+        cfnbotOutputs.<Stack>.<Key> references in its parameters. References to stacks
+        outside the stackset are left for the output index to deal with.
+        '''
+        deps = {}
+        for s in self.stacks:
+            deps[s] = set()
+            for v in s.output_refs.values():
+                d = self.find_stack(parse_output_ref(v)[0])
+                if d and d is not s:
+                    deps[s].add(d)
+        return deps
+
+    def downstream(self, stacks):
+        '''The given stacks, plus every stack that takes outputs from them, directly or not.'''
+        consumers = reverse(self.stacks, self.dependencies())
+        found = set(stacks)
+        todo = list(stacks)
+        while todo:
+            for c in consumers.get(todo.pop(), ()):
+                if c not in found:
+                    found.add(c)
+                    todo.append(c)
+        return found
 
     def get_output(self, value):
         '''
         Checks stack parameters to see if the value refers to another stack's output
         and returns it if it does so properly.
         '''
-        _, stackname, key = value.split('.')
-        logger.debug('Searching {} stacks for {}.{}'.format(len(self.stacks), stackname, key))
-        for s in self.stacks:
-            if s.name == stackname:
-                if s.outputs and key in s.outputs.keys():
-                    logger.debug('Found output reference: {}'.format(s.outputs[key]))
-                    return s.outputs[key]
-
-        # raise if not found, because we don't provide defaults to output refs
-        raise Exception('Unable to find an output named "{}" in a stack named {}'.format(key, stackname))
+        # raises if not found, because we don't provide defaults to output refs
+        return self.output_index.resolve([value])[value]
@@ -0,0 +1,135 @@
+import logging
+import time
+import uuid
+from .trace import span
+from .waiter import settings
+
+logger = logging.getLogger()
+
+CHANGE_SET_PREFIX = 'cfnbot-'
+
+# what planning a stack can come to
+PLANNED = 'planned'         # a change set with changes in it is waiting to be executed
+NO_CHANGES = 'no changes'   # CloudFormation found nothing to do
+UNCHANGED = 'unchanged'     # the fingerprint matched, no change set was needed
+BLOCKED = 'blocked'         # needs outputs that don't exist yet, so it's worked out at deploy time
+FAILED = 'failed'
+
+# what CloudFormation says when a change set has nothing in it.
+NO_CHANGES_REASONS = [
+    "The submitted information didn't contain changes.",
+    'No updates are to be performed.',
+]
+
+SYMBOLS = {
+    'Add': '+',
+    'Modify': '~',
+    'Remove': '-',
+    'Import': '>',
+    'Dynamic': '?',
+}
+
+
+def new_plan_id():
+    return uuid.uuid4().hex[:12]
+
+def change_set_name(plan_id):
+    '''Every stack's change set in a plan has the same name, so a plan is just its id.'''
+    return '{}{}'.format(CHANGE_SET_PREFIX, plan_id)
+
+
+class ChangeSetResult:
+    '''What planning one stack came to. Truthy unless something went wrong.'''
+    def __init__(self, stack, status, name=None, change_set_type=None, changes=None, reason=None):
+        self.stack = stack
+        self.status = status
+        self.name = name
+        self.change_set_type = change_set_type
+        self.changes = changes if changes else []
+        self.reason = reason
+
+    def __bool__(self):
+        return self.status != FAILED
+    __nonzero__ = __bool__
+
+    def __repr__(self):
+        return '<ChangeSetResult {} {} ({} changes)>'.format(self.stack, self.status, len(self.changes))
+
+    def count(self, action):
+        return len([c for c in self.changes if c.get('Action') == action])
+
+
+def _no_changes(reason):
+    return any(r in (reason or '') for r in NO_CHANGES_REASONS)
+
+def describe_changes(cfn, stackname, name):
+    '''Every resource change in a change set, across all pages.'''
+    changes = []
+    kwargs = {'StackName': stackname, 'ChangeSetName': name}
+    while True:
+        r = cfn.describe_change_set(**kwargs)
+        changes.extend(c['ResourceChange'] for c in r.get('Changes', []) if 'ResourceChange' in c)
+        if 'NextToken' not in r:
+            return changes
+        kwargs['NextToken'] = r['NextToken']
+
+def wait_for_change_set(cfn, stackname, name, change_set_type=None):
+    '''
+    Polls a change set until CloudFormation has finished working it out, backing off
+    the same way stack waiters do. Returns a ChangeSetResult.
+    '''
+    delay = settings['delay']
+    deadline = time.time() + settings['timeout']
+    while True:
+        r = cfn.describe_change_set(StackName=stackname, ChangeSetName=name)
+        status = r['Status']
+        if status == 'CREATE_COMPLETE':
+            changes = [c['ResourceChange'] for c in r.get('Changes', []) if 'ResourceChange' in c]
+            if 'NextToken' in r:
+                changes = describe_changes(cfn, stackname, name)
+            return ChangeSetResult(stackname, PLANNED, name, change_set_type, changes)
+        if status == 'FAILED':
+            if _no_changes(r.get('StatusReason')):
+                return ChangeSetResult(stackname, NO_CHANGES, name, change_set_type)
+            return ChangeSetResult(stackname, FAILED, name, change_set_type, reason=r.get('StatusReason'))
+        if time.time() > deadline:
+            return ChangeSetResult(stackname, FAILED, name, change_set_type,
+                                   reason='Timed out after {}s waiting for the change set.'.format(settings['timeout']))
+
+        with span('sleep', stack=stackname):
+            time.sleep(delay)
+        delay = min(settings['max_delay'], delay * settings['backoff'])
+
+
+### output
+def format_change(c):
+    action = c.get('Action')
+    symbol = SYMBOLS.get(action, '?')
+    note = ''
+    if action == 'Modify' and c.get('Replacement') == 'True':
+        symbol, note = '-/+', ' (replaced)'
+    elif action == 'Modify' and c.get('Replacement') == 'Conditional':
+        note = ' (may be replaced)'
+    return '  {:<3} {} ({}){}'.format(symbol, c.get('LogicalResourceId'), c.get('ResourceType'), note)
+
+def format_plan(results):
+    '''Lines describing a whole plan, from {stack: ChangeSetResult} in the order given.'''
+    lines = []
+    for r in results.values():
+        if r.status == PLANNED:
+            lines.append('{} ({}):'.format(r.stack, 'create' if r.change_set_type == 'CREATE' else 'update'))
+            lines.extend(format_change(c) for c in r.changes)
+        elif r.status == BLOCKED:
+            lines.append('{}: worked out at deploy time. {}'.format(r.stack, r.reason or ''))
+        elif r.status == FAILED:
+            lines.append('{}: FAILED. {}'.format(r.stack, r.reason or ''))
+        else:
+            lines.append('{}: {}'.format(r.stack, r.status))
+
+    planned = [r for r in results.values() if r.status == PLANNED]
+    lines.append('{} to add, {} to change, {} to remove across {} of {} stacks.'.format(
+        sum(r.count('Add') for r in planned),
+        sum(r.count('Modify') for r in planned),
+        sum(r.count('Remove') for r in planned),
+        len(planned), len(results)))
+    return lines
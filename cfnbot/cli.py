@@ -1,10 +1,14 @@
-import boto3
 import yaml
 import json
 import logging
 import click
+import os
+import re
 import sys
-from .cfnbot import StackSet, Stack
+import time
+from .cfnbot import StackSet, Stack, clean_path
+from .changeset import change_set_name, format_plan, new_plan_id
+from . import daemon, events, gitdiff, localcache, minify, package, state, status as stack_status, throttle, trace, waiter
 from beeprint import pp
 
 logger = logging.getLogger()
@@ -48,27 +52,129 @@ logger.addHandler(ch)
 
 HELP = {
     'stackset': 'Use a stackset other than "Default".',
+    'poll_delay': 'Seconds to wait before checking on a stack the first time. The wait grows from there.',
+    'max_poll_delay': 'Longest wait between checks on a stack, in seconds.',
+    'force': 'Update stacks even if nothing has changed since they were last deployed.',
+    'target': 'Deploy to PROFILE:REGION instead of the targets in the specfile. Repeat for more targets, either half can be left blank.',
+    'max_targets': 'How many targets to work on at once.',
+    'max_failures': 'Stop starting new targets once this many have failed.',
+    'trace_out': 'Write a Chrome trace (chrome://tracing or Perfetto) of the run to this file.',
+    'cache': 'Use the local cache (compiled specfiles and the like). Lives in ~/.cache/cfnbot unless CFNBOT_CACHE_DIR says otherwise.',
+    'validate': 'Check every template with validate_template, and the parameters against them, before touching any stacks.',
+    'plan': 'Execute the change sets made by `cfnbot plan` with this id. Stacks without a usable one are deployed as usual.',
+    'plan_id': 'Name the plan rather than making up an id, eg: after a commit. Change sets are named cfnbot-ID.',
+    'plan_parallel': 'How many change sets to work on at once.',
+    'minify': 'Send templates over 51,200 bytes as compact JSON, and only go through S3 if they are still too big.',
+    'state': 'Keep what is known about stacks in a SQLite file between runs. Each run then only describes the stacks list_stacks says have changed.',
+    'state_file': 'Where the state store lives.',
+    'package': 'Upload local code and nested templates that templates point at to the TemplateBucket, and deploy the rewritten templates.',
+    'events': 'How many recent events to show for each stack.',
+    'poll_parallel': 'How many stacks to fetch events for at once.',
+    'until_settled': 'Stop watching once no stack is in progress.',
+    'changed_since': 'Only deploy stacks whose template or specfile entry changed since this git ref, and the stacks downstream of them.',
+    'resume': 'Pick up where the last deploy of this stackset left off. Stacks it finished are skipped if nothing about them has changed.',
+    'daemon': 'Hand deploy, delete and status over to a running `cfnbot serve` instead of doing the work here.',
+    'socket': "The daemon's Unix socket.",
+    'workers': 'How many deploys and deletes to run at once. Jobs touching the same stack always wait their turn.',
+    'output': 'jsonl also writes a JSON object per line for every stack transition, CloudFormation event, set of outputs and timing, as they happen. Logs move to stderr while events go to stdout.',
+    'output_file': 'Write the jsonl events to this file instead of stdout. Logs stay where they are.',
+    'max_parallel': 'How many stacks to work on at once. Stacks still wait for the ones they take outputs from.',
 }
 
 @click.group()
+@click.pass_context
 @click.option('--debug/--no-debug', default=False)
-def cli(debug):
+@click.option('--poll-delay', type=click.FLOAT, default=waiter.settings['delay'], help=HELP['poll_delay'])
+@click.option('--max-poll-delay', type=click.FLOAT, default=waiter.settings['max_delay'], help=HELP['max_poll_delay'])
+@click.option('--trace-out', type=click.Path(dir_okay=False, writable=True), default=None, help=HELP['trace_out'])
+@click.option('--cache/--no-cache', default=True, help=HELP['cache'])
+@click.option('--minify/--no-minify', 'minify_templates', default=minify.settings['enabled'], help=HELP['minify'])
+@click.option('--package/--no-package', 'package_templates', default=package.settings['enabled'], help=HELP['package'])
+@click.option('--state/--no-state', 'use_state', default=state.settings['enabled'], envvar='CFNBOT_STATE', help=HELP['state'])
+@click.option('--state-file', type=click.Path(dir_okay=False), default=state.settings['path'], envvar='CFNBOT_STATE_FILE', help=HELP['state_file'])
+@click.option('--daemon/--no-daemon', 'use_daemon', default=daemon.settings['use'], envvar='CFNBOT_DAEMON', help=HELP['daemon'])
+@click.option('--socket', 'socket_path', type=click.Path(dir_okay=False), default=daemon.settings['socket'], envvar='CFNBOT_SOCKET', help=HELP['socket'])
+@click.option('-o', '--output', type=click.Choice(events.FORMATS), default=events.settings['format'], envvar='CFNBOT_OUTPUT', help=HELP['output'])
+@click.option('--output-file', type=click.Path(dir_okay=False, writable=True), default=None, envvar='CFNBOT_OUTPUT_FILE', help=HELP['output_file'])
+def cli(ctx, debug, poll_delay, max_poll_delay, trace_out, cache, minify_templates, package_templates, use_state, state_file, use_daemon, socket_path, output, output_file):
+    events.settings['format'] = output
+    events.settings['path'] = output_file or '-'
+    if output == events.JSONL:
+        events.open_stream(events.settings['path'])
+        ctx.call_on_close(events.close)
+        if events.on_stdout():
+            # stdout is for machines now.
+            old = ch.setStream(sys.stderr)
+            ctx.call_on_close(lambda: ch.setStream(old))
     if debug:
-        click.echo('Debug mode is on')
+        click.echo('Debug mode is on', err=events.on_stdout())
         logger.setLevel(logging.DEBUG)
         logging.getLogger('botocore').setLevel(logging.CRITICAL) # too much noise.
+    localcache.settings['enabled'] = cache
+    minify.settings['enabled'] = minify_templates
+    package.settings['enabled'] = package_templates
+    state.settings['enabled'] = use_state
+    state.settings['path'] = state_file
+    daemon.settings['use'] = use_daemon
+    daemon.settings['socket'] = socket_path
+    waiter.settings['delay'] = poll_delay
+    waiter.settings['max_delay'] = max(poll_delay, max_poll_delay)
+    ctx.call_on_close(log_throttle_stats)
+    if trace_out:
+        trace.start_recording()
+        ctx.call_on_close(lambda: trace.write_chrome_trace(trace_out))
+
+def log_throttle_stats():
+    '''Mentions any throttling AWS did to us, and where the rate ended up.'''
+    for (profile, region, service), st in throttle.stats().items():
+        if st['throttled']:
+            logger.info('{} ({}/{}) throttled {} of {} calls, settled at {:.2f} calls/s.'.format(
+                service, profile or 'default', region or 'default', st['throttled'], st['calls'], st['rate']))
 
 @cli.command()
 @click.argument('specfile', type=click.File())
 @click.option('-s', '--stackset', 'stackset_name', type=click.STRING, default=None, help=HELP['stackset'])
-def deploy(specfile, stackset_name):
+@click.option('-p', '--max-parallel', type=click.IntRange(min=1), default=1, help=HELP['max_parallel'])
+@click.option('--force', is_flag=True, default=False, help=HELP['force'])
+@click.option('-t', '--target', 'targets', type=click.STRING, multiple=True, help=HELP['target'])
+@click.option('--max-targets', type=click.IntRange(min=1), default=1, help=HELP['max_targets'])
+@click.option('--max-failures', type=click.IntRange(min=1), default=1, help=HELP['max_failures'])
+@click.option('--plan', 'plan_id', type=click.STRING, default=None, help=HELP['plan'])
+@click.option('--validate/--no-validate', default=True, help=HELP['validate'])
+@click.option('--changed-since', type=click.STRING, default=None, metavar='GIT_REF', help=HELP['changed_since'])
+@click.option('--resume', is_flag=True, default=False, help=HELP['resume'])
+def deploy(specfile, stackset_name, max_parallel, force, targets, max_targets, max_failures, plan_id, validate, changed_since, resume):
     '''Creates or Updates a set of CloudFormation stacks as defined in the specfile'''
+    click.get_current_context().call_on_close(trace.log_summary)
+    if resume and not localcache.settings['enabled']:
+        logger.error('--resume needs the deploy journal, which lives in the local cache. Drop --no-cache to use it.')
+        sys.exit(1)
+
     ss = parse_specfile(specfile, stackset_name)
 
     if not ss:
         sys.exit(1)
 
-    r = ss.deploy()
+    only = None
+    if changed_since:
+        try:
+            only = set(s.name for s in changed_stacks(ss, specfile.name, stackset_name, changed_since))
+        except Exception as e:
+            logger.error(str(e))
+            sys.exit(1)
+
+    if targets:
+        ss.targets = [parse_target(t) for t in targets]
+    if daemon.settings['use']:
+        options = dict(max_parallel=max_parallel, force=force, max_targets=max_targets, max_failures=max_failures,
+                       plan_id=plan_id, validate=validate, resume=resume)
+        sys.exit(0 if via_daemon('deploy', ss, options=options, only=sorted(only) if only is not None else None) else 1)
+    if ss.targets:
+        results = ss.fan_out(lambda t: t.deploy(max_parallel=max_parallel, force=force, plan_id=plan_id, validate=validate, only=only, resume=resume),
+                             max_targets, max_failures)
+        sys.exit(0 if report_targets(results) else 1)
+
+    r = ss.deploy(max_parallel=max_parallel, force=force, plan_id=plan_id, validate=validate, only=only, resume=resume)
     if r:
         logger.info('Outputs: {}'.format(ss.outputs))
     else:
@@ -81,16 +187,67 @@ def deploy(specfile, stackset_name):
 @cli.command()
 @click.argument('specfile', type=click.File())
 @click.option('-s', '--stackset', 'stackset_name', type=click.STRING, default=None, help=HELP['stackset'])
-def delete(specfile, stackset_name):
+@click.option('-p', '--max-parallel', type=click.IntRange(min=1), default=10, help=HELP['plan_parallel'])
+@click.option('--id', 'plan_id', type=click.STRING, default=None, help=HELP['plan_id'])
+@click.option('--force', is_flag=True, default=False, help=HELP['force'])
+@click.option('-t', '--target', 'targets', type=click.STRING, multiple=True, help=HELP['target'])
+@click.option('--max-targets', type=click.IntRange(min=1), default=1, help=HELP['max_targets'])
+@click.option('--validate/--no-validate', default=True, help=HELP['validate'])
+def plan(specfile, stackset_name, max_parallel, plan_id, force, targets, max_targets, validate):
+    '''Previews what deploy would change, as a set of CloudFormation change sets'''
+    ss = parse_specfile(specfile, stackset_name)
+
+    if not ss:
+        sys.exit(1)
+
+    plan_id = plan_id or new_plan_id()
+    if not re.match(r'^[a-zA-Z0-9][-a-zA-Z0-9]*$', change_set_name(plan_id)) or len(change_set_name(plan_id)) > 128:
+        logger.error('Plan ids can only contain letters, numbers and hyphens.')
+        sys.exit(1)
+
+    if targets:
+        ss.targets = [parse_target(t) for t in targets]
+    if ss.targets:
+        # every target gets planned, failures and all.
+        results = ss.fan_out(lambda t: t.plan(max_parallel=max_parallel, plan_id=plan_id, force=force, validate=validate),
+                             max_targets, len(ss.targets))
+    else:
+        results = {(ss.profile, ss.region): ss.plan(max_parallel=max_parallel, plan_id=plan_id, force=force, validate=validate)}
+
+    ok = True
+    for (profile, region), r in results.items():
+        if len(results) > 1:
+            logger.info('### {}/{}'.format(profile or 'default', region or 'default'))
+        for line in format_plan(r or {}):
+            logger.info(line)
+        ok = ok and bool(r) and all(r.values())
+
+    if not ok:
+        logger.error("Some change sets could not be made. Please check the logs or the AWS console.")
+        sys.exit(1)
+
+    logger.info('Plan {} is ready. Run `cfnbot deploy --plan {}` with the same specfile to carry it out.'.format(plan_id, plan_id))
+    sys.exit(0)
+
+@cli.command()
+@click.argument('specfile', type=click.File())
+@click.option('-s', '--stackset', 'stackset_name', type=click.STRING, default=None, help=HELP['stackset'])
+@click.option('-p', '--max-parallel', type=click.IntRange(min=1), default=1, help=HELP['max_parallel'])
+def delete(specfile, stackset_name, max_parallel):
     '''Deletes a set of CloudFormation stacks as defined in the specfile'''
+    click.get_current_context().call_on_close(trace.log_summary)
     ss = parse_specfile(specfile, stackset_name)
 
     if not ss:
         sys.exit(1)
 
-    r = ss.delete()
+    if daemon.settings['use']:
+        sys.exit(0 if via_daemon('delete', ss, options=dict(max_parallel=max_parallel)) else 1)
+
+    r = ss.delete(max_parallel=max_parallel)
     if r == 0:
         logger.error("The delete process reported errors. Please check the logs or the AWS console.")
+        sys.exit(1)
     if r < 1 and r > 0:
         logger.warning("{}% of stacks failed to delete properly. Please check the logs or the AWS console.".format(int((1.0-r)*100)))
         sys.exit(1)
@@ -98,13 +255,220 @@ def delete(specfile, stackset_name):
     logger.info('Completed without error.')
     sys.exit(0)
 
+@cli.command()
+@click.argument('specfile', type=click.File())
+@click.option('-s', '--stackset', 'stackset_name', type=click.STRING, default=None, help=HELP['stackset'])
+@click.option('-e', '--events', 'event_count', type=click.IntRange(min=0), default=stack_status.settings['events'], help=HELP['events'])
+@click.option('-p', '--max-parallel', type=click.IntRange(min=1), default=10, help=HELP['poll_parallel'])
+def status(specfile, stackset_name, event_count, max_parallel):
+    '''Shows the status, drift and recent events of every stack in the specfile'''
+    ss = parse_specfile(specfile, stackset_name)
+
+    if not ss:
+        sys.exit(1)
+
+    if daemon.settings['use']:
+        sys.exit(0 if via_daemon('status', ss, events=event_count, max_parallel=max_parallel) else 1)
+
+    poller = stack_status.Poller(ss, event_count, max_parallel)
+    views = poller.tick()
+    emit_status(views)
+    for line in stack_status.render(views):
+        logger.info(line)
+    sys.exit(0)
+
+@cli.command()
+@click.argument('specfile', type=click.File())
+@click.option('-s', '--stackset', 'stackset_name', type=click.STRING, default=None, help=HELP['stackset'])
+@click.option('-e', '--events', 'event_count', type=click.IntRange(min=0), default=stack_status.settings['events'], help=HELP['events'])
+@click.option('-p', '--max-parallel', type=click.IntRange(min=1), default=10, help=HELP['poll_parallel'])
+@click.option('--until-settled', is_flag=True, default=False, help=HELP['until_settled'])
+def watch(specfile, stackset_name, event_count, max_parallel, until_settled):
+    '''Keeps showing the status of every stack in the specfile until interrupted'''
+    ss = parse_specfile(specfile, stackset_name)
+
+    if not ss:
+        sys.exit(1)
+
+    poller = stack_status.Poller(ss, event_count, max_parallel)
+    try:
+        while True:
+            views = poller.tick()
+            emit_status(views)
+            lines = stack_status.render(views)
+            if not events.on_stdout():
+                click.clear()
+            for line in lines:
+                logger.info(line)
+            if until_settled and poller.settled():
+                break
+            delay = poller.interval()
+            logger.info('Next update in {:.0f}s. Ctrl-C to stop.'.format(delay))
+            time.sleep(delay)
+    except KeyboardInterrupt:
+        pass
+    sys.exit(0)
+
+@cli.command()
+@click.option('-w', '--workers', type=click.IntRange(min=1), default=4, help=HELP['workers'])
+def serve(workers):
+    '''Runs deploys, deletes and status checks sent over a Unix socket, keeping clients and caches warm between them'''
+    try:
+        daemon.serve(daemon.settings['socket'], workers)
+    except KeyboardInterrupt:
+        pass
+    except Exception as e:
+        logger.error(str(e))
+        sys.exit(1)
+    sys.exit(0)
+
+def emit_status(views):
+    for v in views:
+        events.emit(events.STACK_STATUS, status=v.status, updated=v.updated, drift=v.drift, in_progress=v.in_progress,
+                    failed=v.failed, recent_events=v.events, **events.stack_fields(v.stack))
+
+def via_daemon(command, ss, **request):
+    '''
+    Sends a command and its stackset to `cfnbot serve`, logging the replies as they
+    come in. Template paths are made absolute first, since the daemon could be
+    running anywhere. Returns True/False.
+    '''
+    for s in ss.stacks:
+        s.template_path = clean_path(s.template_path)
+    request.update(command=command, stackset=ss.to_dict(), cwd=os.getcwd())
+
+    ok = False
+    try:
+        for msg in daemon.send(request):
+            events.emit(events.JOB, command=command, stackset=ss.name, **msg)
+            if msg['state'] == daemon.QUEUED:
+                waiting = ', '.join(str(i) for i in msg.get('waiting_on') or [])
+                logger.info('Queued as job {}{}.'.format(msg['job'], ', waiting on job(s) {}'.format(waiting) if waiting else ''))
+            elif msg['state'] == daemon.RUNNING:
+                logger.info('Job {} started.'.format(msg['job']))
+            else:
+                ok = bool(msg.get('ok'))
+                for line in msg.get('lines') or []:
+                    logger.info(line)
+                if msg.get('error'):
+                    logger.error(msg['error'])
+                if msg.get('targets'):
+                    return report_targets({(p, r): v for p, r, v in msg['targets']})
+    except Exception as e:
+        logger.error(str(e))
+        return False
+
+    if not ok:
+        logger.error("The {} process reported errors. Please check the daemon's logs or the AWS console.".format(command))
+    elif command != 'status':
+        logger.info('Completed without error.')
+    return ok
+
+def report_targets(results):
+    '''Logs how each target went. Returns True if they all succeeded.'''
+    for (profile, region), r in results.items():
+        outcome = 'not started' if r is None else ('ok' if r else 'FAILED')
+        logger.info('{:<20} {:<15} {}'.format(profile or 'default', region or 'default', outcome))
+    if all(results.values()):
+        logger.info('Completed without error.')
+        return True
+    logger.error("Some targets reported errors. Please check the logs or the AWS console.")
+    return False
+
+def changed_stacks(ss, specfile_path, stackset_name, ref):
+    '''
+    Stacks whose template or packaged code changed since a git ref, or whose entry in
+    the specfile did, plus every stack downstream of them. Everything counts as changed
+    if the stackset itself changed or the specfile can't be read as of ref.
+    '''
+    files = gitdiff.changed_files(ref)
+    changed = set(s for s in ss.stacks if clean_path(s.template_path) in files)
+    if package.settings['enabled']:
+        for s in ss.stacks:
+            paths = package.sources(s.template_path)
+            if any(f == p or f.startswith(p + os.sep) for f in files for p in paths):
+                changed.add(s)
+
+    if clean_path(specfile_path) in files:
+        old = None
+        text = gitdiff.file_at(ref, specfile_path)
+        try:
+            if text is not None and yaml.load(text, Loader=YAML_LOADER):
+                old = compile_specfile(text, stackset_name)
+        except yaml.YAMLError as e:
+            logger.debug('The specfile at {} does not parse: {}'.format(ref, e))
+
+        strip = lambda d: dict(d, stacks=None, targets=None)
+        if not old or strip(old.to_dict()) != strip(ss.to_dict()):
+            logger.info('The stackset changed since {}, deploying everything.'.format(ref))
+            return set(ss.stacks)
+        before = dict((s.name, s.to_dict()) for s in old.stacks if isinstance(s, Stack))
+        changed.update(s for s in ss.stacks if before.get(s.name) != s.to_dict())
+
+    r = ss.downstream(changed)
+    logger.debug('Changed since {}: {}. With downstream stacks: {}'.format(
+        ref, ', '.join(s.name for s in changed), ', '.join(s.name for s in r)))
+    return r
+
 ### parsers
+def parse_target(value):
+    '''PROFILE:REGION, either of which can be left out, into (profile, region).'''
+    profile, _, region = value.partition(':')
+    return (profile or None, region or None)
+
+# libyaml's loader is many times faster, use it when PyYAML was built with it.
+YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+COMPILED_VERSION = 2
+
+def compiled_key(text, stackset_name):
+    '''Compiled specfiles are keyed on the specfile, the stackset asked for and where we're running from.'''
+    return localcache.sha256(COMPILED_VERSION, text, stackset_name, os.getcwd())
+
+def load_compiled(key):
+    '''
+    A previously compiled StackSet for this key, as long as none of the templates it
+    points at have moved or changed since. None otherwise.
+    '''
+    compiled = localcache.read_json('compiled', '{}.json'.format(key))
+    if not compiled:
+        return None
+    for path, sig in compiled['files'].items():
+        if localcache.file_signature(path) != sig:
+            logger.debug('{} changed since the specfile was compiled.'.format(path))
+            return None
+    try:
+        return StackSet.from_dict(compiled['stackset'])
+    except (KeyError, TypeError) as e:
+        logger.debug('Ignoring a broken compiled specfile: {}'.format(e))
+        return None
+
+def save_compiled(key, ss):
+    files = {s.template_path: localcache.file_signature(s.template_path) for s in ss.stacks}
+    localcache.write_json({'stackset': ss.to_dict(), 'files': files}, 'compiled', '{}.json'.format(key))
+
 def parse_specfile(specfile, stackset_name):
+    '''
+    Turns a specfile into a StackSet. The result is cached on disk, so unchanged
+    specfiles skip YAML parsing and validation entirely on later runs.
+    '''
+    text = specfile.read()
+    key = compiled_key(text, stackset_name)
+    ss = load_compiled(key)
+    if ss:
+        logger.debug('Using the compiled specfile.')
+        return ss
+
+    ss = compile_specfile(text, stackset_name)
+    if ss and all(isinstance(s, Stack) for s in ss.stacks):
+        save_compiled(key, ss)
+    return ss
+
+def compile_specfile(text, stackset_name):
     try:
-        spec = yaml.load(specfile.read())
+        spec = yaml.load(text, Loader=YAML_LOADER)
     except Exception as e:
         logger.error("Couldn't read the YAML provided. Does it pass linting? Am I broken?")
-        logger.debug(e.message)
+        logger.debug(str(e))
         sys.exit(1)
 
     ss = None
@@ -115,6 +479,8 @@ def parse_specfile(specfile, stackset_name):
         ssn = stackset_name if stackset_name else StackSet().name
         ss = parse_stackset(spec[ssn],ssn)
         ss.stacks = [parse_stack(s, ss.name if ss.name != 'Default' else None) for s in spec[ss.name]['Stacks']]
+        ss.siblings = {k: {'profile': v.get('CredentialProfile'), 'region': v.get('Region')}
+                       for k, v in spec.items() if k != ssn and isinstance(v, dict) and 'Stacks' in v}
     elif is_one_stack(spec):
         ss = StackSet(stacks=[{list(spec.keys())[0]: parse_stack(spec)}])
     elif is_multiple_stacks(spec):
@@ -134,12 +500,18 @@ def parse_stackset(snip, name):
     keys = list(snip.keys())
     if 'TemplateBucket' in keys:
         ss.template_bucket = snip['TemplateBucket']
+    if 'CredentialProfile' in keys:
+        ss.profile = snip['CredentialProfile']
+    if 'Region' in keys:
+        ss.region = snip['Region']
+    if 'Targets' in keys:
+        ss.targets = [(t.get('CredentialProfile'), t.get('Region')) for t in snip['Targets']]
     return ss
 
 def parse_stack(snip, prefix=None, sep='-'):
     '''Create a Stack object out of a spec snippet'''
     n = snip['StackName'] if not prefix else "{p}{sep}{sn}".format(p=prefix,sep=sep,sn=snip['StackName'])
-    s = Stack(name=n, template_path=snip['TemplatePath'])
+    s = Stack(name=n, template_path=snip['TemplatePath'], logical_name=snip['StackName'])
     for k in snip.keys():
         if k in ['StackName', 'TemplatePath']:
             continue
@@ -153,6 +525,10 @@ def parse_stack(snip, prefix=None, sep='-'):
             s.settings = snip[k]
         if k == 'TemplateBucket':
             s.template_bucket = snip[k]
+        if k == 'CredentialProfile':
+            s.profile = snip[k]
+        if k == 'Region':
+            s.region = snip[k]
     return s
 
 ### checks
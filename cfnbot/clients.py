@@ -0,0 +1,74 @@
+import logging
+import threading
+from . import throttle, trace
+
+logger = logging.getLogger()
+
+# botocore client config. max_pool_connections gets bumped to suit the parallelism level.
+# throttling is handled by cfnbot.throttle, so botocore sticks to standard retries.
+settings = {
+    'max_pool_connections': 10,
+    'retries': {'mode': 'standard', 'max_attempts': 10},
+}
+
+_sessions = {}
+_clients = {}
+_lock = threading.Lock()
+
+
+def profile_name(profile):
+    '''"default" means whatever boto would pick on its own, env vars included.'''
+    return None if profile in [None, 'default'] else profile
+
+def size_pool(max_parallel):
+    '''
+    Makes sure clients have enough HTTP connections for max_parallel workers. Each
+    worker can have a couple of calls going at once (eg: an upload and a waiter).
+    Clients made with a smaller pool are dropped and rebuilt on next use.
+    '''
+    wanted = max(10, max_parallel * 2)
+    with _lock:
+        if wanted > settings['max_pool_connections']:
+            logger.debug('Growing the client connection pool to {}.'.format(wanted))
+            settings['max_pool_connections'] = wanted
+            _clients.clear()
+
+def session(profile=None):
+    '''One boto3 session per credential profile, created the first time it's asked for.'''
+    import boto3
+    p = profile_name(profile)
+    with _lock:
+        if p not in _sessions:
+            _sessions[p] = boto3.session.Session(profile_name=p)
+        return _sessions[p]
+
+def client(service, profile=None, region=None):
+    '''
+    Pooled, lazily created client keyed by (profile, region, service). boto3 clients
+    are thread-safe, so everyone asking for the same key shares one.
+    '''
+    from botocore.config import Config
+    key = (profile_name(profile), region, service)
+    with _lock:
+        c = _clients.get(key)
+    if c:
+        return c
+
+    s = session(profile)
+    with _lock:
+        if key not in _clients:
+            logger.debug('Creating a {} client for profile {}, region {}.'.format(service, key[0], region))
+            c = s.client(service, region_name=region, config=Config(
+                max_pool_connections=settings['max_pool_connections'],
+                retries=settings['retries'],
+            ))
+            throttle.attach(c, service, key[0], region)
+            trace.attach(c, service)
+            _clients[key] = c
+        return _clients[key]
+
+def reset():
+    '''Forgets every session and client.'''
+    with _lock:
+        _sessions.clear()
+        _clients.clear()
@@ -0,0 +1,288 @@
+import itertools
+import json
+import logging
+import os
+import socket
+import socketserver
+import threading
+import time
+from . import localcache, status as stack_status
+from .clients import profile_name
+
+logger = logging.getLogger()
+
+settings = {
+    # the daemon's socket. only the user running it can connect.
+    'socket': localcache.path('daemon.sock'),
+    # hand deploy/delete/status over to the daemon instead of doing them here.
+    'use': False,
+}
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+
+
+def lock_keys(ss, only=None):
+    '''
+    (profile, region, stack name) for every stack a job would touch, in every target.
+    Two jobs sharing a key never run at the same time.
+    '''
+    keys = set()
+    for profile, region in (ss.targets or [(None, None)]):
+        for s in ss.stacks:
+            if only is not None and s.name not in only:
+                continue
+            if ss.targets:
+                p, r = profile or ss.profile, region or ss.region
+            else:
+                p, r = s.profile or ss.profile, s.region or ss.region
+            keys.add((profile_name(p), r, s.name))
+    return keys
+
+
+class Job:
+    '''One deploy or delete, waiting for, holding or done with its stacks.'''
+    _ids = itertools.count(1)
+
+    def __init__(self, command, stackset, options=None, only=None):
+        self.id = next(Job._ids)
+        self.command = command
+        self.stackset = stackset
+        self.options = options if options else {}
+        self.only = only
+        self.keys = lock_keys(stackset, only)
+        self.state = QUEUED
+        self.ok = None
+        self.error = None
+        self.targets = None
+        self.started = threading.Event()
+        self.finished = threading.Event()
+
+    def __str__(self):
+        return 'job {} ({} {})'.format(self.id, self.command, self.stackset.name)
+
+    def run(self):
+        ss = self.stackset
+        o = self.options
+        if self.command == 'deploy':
+            action = lambda t: t.deploy(max_parallel=o.get('max_parallel', 1), force=o.get('force', False),
+                                        plan_id=o.get('plan_id'), validate=o.get('validate', True),
+                                        only=self.only, resume=o.get('resume', False))
+        else:
+            action = lambda t: t.delete(max_parallel=o.get('max_parallel', 1)) == 1
+
+        if ss.targets:
+            results = ss.fan_out(action, o.get('max_targets', 1), o.get('max_failures', 1))
+            self.targets = [[p, r, v] for (p, r), v in results.items()]
+            return all(results.values())
+        return bool(action(ss))
+
+    def to_dict(self):
+        return {'job': self.id, 'state': self.state, 'ok': self.ok, 'error': self.error, 'targets': self.targets}
+
+
+class JobQueue:
+    '''
+    First come, first served, up to workers jobs at once. A job only starts once
+    none of its stacks are held by a running job or wanted by one queued before it,
+    so jobs touching the same stack run in the order they arrived and everything
+    else goes around them.
+    '''
+    def __init__(self, workers=4):
+        self.workers = max(1, workers)
+        self._pending = []
+        self._held = {}     # lock key: job holding it
+        self._cond = threading.Condition()
+        self._stopping = False
+
+    def submit(self, job):
+        with self._cond:
+            self._pending.append(job)
+            self._cond.notify_all()
+        logger.info('Queued {}, {} stacks.'.format(job, len(job.keys)))
+
+    def blockers(self, job):
+        '''Jobs this one is waiting on, running or queued ahead of it.'''
+        with self._cond:
+            ahead = list(self._held.values())
+            for j in self._pending:
+                if j is job:
+                    break
+                ahead.append(j)
+        return sorted(set(j.id for j in ahead if j is not job and j.keys & job.keys))
+
+    def _next(self):
+        wanted = set()
+        for j in self._pending:
+            if not (j.keys & wanted) and not any(k in self._held for k in j.keys):
+                return j
+            wanted.update(j.keys)
+        return None
+
+    def take(self):
+        '''Blocks until a job can start, locks its stacks and hands it over. None once stopping.'''
+        with self._cond:
+            while True:
+                if self._stopping:
+                    return None
+                job = self._next()
+                if job:
+                    self._pending.remove(job)
+                    for k in job.keys:
+                        self._held[k] = job
+                    job.state = RUNNING
+                    job.started.set()
+                    return job
+                self._cond.wait()
+
+    def release(self, job):
+        with self._cond:
+            for k in job.keys:
+                self._held.pop(k, None)
+            job.state = DONE
+            job.finished.set()
+            self._cond.notify_all()
+
+    def work(self):
+        while True:
+            job = self.take()
+            if job is None:
+                return
+            start = time.time()
+            logger.info('Starting {}.'.format(job))
+            try:
+                job.ok = job.run()
+            except Exception as e:
+                logger.error('{} blew up: {}'.format(job, e))
+                job.ok = False
+                job.error = str(e)
+            logger.info('Finished {} in {:.1f}s: {}.'.format(job, time.time() - start, 'ok' if job.ok else 'FAILED'))
+            self.release(job)
+
+    def start(self):
+        for i in range(self.workers):
+            threading.Thread(target=self.work, name='cfnbot-worker-{}'.format(i), daemon=True).start()
+
+    def stop(self):
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+
+
+### server
+class Handler(socketserver.StreamRequestHandler):
+    '''
+    One request per connection, as a line of JSON. Replies are lines of JSON too:
+    deploys and deletes get one as they're queued, started and finished, status
+    gets the table. Hanging up doesn't cancel a job, it just stops the updates.
+    '''
+    def send(self, msg):
+        self.wfile.write((json.dumps(msg, default=str) + '\n').encode('utf-8'))
+        self.wfile.flush()
+
+    def handle(self):
+        from .cfnbot import StackSet
+        try:
+            line = self.rfile.readline()
+            if not line.strip():
+                # someone checking whether we're here.
+                return
+            req = json.loads(line.decode('utf-8'))
+            command = req['command']
+            if command == 'ping':
+                self.send({'state': DONE, 'ok': True, 'pid': os.getpid()})
+                return
+
+            ss = StackSet.from_dict(req['stackset'])
+            ss.workdir = req.get('cwd')
+            if command == 'status':
+                poller = stack_status.Poller(ss, req.get('events'), req.get('max_parallel', 10))
+                self.send({'state': DONE, 'ok': True, 'lines': stack_status.render(poller.tick())})
+                return
+            if command not in ['deploy', 'delete']:
+                raise Exception('Unknown command: {}'.format(command))
+
+            only = set(req['only']) if req.get('only') is not None else None
+            job = Job(command, ss, req.get('options'), only)
+            self.server.queue.submit(job)
+            # it may well be running (or done) already, but each state gets its turn.
+            self.send(dict(job.to_dict(), state=QUEUED, waiting_on=self.server.queue.blockers(job)))
+            job.started.wait()
+            self.send(dict(job.to_dict(), state=RUNNING))
+            job.finished.wait()
+            self.send(job.to_dict())
+        except (BrokenPipeError, ConnectionResetError):
+            logger.debug('A client hung up before its job was done.')
+        except Exception as e:
+            logger.error('Bad request: {}'.format(e))
+            try:
+                self.send({'state': DONE, 'ok': False, 'error': str(e)})
+            except (IOError, OSError):
+                pass
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, queue):
+        self.queue = queue
+        socketserver.UnixStreamServer.__init__(self, path, Handler)
+
+
+def _in_use(path):
+    '''True if something is already answering on a socket path.'''
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(path)
+        return True
+    except (IOError, OSError):
+        return False
+    finally:
+        s.close()
+
+def serve(path=None, workers=4):
+    '''
+    Takes jobs on a Unix socket until interrupted. Clients, sessions, the stack
+    cache, validations and so on live as long as the process, so every job after
+    the first starts warm.
+    '''
+    path = path or settings['socket']
+    if os.path.exists(path):
+        if _in_use(path):
+            raise Exception('Something is already listening on {}. Is another cfnbot daemon running?'.format(path))
+        os.remove(path)
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    queue = JobQueue(workers)
+    old = os.umask(0o077)
+    try:
+        server = Server(path, queue)
+    finally:
+        os.umask(old)
+    queue.start()
+    logger.info('cfnbot daemon listening on {}, running up to {} jobs at once.'.format(path, queue.workers))
+    try:
+        server.serve_forever()
+    finally:
+        queue.stop()
+        server.server_close()
+        if os.path.exists(path):
+            os.remove(path)
+
+
+### client
+def send(request, path=None):
+    '''Sends a request to the daemon and yields its replies as they come in.'''
+    path = path or settings['socket']
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(path)
+    except (IOError, OSError) as e:
+        s.close()
+        raise Exception('Unable to reach a cfnbot daemon on {}: {}. Is `cfnbot serve` running?'.format(path, e))
+    with s, s.makefile('rwb') as f:
+        f.write((json.dumps(request, default=str) + '\n').encode('utf-8'))
+        f.flush()
+        for line in f:
+            yield json.loads(line.decode('utf-8'))
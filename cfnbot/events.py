@@ -0,0 +1,87 @@
+import datetime
+import json
+import logging
+import sys
+import threading
+
+logger = logging.getLogger()
+
+settings = {
+    # text: log lines for people. jsonl: a JSON object per line for every event too.
+    'format': 'text',
+    # where events go. '-' is stdout, in which case the logs move to stderr.
+    'path': '-',
+}
+
+TEXT = 'text'
+JSONL = 'jsonl'
+FORMATS = [TEXT, JSONL]
+
+# what can be emitted
+RUN_STARTED = 'run_started'         # a deploy or delete is about to touch stacks
+RUN_FINISHED = 'run_finished'       # ...and it's over, with per-stack timings
+STACK_STARTED = 'stack_started'     # a stack's turn came up
+STACK_OPERATION = 'stack_operation' # CloudFormation is creating, updating or deleting it
+STACK_EVENT = 'stack_event'         # a describe_stack_events entry, as the waiter sees it
+STACK_OUTPUTS = 'stack_outputs'     # a stack's outputs, once it's up. always before its stack_finished.
+STACK_FINISHED = 'stack_finished'   # done with a stack, one way or another
+STACK_PLANNED = 'stack_planned'     # what planning a stack came to
+STACK_STATUS = 'stack_status'       # a row of `status` or `watch`
+TARGET_FINISHED = 'target_finished' # one profile/region of a fanned out run is over
+JOB = 'job'                         # a daemon job was queued, started or finished
+
+_lock = threading.Lock()
+_stream = None
+_owned = False
+
+
+def enabled():
+    return _stream is not None
+
+def on_stdout():
+    return _stream is sys.stdout
+
+def open_stream(path=None):
+    '''Starts emitting events to a file, or stdout for '-'. Anything open already is closed first.'''
+    global _stream, _owned
+    close()
+    path = path or settings['path']
+    with _lock:
+        if path == '-':
+            _stream, _owned = sys.stdout, False
+        else:
+            _stream, _owned = open(path, 'a', encoding='utf-8'), True
+
+def close():
+    global _stream, _owned
+    with _lock:
+        if _stream is not None and _owned:
+            _stream.close()
+        _stream, _owned = None, False
+
+def _now():
+    return datetime.datetime.now(datetime.timezone.utc).isoformat()
+
+def emit(event, **fields):
+    '''
+    Writes an event out as a line of JSON, straight away. Nothing is kept, so a run
+    costs the same memory however long it goes, and whoever is reading sees each
+    event as it happens. Does nothing unless a stream is open.
+    '''
+    if _stream is None:
+        return
+    e = {'event': event, 'time': _now()}
+    e.update(fields)
+    line = json.dumps(e, default=str) + '\n'
+    with _lock:
+        if _stream is None:
+            return
+        try:
+            _stream.write(line)
+            _stream.flush()
+        except (IOError, OSError, ValueError) as ex:
+            logger.debug('Unable to emit a {} event: {}'.format(event, ex))
+
+def stack_fields(s):
+    '''Where a stack lives, so events from several targets can be told apart.'''
+    return {'stack': s.name, 'logical_name': s.logical_name, 'profile': s.profile, 'region': s.region}
@@ -0,0 +1,36 @@
+import logging
+import os
+import subprocess
+
+logger = logging.getLogger()
+
+
+def _git(*args):
+    try:
+        return subprocess.check_output(['git'] + list(args), stderr=subprocess.PIPE).decode('utf-8')
+    except OSError:
+        raise Exception('git is needed to work out what changed, but it could not be run.')
+    except subprocess.CalledProcessError as e:
+        raise Exception('git {} failed: {}'.format(' '.join(args), e.stderr.decode('utf-8').strip()))
+
+def toplevel():
+    return _git('rev-parse', '--show-toplevel').strip()
+
+def changed_files(ref):
+    '''
+    Real paths of every file that differs from ref in the working tree, committed
+    or not, plus untracked files which aren't ignored.
+    '''
+    top = toplevel()
+    names = _git('diff', '--name-only', ref, '--').splitlines()
+    names += _git('ls-files', '--others', '--exclude-standard', '--full-name', top).splitlines()
+    return set(os.path.realpath(os.path.join(top, n)) for n in names if n)
+
+def file_at(ref, path):
+    '''Contents of a file as of ref, or None if it didn't exist then.'''
+    rel = os.path.relpath(os.path.realpath(path), os.path.realpath(toplevel()))
+    try:
+        return _git('show', '{}:{}'.format(ref, rel.replace(os.sep, '/')))
+    except Exception as e:
+        logger.debug('{} not found at {}: {}'.format(path, ref, e))
+        return None
@@ -0,0 +1,164 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+logger = logging.getLogger()
+
+OUTPUT_REF_PREFIX = 'cfnbotOutputs'
+
+
+### output references
+def is_output_ref(value):
+    '''True if a parameter value looks like cfnbotOutputs.[<StackSet>.]<Stack>.<Key>'''
+    return isinstance(value, str) and value.startswith(OUTPUT_REF_PREFIX)
+
+def parse_output_ref(value):
+    '''
+    Splits cfnbotOutputs.<Stack>.<Key> into (Stack, Key). A reference to a stack in
+    another stackset, cfnbotOutputs.<StackSet>.<Stack>.<Key>, comes out as
+    (StackSet.Stack, Key).
+    '''
+    parts = value.split('.')
+    if len(parts) not in [3, 4] or not all(parts):
+        raise Exception('Output references must look like {}.[<StackSet>.]<StackName>.<OutputKey>. Found: {}'.format(OUTPUT_REF_PREFIX, value))
+    return '.'.join(parts[1:-1]), parts[-1]
+
+
+### the graph
+def find_cycle(nodes, deps):
+    '''Returns a list of nodes forming a dependency loop, or None if there isn't one.'''
+    state = {}
+    path = []
+
+    def visit(n):
+        state[n] = 'visiting'
+        path.append(n)
+        for d in deps.get(n, ()):
+            if state.get(d) == 'visiting':
+                return path[path.index(d):] + [d]
+            if d not in state:
+                c = visit(d)
+                if c:
+                    return c
+        path.pop()
+        state[n] = 'done'
+        return None
+
+    for n in nodes:
+        if n not in state:
+            c = visit(n)
+            if c:
+                return c
+    return None
+
+def reverse(nodes, deps):
+    '''Flips a dependency map around so that consumers become dependencies of producers.'''
+    r = {n: set() for n in nodes}
+    for n in nodes:
+        for d in deps.get(n, ()):
+            r[d].add(n)
+    return r
+
+def by_priority(nodes, priority=None):
+    '''Nodes, highest priority first. Ties (and everything, without priorities) keep list order.'''
+    if not priority:
+        return list(nodes)
+    return sorted(nodes, key=lambda n: -priority.get(n, 0))
+
+def critical_path(nodes, deps, durations):
+    '''
+    {node: seconds from the node starting to everything that waits on it being done},
+    given how long each node takes. The node with the biggest number is at the head
+    of the critical path. Everything gets 0 if there's a dependency loop.
+    '''
+    if find_cycle(nodes, deps):
+        return {n: 0 for n in nodes}
+    consumers = reverse(nodes, deps)
+    rank = {}
+
+    def visit(n):
+        if n not in rank:
+            rank[n] = durations.get(n, 0) + max([visit(c) for c in consumers[n]] + [0])
+        return rank[n]
+
+    for n in nodes:
+        visit(n)
+    return rank
+
+def simulate(nodes, deps, durations, max_parallel=1, priority=None, running=None):
+    '''
+    Seconds until every node is done if each takes durations[n] and they're started
+    the way run_graph would start them. running maps nodes already going to the
+    seconds they have left. Deps which are in neither are taken to be done already.
+    '''
+    max_parallel = max(1, max_parallel)
+    finish = dict(running or {})
+    pending = [n for n in by_priority(nodes, priority) if n not in finish]
+    waiting_on = set(pending) | set(finish)
+    now = 0.0
+    while pending or finish:
+        for n in list(pending):
+            if len(finish) >= max_parallel:
+                break
+            if not any(d in waiting_on for d in deps.get(n, ())):
+                pending.remove(n)
+                finish[n] = now + durations.get(n, 0)
+        if not finish:
+            break
+        n = min(finish, key=finish.get)
+        now = max(now, finish.pop(n))
+        waiting_on.discard(n)
+    return now
+
+def run_graph(nodes, deps, fn, max_parallel=1, keep_going=False, priority=None):
+    '''
+    Calls fn(node) for every node once all of its deps have returned something truthy,
+    with up to max_parallel calls in flight. When several nodes are ready at once the
+    ones with the highest priority go first, then list order, so max_parallel=1 with
+    no priorities behaves like the old one-at-a-time loop.
+
+    Nodes downstream of a failure never run. Anything else stops being scheduled after
+    the first failure unless keep_going is set. A node whose fn raises counts as a
+    failure. Returns {node: result} for the nodes which actually ran.
+    '''
+    cycle = find_cycle(nodes, deps)
+    if cycle:
+        raise Exception('Dependency loop found: {}'.format(' -> '.join(str(n) for n in cycle)))
+
+    max_parallel = max(1, max_parallel)
+    results = {}
+    pending = by_priority(nodes, priority)
+    running = {}
+    failed = False
+
+    with ThreadPoolExecutor(max_workers=max_parallel) as pool:
+        while pending or running:
+            if failed and not keep_going:
+                pending = []
+            for n in list(pending):
+                if len(running) >= max_parallel:
+                    break
+                ds = deps.get(n, ())
+                if any(d in results and not results[d] for d in ds):
+                    logger.debug('Skipping {}, something it depends on failed.'.format(n))
+                    pending.remove(n)
+                elif all(results.get(d) for d in ds):
+                    pending.remove(n)
+                    running[pool.submit(fn, n)] = n
+
+            if not running:
+                # whatever is left is waiting on something that was skipped.
+                break
+
+            done, _ = wait(list(running.keys()), return_when=FIRST_COMPLETED)
+            for f in done:
+                n = running.pop(f)
+                try:
+                    results[n] = f.result()
+                except Exception as e:
+                    # one node blowing up is just a failure, the rest of the graph carries on as usual.
+                    logger.error('{} blew up: {}'.format(n, e))
+                    results[n] = False
+                if not results[n]:
+                    failed = True
+
+    return results
@@ -0,0 +1,70 @@
+import json
+import logging
+import os
+import threading
+import time
+from . import localcache
+from .clients import profile_name
+
+logger = logging.getLogger()
+
+DEPLOYED = 'deployed'
+FAILED = 'failed'
+
+
+class Journal:
+    '''
+    Append-only record of how each stack in a deploy went, as JSON lines: its state,
+    the fingerprint of what was sent and the outputs it ended up with. The last line
+    for a stack wins. Does nothing while the local cache is turned off.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def record(self, stack, state, fingerprint=None, outputs=None):
+        if not localcache.settings['enabled']:
+            return
+        line = json.dumps({
+            'stack': stack,
+            'state': state,
+            'fingerprint': fingerprint,
+            'outputs': outputs if outputs else {},
+            'time': time.time(),
+        }, sort_keys=True, default=str)
+        with self._lock:
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                with open(self.path, 'a') as f:
+                    f.write(line + '\n')
+            except (IOError, OSError) as e:
+                logger.warning('Unable to write to the deploy journal {}: {}'.format(self.path, e))
+
+    def load(self):
+        '''{stack: last entry}'''
+        entries = {}
+        if not localcache.settings['enabled']:
+            return entries
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        e = json.loads(line)
+                    except ValueError:
+                        # a run that died mid-write. everything before it is still good.
+                        continue
+                    entries[e['stack']] = e
+        except (IOError, OSError):
+            pass
+        return entries
+
+    def clear(self):
+        with self._lock:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+
+def for_stackset(ss):
+    '''The journal for a stackset in its account and region, run from its workdir or here.'''
+    key = localcache.sha256(ss.workdir or os.getcwd(), ss.name, profile_name(ss.profile), ss.region)
+    return Journal(localcache.path('journals', '{}.jsonl'.format(key)))
@@ -0,0 +1,62 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+
+logger = logging.getLogger()
+
+settings = {
+    'enabled': True,
+    # XDG_CACHE_HOME/cfnbot, or ~/.cache/cfnbot. CFNBOT_CACHE_DIR wins over both.
+    'dir': os.environ.get('CFNBOT_CACHE_DIR') or os.path.join(
+        os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'), 'cfnbot'),
+}
+
+
+def sha256(*parts):
+    '''Hex digest over any mix of str and bytes.'''
+    h = hashlib.sha256()
+    for p in parts:
+        h.update(p if isinstance(p, bytes) else str(p).encode('utf-8'))
+        h.update(b'\0')
+    return h.hexdigest()
+
+def file_signature(path):
+    '''(size, mtime) for a file, or None if it isn't there. Cheap stand-in for hashing it.'''
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_size, st.st_mtime_ns]
+
+def path(*parts):
+    return os.path.join(settings['dir'], *parts)
+
+def read_json(*parts):
+    '''Whatever was stored under parts, or None if it's missing, unreadable or caching is off.'''
+    if not settings['enabled']:
+        return None
+    p = path(*parts)
+    try:
+        with open(p) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+def write_json(data, *parts):
+    '''Stores data under parts atomically. Failing to write a cache is never fatal.'''
+    if not settings['enabled']:
+        return
+    p = path(*parts)
+    tmp = None
+    try:
+        os.makedirs(os.path.dirname(p), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(p), prefix='.tmp-')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f, sort_keys=True, default=str)
+        os.replace(tmp, p)
+    except (IOError, OSError, TypeError, ValueError) as e:
+        logger.debug('Unable to write cache file {}: {}'.format(p, e))
+        if tmp and os.path.exists(tmp):
+            os.remove(tmp)
@@ -0,0 +1,94 @@
+import hashlib
+import json
+import logging
+import threading
+import yaml
+from . import localcache
+
+logger = logging.getLogger()
+
+settings = {
+    # minify templates that are too big to send inline before falling back to S3.
+    'enabled': False,
+}
+
+
+# YAML templates minus the bits JSON can't say: intrinsic function tags become
+# their long form and dates stay strings, like they do in CloudFormation.
+class TemplateLoader(getattr(yaml, 'CSafeLoader', yaml.SafeLoader)):
+    pass
+
+TemplateLoader.yaml_implicit_resolvers = {
+    k: [(tag, regexp) for tag, regexp in v if tag != 'tag:yaml.org,2002:timestamp']
+    for k, v in TemplateLoader.yaml_implicit_resolvers.items()
+}
+
+def _construct_intrinsic(loader, suffix, node):
+    if isinstance(node, yaml.ScalarNode):
+        value = loader.construct_scalar(node)
+    elif isinstance(node, yaml.SequenceNode):
+        value = loader.construct_sequence(node, deep=True)
+    else:
+        value = loader.construct_mapping(node, deep=True)
+
+    if suffix == 'Ref' or suffix == 'Condition':
+        return {suffix: value}
+    if suffix == 'GetAtt' and isinstance(value, str):
+        value = value.split('.', 1)
+    return {'Fn::{}'.format(suffix): value}
+
+def _construct_number(loader, node):
+    '''Numbers that wouldn't come back out the way they went in (1.10, 0755) stay strings.'''
+    text = loader.construct_scalar(node)
+    tag = 'tag:yaml.org,2002:int' if node.tag.endswith(':int') else 'tag:yaml.org,2002:float'
+    value = yaml.SafeLoader.yaml_constructors[tag](loader, node)
+    return value if json.dumps(value) == text else text
+
+TemplateLoader.add_multi_constructor('!', _construct_intrinsic)
+TemplateLoader.add_constructor('tag:yaml.org,2002:int', _construct_number)
+TemplateLoader.add_constructor('tag:yaml.org,2002:float', _construct_number)
+
+
+def minify(body):
+    '''A template, YAML or JSON, as compact JSON bytes. Barfs if it doesn't parse.'''
+    text = body.decode('utf-8')
+    try:
+        template = json.loads(text)
+    except ValueError:
+        template = yaml.load(text, Loader=TemplateLoader)
+    return json.dumps(template, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+
+# template sha256: minified body, for templates minified during this run
+_minified = {}
+_lock = threading.Lock()
+
+def minified(body, path=None):
+    '''
+    Minified version of a template body, cached by content hash for the run and in
+    the local cache. Templates which can't be minified come back as they are.
+    '''
+    key = hashlib.sha256(body).hexdigest()
+    with _lock:
+        if key in _minified:
+            return _minified[key]
+
+    cached = localcache.read_json('minified', '{}.json'.format(key))
+    if cached is not None:
+        small = cached['body'].encode('utf-8')
+    else:
+        try:
+            small = minify(body)
+            localcache.write_json({'body': small.decode('utf-8')}, 'minified', '{}.json'.format(key))
+            logger.debug('Minified {} from {} to {} bytes.'.format(path or 'template', len(body), len(small)))
+        except Exception as e:
+            logger.warning('Unable to minify {}, using it as is: {}'.format(path or 'template', e))
+            small = body
+
+    with _lock:
+        _minified[key] = small
+    return small
+
+def forget():
+    with _lock:
+        _minified.clear()
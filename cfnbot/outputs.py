@@ -0,0 +1,106 @@
+import logging
+import threading
+from .cache import stack_cache
+from .graph import parse_output_ref
+
+logger = logging.getLogger()
+
+
+def outputs_of(description):
+    '''{OutputKey: OutputValue} from a describe_stacks entry.'''
+    return {o['OutputKey']: o['OutputValue'] for o in (description or {}).get('Outputs', [])}
+
+
+class OutputIndex:
+    '''
+    Where every output reference in a stackset points, and what it comes to.
+
+    Stacks in the stackset are found by their name in the specfile or their real
+    name. cfnbotOutputs.<StackSet>.<Stack>.<Key> points at a stack in another
+    stackset from the same specfile, and any other name is taken to be an existing
+    stack in the stackset's account and region. Outputs are read once and kept for
+    the rest of the run: the stackset's own in its known_outputs, everything else
+    here, fetched with one describe_stacks sweep per account and region.
+    '''
+    def __init__(self, stackset):
+        self.stackset = stackset
+        self._by_name = {}
+        for s in stackset.stacks:
+            self._by_name.setdefault(s.name, s)
+            self._by_name.setdefault(s.logical_name, s)
+        self._external = {}     # (profile, region, stack name): outputs, None if the stack isn't there
+        self._lock = threading.Lock()
+
+    def find_stack(self, name):
+        '''A stack in the stackset, by any of the names a reference might use for it.'''
+        if name in self._by_name:
+            return self._by_name[name]
+        if '.' in name:
+            ssn, stack = name.split('.', 1)
+            if ssn == self.stackset.name:
+                return self._by_name.get(stack)
+        return self._by_name.get('{}-{}'.format(self.stackset.name, name))
+
+    def locate(self, name):
+        '''(profile, region, stack name) for a stack outside the stackset.'''
+        ss = self.stackset
+        if '.' in name:
+            ssn, stack = name.split('.', 1)
+            sibling = ss.siblings.get(ssn, {})
+            return (sibling.get('profile') or ss.profile, sibling.get('region') or ss.region,
+                    stack if ssn == 'Default' else '{}-{}'.format(ssn, stack))
+        return (ss.profile, ss.region, name)
+
+    def outputs_of(self, s):
+        '''Outputs of a stack in the stackset, read through the stack cache the first time.'''
+        known = self.stackset.known_outputs
+        if s.name not in known:
+            d = stack_cache(s.profile, s.region).get(s.name)
+            if d is None:
+                return None
+            known[s.name] = outputs_of(d)
+        return known[s.name]
+
+    def _fetch(self, locations):
+        '''Sweeps each account/region the locations are in, once, and keeps their outputs.'''
+        with self._lock:
+            todo = [l for l in locations if l not in self._external]
+            for profile, region in set((p, r) for p, r, _ in todo):
+                c = stack_cache(profile, region)
+                c.ensure_swept()
+                for p, r, n in todo:
+                    if (p, r) == (profile, region):
+                        d = c.get(n)
+                        self._external[(p, r, n)] = outputs_of(d) if d else None
+
+    def resolve(self, refs):
+        '''
+        Values for a batch of cfnbotOutputs references, as {reference: value}. Stacks
+        outside the stackset are all fetched together. Barfs on the first reference
+        that can't be found.
+        '''
+        found = {}
+        outside = {}
+        for ref in refs:
+            stackname, key = parse_output_ref(ref)
+            s = self.find_stack(stackname)
+            if s:
+                outputs = self.outputs_of(s)
+            else:
+                outside[ref] = self.locate(stackname)
+                continue
+            if not outputs or key not in outputs:
+                raise Exception('Unable to find an output named "{}" in a stack named {}'.format(key, stackname))
+            found[ref] = outputs[key]
+
+        if outside:
+            self._fetch(set(outside.values()))
+        for ref, loc in outside.items():
+            stackname, key = parse_output_ref(ref)
+            outputs = self._external.get(loc)
+            if outputs is None:
+                raise Exception('Unable to find a stack named {} for {}'.format(loc[2], ref))
+            if key not in outputs:
+                raise Exception('Unable to find an output named "{}" in a stack named {}'.format(key, loc[2]))
+            found[ref] = outputs[key]
+        return found
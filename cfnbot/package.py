@@ -0,0 +1,323 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import stat
+import tempfile
+import threading
+import zipfile
+import yaml
+from concurrent.futures import ThreadPoolExecutor
+from . import localcache, uploads
+from .clients import client
+from .minify import TemplateLoader
+
+logger = logging.getLogger()
+
+settings = {
+    # upload local code and templates that templates point at, and send the rewritten template.
+    'enabled': False,
+}
+
+# what a property wants a local path turned into
+ZIP = 'zip'             # a zip of the directory, or of the file unless it's a .zip/.jar already
+FILE = 'file'           # the file as it is
+TEMPLATE = 'template'   # a nested template, packaged in turn
+
+# how the uploaded object gets written back into the template
+S3_BUCKET_KEY = 'S3Bucket/S3Key'
+BUCKET_KEY = 'Bucket/Key'
+S3_URI = 's3://'
+HTTPS_URL = 'https://'
+
+# resource type: [(property, what it takes, how it's written)]. the same list as
+# `aws cloudformation package`, minus the oddballs.
+PACKAGEABLE = {
+    'AWS::Lambda::Function': [('Code', ZIP, S3_BUCKET_KEY)],
+    'AWS::Lambda::LayerVersion': [('Content', ZIP, S3_BUCKET_KEY)],
+    'AWS::Serverless::Function': [('CodeUri', ZIP, S3_URI)],
+    'AWS::Serverless::LayerVersion': [('ContentUri', ZIP, S3_URI)],
+    'AWS::Serverless::Api': [('DefinitionUri', FILE, S3_URI)],
+    'AWS::Serverless::StateMachine': [('DefinitionUri', FILE, S3_URI)],
+    'AWS::ApiGateway::RestApi': [('BodyS3Location', FILE, BUCKET_KEY)],
+    'AWS::StepFunctions::StateMachine': [('DefinitionS3Location', FILE, BUCKET_KEY)],
+    'AWS::CloudFormation::Stack': [('TemplateURL', TEMPLATE, HTTPS_URL)],
+    'AWS::Serverless::Application': [('Location', TEMPLATE, HTTPS_URL)],
+}
+# stack settings that can point at a local file instead of a URL
+PACKAGEABLE_SETTINGS = ['StackPolicyURL']
+
+# every zip entry gets the same timestamp, so the same files always make the same zip.
+ZIP_EPOCH = (1980, 1, 1, 0, 0, 0)
+
+
+### finding local paths
+def is_local(value):
+    '''True for strings that aren't already somewhere in S3 or on the web.'''
+    return isinstance(value, str) and value and not value.startswith(('s3://', 'http://', 'https://'))
+
+def _resolve(value, base):
+    path = os.path.normpath(os.path.join(base, os.path.expanduser(value)))
+    if not os.path.exists(path):
+        raise Exception('{} points at {}, which does not exist.'.format(value, path))
+    return os.path.realpath(path)
+
+# template sha256: [[resource, property, path, kind, form]], for templates scanned during this run
+_scanned = {}
+_lock = threading.Lock()
+
+def _load(body):
+    try:
+        return json.loads(body.decode('utf-8'))
+    except ValueError:
+        return yaml.load(body.decode('utf-8'), Loader=TemplateLoader)
+
+def scan(path):
+    '''
+    Every local path a template points at, as [resource, property, real path, kind,
+    form] lists. Templates that can't have any (ie: no packageable resource types
+    in them at all) aren't even parsed. Cached by template hash.
+    '''
+    with open(path, 'rb') as f:
+        body = f.read()
+    key = hashlib.sha256(body).hexdigest()
+    with _lock:
+        if key in _scanned:
+            return _scanned[key]
+
+    found = []
+    if any(t.encode('utf-8') in body for t in PACKAGEABLE):
+        template = _load(body)
+        template = template if isinstance(template, dict) else {}
+        base = os.path.dirname(os.path.abspath(path))
+        for name, r in sorted((template.get('Resources') or {}).items()):
+            if not isinstance(r, dict):
+                continue
+            for prop, kind, form in PACKAGEABLE.get(r.get('Type'), []):
+                value = (r.get('Properties') or {}).get(prop)
+                if is_local(value):
+                    found.append([name, prop, _resolve(value, base), kind, form])
+
+    with _lock:
+        _scanned[key] = found
+    return found
+
+def sources(path):
+    '''Real paths of everything a template would package, nested templates' artifacts included.'''
+    r = set()
+    for _, _, p, kind, _ in scan(path):
+        if p not in r:
+            r.add(p)
+            if kind == TEMPLATE:
+                r.update(sources(p))
+    return r
+
+
+### building
+def _files(path):
+    '''(name in the zip, real path) for everything under path, in a fixed order.'''
+    if os.path.isfile(path):
+        return [(os.path.basename(path), path)]
+    r = []
+    for root, dirs, files in os.walk(path, followlinks=True):
+        dirs.sort()
+        for f in sorted(files):
+            full = os.path.join(root, f)
+            r.append((os.path.relpath(full, path).replace(os.sep, '/'), full))
+    return r
+
+def needs_zip(path, kind):
+    return kind == ZIP and not (os.path.isfile(path) and path.lower().endswith(('.zip', '.jar')))
+
+def build_zip(path, dest):
+    '''
+    Zips a directory (or a single file) into dest. Entries are sorted and stamped
+    with ZIP_EPOCH, and only the executable bit of each file's mode is kept, so
+    the same files always make a byte-for-byte identical zip.
+    '''
+    with zipfile.ZipFile(dest, 'w', zipfile.ZIP_DEFLATED) as z:
+        for name, full in _files(path):
+            info = zipfile.ZipInfo(name, date_time=ZIP_EPOCH)
+            info.compress_type = zipfile.ZIP_DEFLATED
+            mode = 0o755 if os.stat(full).st_mode & stat.S_IXUSR else 0o644
+            info.external_attr = (stat.S_IFREG | mode) << 16
+            with open(full, 'rb') as src, z.open(info, 'w') as out:
+                shutil.copyfileobj(src, out, 1024 * 1024)
+
+def _sha256_file(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def signature(path, kind):
+    '''
+    Cheap stand-in for an artifact's contents: the name, size, mtime and exec bit of
+    every file in it. Unchanged artifacts keep the same signature without being read.
+    '''
+    parts = [kind, needs_zip(path, kind)]
+    for name, full in _files(path):
+        st = os.stat(full)
+        parts.append([name, st.st_size, st.st_mtime_ns, bool(st.st_mode & stat.S_IXUSR)])
+    return localcache.sha256(json.dumps(parts))
+
+
+### uploading
+def forget():
+    '''Forgets scanned templates and which artifacts are known to be in S3.'''
+    with _lock:
+        _scanned.clear()
+    uploads.forget()
+
+def artifact_key(sha, path, zipped):
+    '''S3 key for an artifact, named after its contents so unchanged ones are never uploaded twice.'''
+    name = os.path.basename(path.rstrip(os.sep)) + ('.zip' if zipped else '')
+    return 'cfnbot/artifacts/{}/{}'.format(sha, name)
+
+def upload_artifact(path, kind, bucket, profile=None, region=None):
+    '''
+    Gets a file or directory into S3 under a content-hash key and returns the key.
+    The hash of an artifact is remembered against its signature in the local cache,
+    so an unchanged artifact which is already in S3 costs a head_object and nothing else.
+    '''
+    s3 = client('s3', profile, region)
+    zipped = needs_zip(path, kind)
+    sig = signature(path, kind)
+    known = localcache.read_json('artifacts', '{}.json'.format(sig))
+    if known and uploads.exists(s3, bucket, artifact_key(known['sha256'], path, zipped)):
+        logger.debug('{} is unchanged and already in s3://{}.'.format(path, bucket))
+        return artifact_key(known['sha256'], path, zipped)
+
+    tmp = None
+    try:
+        if zipped:
+            fd, tmp = tempfile.mkstemp(suffix='.zip')
+            os.close(fd)
+            build_zip(path, tmp)
+            filename = tmp
+        else:
+            filename = path
+        sha = _sha256_file(filename)
+        key = artifact_key(sha, path, zipped)
+        if uploads.ensure(s3, bucket, key, lambda: s3.upload_file(filename, bucket, key)):
+            logger.info('Uploaded {} to s3://{}/{}.'.format(path, bucket, key))
+        localcache.write_json({'sha256': sha}, 'artifacts', '{}.json'.format(sig))
+        return key
+    finally:
+        if tmp and os.path.exists(tmp):
+            os.remove(tmp)
+
+def _location(form, bucket, key, region):
+    if form == S3_BUCKET_KEY:
+        return {'S3Bucket': bucket, 'S3Key': key}
+    if form == BUCKET_KEY:
+        return {'Bucket': bucket, 'Key': key}
+    if form == S3_URI:
+        return 's3://{}/{}'.format(bucket, key)
+    return 'https://{}.s3.{}.amazonaws.com/{}'.format(bucket, region, key)
+
+
+### packaging
+_tmpdir = None
+
+def _workdir():
+    '''Where packaged templates are written: the local cache, or somewhere temporary without one.'''
+    if localcache.settings['enabled']:
+        return localcache.path('packaged')
+    global _tmpdir
+    with _lock:
+        if not _tmpdir:
+            _tmpdir = tempfile.mkdtemp(prefix='cfnbot-packaged-')
+        return _tmpdir
+
+class Packager:
+    '''
+    Packages the templates of one bucket, profile and region. Every artifact is
+    uploaded first, up to max_parallel at once, then each template is written out
+    again with its local paths swapped for S3 locations. Templates without any
+    local paths are left exactly as they are.
+    '''
+    def __init__(self, bucket, profile=None, region=None, max_parallel=1):
+        self.bucket = bucket
+        self.profile = profile
+        self.region = region
+        self.max_parallel = max(1, max_parallel)
+        self.keys = {}          # (real path, kind): S3 key
+        self.packaged = {}      # template path: packaged template path
+        self._lock = threading.Lock()
+
+    def artifacts(self, paths):
+        '''(real path, kind) for every artifact the templates need, nested templates' too.'''
+        found = set()
+        todo = list(paths)
+        seen = set()
+        while todo:
+            p = todo.pop()
+            if p in seen:
+                continue
+            seen.add(p)
+            for _, _, path, kind, _ in scan(p):
+                if kind == TEMPLATE:
+                    todo.append(path)
+                else:
+                    found.add((path, kind))
+        return found
+
+    def upload(self, artifacts):
+        if not artifacts:
+            return
+        if not self.bucket:
+            raise Exception('{} need packaging, but a TemplateBucket was not specified.'.format(
+                ', '.join(sorted(p for p, _ in artifacts))))
+        with ThreadPoolExecutor(max_workers=self.max_parallel) as pool:
+            futures = {pool.submit(upload_artifact, p, k, self.bucket, self.profile, self.region): (p, k) for p, k in artifacts}
+            for f, a in futures.items():
+                self.keys[a] = f.result()
+
+    def template(self, path):
+        '''Path to the packaged copy of a template, or None if it has no local paths.'''
+        path = os.path.realpath(path)
+        with self._lock:
+            if path in self.packaged:
+                return self.packaged[path]
+        found = scan(path)
+        if not found:
+            return None
+
+        with open(path, 'rb') as f:
+            template = _load(f.read())
+        s3 = client('s3', self.profile, self.region)
+        region = self.region or s3.meta.region_name
+        for name, prop, p, kind, form in found:
+            if kind == TEMPLATE:
+                key = self.upload_template(self.template(p) or p, p)
+            else:
+                key = self.keys[(p, kind)]
+            template['Resources'][name]['Properties'][prop] = _location(form, self.bucket, key, region)
+
+        body = json.dumps(template, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+        out = os.path.join(_workdir(), hashlib.sha256(body).hexdigest(), os.path.basename(path))
+        if not os.path.exists(out):
+            os.makedirs(os.path.dirname(out), exist_ok=True)
+            with open(out, 'wb') as f:
+                f.write(body)
+        logger.debug('Packaged {} into {}.'.format(path, out))
+        with self._lock:
+            self.packaged[path] = out
+        return out
+
+    def upload_template(self, path, original):
+        '''Puts a (packaged) nested template in S3 under a content-hash key. Returns the key.'''
+        s3 = client('s3', self.profile, self.region)
+        key = uploads.template_key(_sha256_file(path), original)
+        uploads.ensure(s3, self.bucket, key, lambda: s3.upload_file(path, self.bucket, key))
+        return key
+
+    def setting(self, value, base):
+        '''S3 URL for a stack setting which points at a local file.'''
+        p = _resolve(value, base)
+        key = upload_artifact(p, FILE, self.bucket, self.profile, self.region)
+        region = self.region or client('s3', self.profile, self.region).meta.region_name
+        return _location(HTTPS_URL, self.bucket, key, region)
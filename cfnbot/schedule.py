@@ -0,0 +1,146 @@
+import datetime
+import logging
+import threading
+import time
+from . import localcache
+from .graph import critical_path, simulate
+
+logger = logging.getLogger()
+
+settings = {
+    # seconds to guess for a create, update or delete nothing is known about yet.
+    'default_duration': 60,
+    # how much the newest run counts towards a stack's duration history.
+    'smoothing': 0.5,
+}
+
+CREATE = 'CREATE'
+UPDATE = 'UPDATE'
+DELETE = 'DELETE'
+REPLACE = 'REPLACE'             # a ROLLBACK_COMPLETE stack, deleted and created again
+MAYBE_UPDATE = 'MAYBE_UPDATE'   # an update that can't be ruled out up front, eg: with --force
+SKIP = 'SKIP'                   # expected to do something, and turned out to have nothing to do
+LAST = 'last'                   # what a stack ended up doing last time, kept with its durations
+
+_history_lock = threading.Lock()
+
+
+def load_history():
+    '''{stack name: {operation: seconds, 'last': operation}} from earlier runs.'''
+    return localcache.read_json('durations.json') or {}
+
+def save_history(durations):
+    '''
+    Folds {stack name: {operation: seconds}} from this run into the history, as a
+    moving average so one slow run doesn't throw every later estimate out.
+    '''
+    if not durations:
+        return
+    with _history_lock:
+        history = load_history()
+        a = settings['smoothing']
+        for name, ops in durations.items():
+            h = history.setdefault(name, {})
+            for op, secs in ops.items():
+                if op == LAST:
+                    h[op] = secs
+                    continue
+                h[op] = round(secs if op not in h else a * secs + (1 - a) * h[op], 2)
+        localcache.write_json(history, 'durations.json')
+
+def estimate(history, name, operation):
+    '''
+    Seconds a stack should take: its own history for the operation, else the median
+    of every stack's, else the default. No operation means nothing to do, ie: 0. An
+    update that might not happen goes by whether it did last time, and a replacement
+    is a delete and a create unless the stack has been replaced before.
+    '''
+    if not operation:
+        return 0.0
+    known = history.get(name, {})
+    if operation == MAYBE_UPDATE:
+        if known.get(LAST) == SKIP:
+            return known.get(SKIP, 0.0)
+        operation = UPDATE
+    if operation == REPLACE and REPLACE not in known:
+        return estimate(history, name, DELETE) + estimate(history, name, CREATE)
+    if operation in known:
+        return known[operation]
+    others = sorted(h[operation] for h in history.values() if operation in h)
+    if others:
+        return others[len(others) // 2]
+    return float(settings['default_duration'])
+
+def is_known(history, name, operation):
+    '''True if earlier runs say something about how long the operation takes this stack.'''
+    known = history.get(name, {})
+    if operation == MAYBE_UPDATE:
+        return LAST in known
+    if operation == REPLACE:
+        return REPLACE in known or (DELETE in known and CREATE in known)
+    return operation in known
+
+def clock(seconds):
+    '''Wall clock time seconds from now.'''
+    return (datetime.datetime.now() + datetime.timedelta(seconds=seconds)).strftime('%H:%M:%S')
+
+
+class Schedule:
+    '''
+    Running order and ETA for a stackset. Each stack is guessed to take as long as
+    it did last time for the operation it's expected to need. Stacks with the most
+    waiting on them, time-wise, are started first. As stacks finish, the rest of the
+    run is simulated again to keep the ETA honest, and the real durations go into
+    the history for next time, along with stacks that turned out to have nothing to do.
+    '''
+    def __init__(self, stacks, deps, operation, max_parallel=1):
+        history = load_history()
+        self.stacks = list(stacks)
+        self.deps = deps
+        self.max_parallel = max(1, max_parallel)
+        self.ops = {s: operation(s) for s in self.stacks}
+        self.estimates = {s: estimate(history, s.name, self.ops[s]) for s in self.stacks}
+        # stacks with work to do that earlier runs say something about.
+        self.known = len([s for s in self.stacks if self.ops[s] and is_known(history, s.name, self.ops[s])])
+        self.priority = critical_path(self.stacks, deps, self.estimates)
+        self.started = {}
+        self.finished = set()
+        self.durations = {}
+        self._lock = threading.Lock()
+
+    def eta(self):
+        '''Seconds until the run should be done.'''
+        now = time.time()
+        with self._lock:
+            running = {s: max(0.0, self.estimates[s] - (now - t)) for s, t in self.started.items() if s not in self.finished}
+            todo = [s for s in self.stacks if s not in self.started]
+        return simulate(todo, self.deps, self.estimates, self.max_parallel, self.priority, running)
+
+    def describe(self, eta=None):
+        eta = self.eta() if eta is None else eta
+        return 'about {:.0f}s to go, done around {}'.format(eta, clock(eta))
+
+    def start(self, s):
+        with self._lock:
+            self.started[s] = time.time()
+
+    def finish(self, s, operation=None, ok=True):
+        '''
+        Marks a stack done, keeping successful operations for the history, and SKIP
+        for stacks that were expected to do something and didn't. Returns (seconds it
+        took, stacks finished so far, stacks with work still to do).
+        '''
+        with self._lock:
+            took = time.time() - self.started.get(s, time.time())
+            self.finished.add(s)
+            self.estimates[s] = took
+            outcome = operation or (SKIP if self.ops.get(s) else None)
+            if ok and outcome:
+                d = self.durations.setdefault(s.name, {})
+                d[outcome] = took
+                d[LAST] = outcome
+            left = len([x for x in self.stacks if x not in self.finished and self.estimates[x]])
+            return took, len(self.finished), left
+
+    def save(self):
+        save_history(self.durations)
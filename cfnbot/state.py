@@ -0,0 +1,193 @@
+import datetime
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from . import localcache
+
+logger = logging.getLogger()
+
+settings = {
+    # keep what's known about stacks in a SQLite file between runs.
+    'enabled': False,
+    'path': localcache.path('state.sqlite'),
+    # past this many changed stacks, one describe_stacks sweep beats describing them one by one.
+    'max_describes': 10,
+}
+
+SCHEMA_VERSION = 1
+# everything but DELETE_COMPLETE, which list_stacks would otherwise keep returning for 90 days.
+LIVE_STATUSES = [
+    'CREATE_IN_PROGRESS', 'CREATE_FAILED', 'CREATE_COMPLETE',
+    'ROLLBACK_IN_PROGRESS', 'ROLLBACK_FAILED', 'ROLLBACK_COMPLETE',
+    'DELETE_IN_PROGRESS', 'DELETE_FAILED',
+    'UPDATE_IN_PROGRESS', 'UPDATE_COMPLETE_CLEANUP_IN_PROGRESS', 'UPDATE_COMPLETE', 'UPDATE_FAILED',
+    'UPDATE_ROLLBACK_IN_PROGRESS', 'UPDATE_ROLLBACK_FAILED', 'UPDATE_ROLLBACK_COMPLETE_CLEANUP_IN_PROGRESS',
+    'UPDATE_ROLLBACK_COMPLETE', 'REVIEW_IN_PROGRESS',
+    'IMPORT_IN_PROGRESS', 'IMPORT_COMPLETE', 'IMPORT_ROLLBACK_IN_PROGRESS', 'IMPORT_ROLLBACK_FAILED', 'IMPORT_ROLLBACK_COMPLETE',
+]
+# describe_stacks fields that come back as datetimes, and go into the store as ISO strings.
+TIME_FIELDS = ['CreationTime', 'LastUpdatedTime', 'DeletionTime']
+
+
+def _iso(t):
+    return t.isoformat() if isinstance(t, datetime.datetime) else t
+
+def encode(description):
+    d = dict(description)
+    for k in TIME_FIELDS:
+        if k in d:
+            d[k] = _iso(d[k])
+    drift = d.get('DriftInformation')
+    if drift and 'LastCheckTimestamp' in drift:
+        d['DriftInformation'] = dict(drift, LastCheckTimestamp=_iso(drift['LastCheckTimestamp']))
+    return json.dumps(d, sort_keys=True, default=str)
+
+def decode(text):
+    d = json.loads(text)
+    for k in TIME_FIELDS:
+        if d.get(k):
+            d[k] = datetime.datetime.fromisoformat(d[k])
+    drift = d.get('DriftInformation')
+    if drift and drift.get('LastCheckTimestamp'):
+        drift['LastCheckTimestamp'] = datetime.datetime.fromisoformat(drift['LastCheckTimestamp'])
+    return d
+
+def version(summary):
+    '''What list_stacks says about a stack that moves whenever the stack does.'''
+    return [summary.get('StackId'), summary.get('StackStatus'),
+            _iso(summary.get('LastUpdatedTime') or summary.get('CreationTime'))]
+
+
+class StateStore:
+    '''
+    The last describe_stacks entry seen for every stack, per profile and region, in
+    a SQLite file, along with its status, outputs, last update and fingerprint so
+    the file makes sense on its own. Safe to share between threads and processes.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._ready = False
+
+    def _connect(self):
+        if not self._ready:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        db = sqlite3.connect(self.path, timeout=30)
+        if not self._ready:
+            if db.execute('PRAGMA user_version').fetchone()[0] != SCHEMA_VERSION:
+                db.executescript('''
+                    DROP TABLE IF EXISTS stacks;
+                    CREATE TABLE stacks (
+                        profile TEXT NOT NULL,
+                        region TEXT NOT NULL,
+                        name TEXT NOT NULL,
+                        stack_id TEXT,
+                        status TEXT,
+                        updated TEXT,
+                        outputs TEXT,
+                        fingerprint TEXT,
+                        description TEXT,
+                        seen_at REAL,
+                        PRIMARY KEY (profile, region, name)
+                    );
+                    PRAGMA user_version = {};
+                '''.format(SCHEMA_VERSION))
+            self._ready = True
+        return db
+
+    def _run(self, fn):
+        with self._lock:
+            db = self._connect()
+            try:
+                with db:
+                    return fn(db)
+            finally:
+                db.close()
+
+    def load(self, profile, region):
+        '''{stack name: (version, description)} for everything stored for a profile/region.'''
+        rows = self._run(lambda db: db.execute(
+            'SELECT name, stack_id, status, updated, description FROM stacks WHERE profile = ? AND region = ?',
+            (profile or 'default', region or '')).fetchall())
+        return {n: ([i, s, u], decode(d)) for n, i, s, u, d in rows}
+
+    def _row(self, profile, region, description):
+        from .cfnbot import deployed_fingerprint
+        from .outputs import outputs_of
+        d = description
+        return (profile or 'default', region or '', d['StackName'], d.get('StackId'), d.get('StackStatus'),
+                version(d)[2], json.dumps(outputs_of(d), sort_keys=True), deployed_fingerprint(d), encode(d), time.time())
+
+    def save(self, profile, region, descriptions, replace=False):
+        '''Stores descriptions. With replace, anything else stored for the profile/region goes.'''
+        rows = [self._row(profile, region, d) for d in descriptions]
+        def _save(db):
+            if replace:
+                db.execute('DELETE FROM stacks WHERE profile = ? AND region = ?', (profile or 'default', region or ''))
+            db.executemany('INSERT OR REPLACE INTO stacks VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+        self._run(_save)
+
+    def forget(self, profile, region, names):
+        self._run(lambda db: db.executemany(
+            'DELETE FROM stacks WHERE profile = ? AND region = ? AND name = ?',
+            [(profile or 'default', region or '', n) for n in names]))
+
+
+_store = None
+_store_lock = threading.Lock()
+
+def store():
+    '''The StateStore, if there is one.'''
+    global _store
+    if not settings['enabled']:
+        return None
+    with _store_lock:
+        if _store is None or _store.path != settings['path']:
+            _store = StateStore(settings['path'])
+        return _store
+
+def revalidate(cfn, profile, region, st):
+    '''
+    Brings what's stored for a profile/region up to date with one list_stacks sweep,
+    describing only the stacks which were created, changed or replaced since. Returns
+    {stack name: description}, or None if a full describe_stacks sweep would be
+    cheaper (eg: nothing stored yet).
+    '''
+    stored = st.load(profile, region)
+    if not stored:
+        return None
+
+    live = {}
+    for page in cfn.get_paginator('list_stacks').paginate(StackStatusFilter=LIVE_STATUSES):
+        for s in page['StackSummaries']:
+            live[s['StackName']] = s
+    stale = [n for n, s in live.items() if n not in stored or stored[n][0] != version(s)]
+    if len(stale) > settings['max_describes']:
+        logger.debug('{} stacks changed since last time, sweeping instead.'.format(len(stale)))
+        return None
+
+    found = {n: stored[n][1] for n in live if n not in stale}
+    fresh = []
+    for n in stale:
+        # by id, in case it's gone again by now.
+        try:
+            d = cfn.describe_stacks(StackName=live[n]['StackId'])['Stacks'][0]
+        except Exception as e:
+            logger.debug('Unable to describe {}: {}'.format(n, e))
+            continue
+        if d['StackStatus'] == 'DELETE_COMPLETE':
+            continue
+        found[n] = d
+        fresh.append(d)
+
+    gone = [n for n in stored if n not in live]
+    if fresh:
+        st.save(profile, region, fresh)
+    if gone:
+        st.forget(profile, region, gone)
+    logger.debug('State store: {} stacks unchanged, {} described again, {} gone.'.format(
+        len(found) - len(fresh), len(fresh), len(gone)))
+    return found
@@ -0,0 +1,144 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from .cache import stack_cache
+from .clients import client
+from .waiter import settings as waiter_settings
+
+logger = logging.getLogger()
+
+settings = {
+    'events': 3,        # recent events kept per stack
+    'idle_delay': 60,   # seconds between polls once nothing is happening
+}
+
+FAILED_HINTS = ['FAILED', 'ROLLBACK']
+
+
+def _when(t):
+    return t.strftime('%Y-%m-%d %H:%M:%S') if t else '-'
+
+
+class StackView:
+    '''What the poller last saw of one stack.'''
+    def __init__(self, stack):
+        self.stack = stack
+        self.description = None
+        self.events = []
+        self._last_event_id = None
+        self._seen = None
+
+    @property
+    def name(self):
+        return self.stack.name
+
+    @property
+    def status(self):
+        return self.description['StackStatus'] if self.description else 'NOT_DEPLOYED'
+
+    @property
+    def updated(self):
+        d = self.description or {}
+        return d.get('LastUpdatedTime') or d.get('CreationTime')
+
+    @property
+    def drift(self):
+        return (self.description or {}).get('DriftInformation', {}).get('StackDriftStatus', '-')
+
+    @property
+    def in_progress(self):
+        return self.status.endswith('_IN_PROGRESS')
+
+    @property
+    def failed(self):
+        return any(h in self.status for h in FAILED_HINTS)
+
+    def changed(self):
+        '''True if the stack looks different to last time, ie: its events are worth fetching.'''
+        seen = (self.status, self.updated)
+        changed = seen != self._seen
+        self._seen = seen
+        return changed
+
+
+class Poller:
+    '''
+    Keeps an eye on every stack in a stackset with one loop. Each tick is a single
+    paginated describe_stacks sweep per account/region, plus describe_stack_events
+    for just the stacks which changed or are still busy. Quiet stacks cost nothing
+    after the first tick.
+    '''
+    def __init__(self, stackset, events=None, max_parallel=10):
+        stackset.share_connection_settings()
+        self.stackset = stackset
+        self.views = [StackView(s) for s in stackset.stacks]
+        self.events = settings['events'] if events is None else events
+        self.max_parallel = max(1, max_parallel)
+        self.ticks = 0
+        self._delay = waiter_settings['delay']
+
+    def tick(self):
+        '''Brings every StackView up to date. Returns the views.'''
+        targets = set((v.stack.profile, v.stack.region) for v in self.views)
+        for profile, region in targets:
+            stack_cache(profile, region).sweep()
+
+        busy = []
+        for v in self.views:
+            v.description = stack_cache(v.stack.profile, v.stack.region).get(v.name)
+            if v.changed() or v.in_progress:
+                busy.append(v)
+
+        if self.events and busy:
+            busy = [v for v in busy if v.description]
+            with ThreadPoolExecutor(max_workers=self.max_parallel) as pool:
+                for f in [pool.submit(self._fetch_events, v) for v in busy]:
+                    try:
+                        f.result()
+                    except Exception as e:
+                        logger.debug('Unable to fetch events: {}'.format(e))
+        self.ticks += 1
+        return self.views
+
+    def _fetch_events(self, v):
+        r = client('cloudformation', v.stack.profile, v.stack.region).describe_stack_events(StackName=v.description['StackId'])
+        new = []
+        for e in r['StackEvents']:
+            if e['EventId'] == v._last_event_id:
+                break
+            new.append(e)
+        if new:
+            v._last_event_id = new[0]['EventId']
+            # newest first, like the console.
+            v.events = (new + v.events)[:self.events]
+
+    def interval(self):
+        '''Seconds until the next tick: short while anything is moving, backing off once it all settles.'''
+        if any(v.in_progress for v in self.views):
+            self._delay = waiter_settings['delay']
+        else:
+            self._delay = min(settings['idle_delay'], self._delay * waiter_settings['backoff'])
+        return self._delay
+
+    def settled(self):
+        return not any(v.in_progress for v in self.views)
+
+
+### output
+def render(views):
+    '''Lines for a status table, recent events under each stack.'''
+    width = max([len(v.name) for v in views] + [5]) + 2
+    lines = ['{:<{w}}{:<32}{:<22}{}'.format('STACK', 'STATUS', 'UPDATED', 'DRIFT', w=width)]
+    for v in views:
+        lines.append('{:<{w}}{:<32}{:<22}{}'.format(v.name, v.status, _when(v.updated), v.drift, w=width))
+        for e in v.events:
+            msg = '    {} {} ({}) {}'.format(_when(e['Timestamp']), e['LogicalResourceId'], e['ResourceType'], e['ResourceStatus'])
+            if e.get('ResourceStatusReason'):
+                msg = '{}: {}'.format(msg, e['ResourceStatusReason'])
+            lines.append(msg)
+
+    lines.append('{} stacks: {} in progress, {} failed or rolled back, {} not deployed.'.format(
+        len(views),
+        len([v for v in views if v.in_progress]),
+        len([v for v in views if v.failed and not v.in_progress]),
+        len([v for v in views if not v.description])))
+    return lines
@@ -0,0 +1,130 @@
+import logging
+import random
+import threading
+import time
+
+logger = logging.getLogger()
+
+# calls per second, per service per account/region. the rate drops when AWS throttles
+# us and creeps back up while calls go through.
+settings = {
+    'rate': 5.0,
+    'min_rate': 0.5,
+    'max_rate': 20.0,
+    'burst': 10,
+    'recovery': 0.05,       # calls/s added back after each successful call
+    'max_attempts': 10,     # per call, including the first
+    'base_delay': 0.5,      # seconds, backoff before the first retry
+    'max_delay': 20.0,      # seconds, backoff cap
+}
+
+THROTTLING_CODES = [
+    'Throttling',
+    'ThrottlingException',
+    'ThrottledException',
+    'RequestLimitExceeded',
+    'TooManyRequestsException',
+    'SlowDown',
+]
+
+
+class RateLimiter:
+    '''
+    Token bucket shared by every worker talking to one service in one account and
+    region. Throttling halves the rate, successful calls slowly bring it back.
+    '''
+    def __init__(self, rate=None, burst=None):
+        self.rate = rate if rate else settings['rate']
+        self.burst = burst if burst else settings['burst']
+        self.calls = 0
+        self.throttled = 0
+        self._tokens = float(self.burst)
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        '''Blocks until a call is allowed.'''
+        while True:
+            with self._lock:
+                now = time.time()
+                self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    self.calls += 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def on_throttle(self):
+        with self._lock:
+            self.throttled += 1
+            self.rate = max(settings['min_rate'], self.rate / 2)
+            logger.debug('Throttled, slowing down to {:.2f} calls/s.'.format(self.rate))
+
+    def on_success(self):
+        with self._lock:
+            self.rate = min(settings['max_rate'], self.rate + settings['recovery'])
+
+
+def backoff(attempts):
+    '''Full jitter: anywhere between nothing and the exponential backoff for this attempt.'''
+    return random.uniform(0, min(settings['max_delay'], settings['base_delay'] * 2 ** attempts))
+
+def is_throttling(response):
+    '''True if a botocore (http_response, parsed) pair is a throttling error.'''
+    if not response:
+        return False
+    return response[1].get('Error', {}).get('Code') in THROTTLING_CODES
+
+
+_limiters = {}
+_lock = threading.Lock()
+
+def limiter(service, profile=None, region=None):
+    '''The RateLimiter for a service in a profile/region, made on first use.'''
+    key = (profile, region, service)
+    with _lock:
+        if key not in _limiters:
+            _limiters[key] = RateLimiter()
+        return _limiters[key]
+
+def reset():
+    '''Drops every RateLimiter, and with them the rates they'd settled on.'''
+    with _lock:
+        _limiters.clear()
+
+def attach(client, service, profile=None, region=None):
+    '''
+    Hooks a botocore client up to the shared limiter: every attempt waits for a token,
+    and throttled calls are retried here with jittered backoff rather than failing
+    the stack.
+    '''
+    lim = limiter(service, profile, region)
+    event_name = client.meta.service_model.service_id.hyphenize()
+
+    def _before_send(**kwargs):
+        lim.acquire()
+
+    def _needs_retry(response, attempts, operation, **kwargs):
+        if not is_throttling(response):
+            if response and 'Error' not in response[1]:
+                lim.on_success()
+            return None
+        lim.on_throttle()
+        if attempts >= settings['max_attempts']:
+            logger.warning('{} was throttled {} times, giving up.'.format(operation.name, attempts))
+            return None
+        delay = backoff(attempts)
+        logger.debug('{} was throttled, retrying in {:.2f}s.'.format(operation.name, delay))
+        return delay
+
+    client.meta.events.register('before-send.{}'.format(event_name), _before_send)
+    # first, so ours is the answer botocore goes with for throttling errors.
+    client.meta.events.register_first('needs-retry.{}'.format(event_name), _needs_retry)
+    return client
+
+def stats():
+    '''{(profile, region, service): {'rate': calls/s, 'calls': n, 'throttled': n}}'''
+    with _lock:
+        return {k: {'rate': v.rate, 'calls': v.calls, 'throttled': v.throttled} for k, v in _limiters.items()}
@@ -0,0 +1,156 @@
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger()
+
+# upper bounds, in seconds, of the latency histogram buckets. the last one catches the rest.
+BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float('inf')]
+
+_lock = threading.Lock()
+_t0 = time.time()
+_recording = False
+_events = []
+_api = {}       # (service, operation): {'count', 'errors', 'total', 'max', 'buckets'}
+_phases = {}    # phase: seconds
+_stacks = {}    # stack: {phase: seconds}
+
+
+def start_recording():
+    '''Keep every span and API call for a Chrome trace, not just the totals.'''
+    global _recording
+    _recording = True
+
+def reset():
+    global _t0
+    with _lock:
+        _t0 = time.time()
+        del _events[:]
+        _api.clear()
+        _phases.clear()
+        _stacks.clear()
+
+def _record(name, cat, start, end, args):
+    if not _recording:
+        return
+    t = threading.current_thread()
+    _events.append({
+        'name': name,
+        'cat': cat,
+        'ph': 'X',
+        'ts': int((start - _t0) * 1e6),
+        'dur': int((end - start) * 1e6),
+        'pid': os.getpid(),
+        'tid': t.ident,
+        'args': dict(args, thread=t.name),
+    })
+
+
+### spans
+def _add_span(name, stack, start, end, args):
+    with _lock:
+        _phases[name] = _phases.get(name, 0) + (end - start)
+        if stack:
+            st = _stacks.setdefault(stack, {})
+            st[name] = st.get(name, 0) + (end - start)
+            args = dict(args, stack=stack)
+        _record(name, 'cfnbot', start, end, args)
+
+@contextmanager
+def span(name, stack=None, **args):
+    '''Times a block of work, optionally on behalf of a stack.'''
+    start = time.time()
+    try:
+        yield
+    finally:
+        _add_span(name, str(stack) if stack else None, start, time.time(), args)
+
+def traced(name):
+    '''Decorator for Stack methods: the whole call becomes a span for that stack.'''
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(self, *args, **kwargs):
+            start = time.time()
+            try:
+                return fn(self, *args, **kwargs)
+            finally:
+                # name as of the end of the call, deploy may have prefixed it.
+                _add_span(name, str(self.name), start, time.time(), {})
+        return wrapper
+    return decorator
+
+
+### API calls
+def _api_call(service, operation, seconds, error):
+    with _lock:
+        a = _api.setdefault((service, operation), {
+            'count': 0, 'errors': 0, 'total': 0.0, 'max': 0.0, 'buckets': [0] * len(BUCKETS)})
+        a['count'] += 1
+        a['errors'] += 1 if error else 0
+        a['total'] += seconds
+        a['max'] = max(a['max'], seconds)
+        for i, b in enumerate(BUCKETS):
+            if seconds <= b:
+                a['buckets'][i] += 1
+                break
+
+def attach(client, service):
+    '''Times every API call a botocore client makes, retries and all.'''
+    def _before_call(context, **kwargs):
+        context['cfnbot_start'] = time.time()
+
+    def _after_call(event_name, context, parsed=None, **kwargs):
+        start = context.get('cfnbot_start')
+        if start is None:
+            return
+        end = time.time()
+        operation = event_name.split('.')[-1]
+        error = parsed is None or 'Error' in parsed
+        _api_call(service, operation, end - start, error)
+        with _lock:
+            _record(operation, 'api', start, end, {'service': service, 'error': error})
+
+    # before-parameter-build rather than before-call, which stubs can answer before we see it.
+    client.meta.events.register('before-parameter-build', _before_call)
+    client.meta.events.register('after-call', _after_call)
+    client.meta.events.register('after-call-error', _after_call)
+    return client
+
+
+### reporting
+def summary():
+    '''Everything measured so far, as plain data.'''
+    with _lock:
+        return {
+            'api': {'{}.{}'.format(*k): dict(v, buckets=dict(zip([str(b) for b in BUCKETS], v['buckets'])))
+                    for k, v in _api.items()},
+            'phases': dict(_phases),
+            'stacks': {k: dict(v) for k, v in _stacks.items()},
+        }
+
+def log_summary():
+    '''Prints where the time went: API calls, phases, and the slowest stacks.'''
+    s = summary()
+    if not s['api'] and not s['phases']:
+        return
+    logger.info('{:<40} {:>6} {:>6} {:>9} {:>9}'.format('API call', 'count', 'errors', 'mean (s)', 'max (s)'))
+    for k, v in sorted(s['api'].items(), key=lambda i: -i[1]['total']):
+        logger.info('{:<40} {:>6} {:>6} {:>9.3f} {:>9.3f}'.format(k, v['count'], v['errors'], v['total'] / v['count'], v['max']))
+    logger.info('{:<40} {:>9}'.format('Phase', 'total (s)'))
+    for k, v in sorted(s['phases'].items(), key=lambda i: -i[1]):
+        logger.info('{:<40} {:>9.1f}'.format(k, v))
+    logger.info('{:<40} {}'.format('Stack', 'time per phase (s)'))
+    for k, v in sorted(s['stacks'].items(), key=lambda i: -max(i[1].values()))[:10]:
+        logger.info('{:<40} {}'.format(k, ', '.join('{} {:.1f}'.format(p, t) for p, t in sorted(v.items()))))
+
+def write_chrome_trace(path):
+    '''Dumps recorded spans in Chrome trace format (chrome://tracing, Perfetto) along with the summary.'''
+    with _lock:
+        events = list(_events)
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms', 'cfnbot': summary()}, f)
+    logger.info('Trace written to {}'.format(path))
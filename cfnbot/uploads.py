@@ -0,0 +1,48 @@
+import logging
+import os
+import threading
+import botocore.exceptions
+
+logger = logging.getLogger()
+
+# (bucket, key) pairs we've already put or seen in S3 during this run
+_uploaded = set()
+_lock = threading.Lock()
+
+
+def forget():
+    '''Forgets which objects are known to be in S3, eg: when switching accounts.'''
+    with _lock:
+        _uploaded.clear()
+
+def template_key(sha, path):
+    '''S3 key for a template, named after its contents so identical files share an object.'''
+    return 'cfnbot/templates/{}/{}'.format(sha, os.path.basename(path))
+
+def exists(s3, bucket, key):
+    '''True if an object is in S3. Only asks S3 the first time for each object.'''
+    with _lock:
+        if (bucket, key) in _uploaded:
+            return True
+    try:
+        s3.head_object(Bucket=bucket, Key=key)
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] not in ['404', 'NoSuchKey', 'NotFound']:
+            raise
+        return False
+    with _lock:
+        _uploaded.add((bucket, key))
+    return True
+
+def ensure(s3, bucket, key, put):
+    '''
+    Calls put() to get an object into S3 unless it's there already. Keys are named
+    after their contents, so one that exists never needs replacing. Returns True if
+    put() was called.
+    '''
+    if exists(s3, bucket, key):
+        return False
+    put()
+    with _lock:
+        _uploaded.add((bucket, key))
+    return True
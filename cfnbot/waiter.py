@@ -0,0 +1,200 @@
+import logging
+import time
+import uuid
+from . import events
+from .trace import span
+
+logger = logging.getLogger()
+
+# poll quickly at first, then back off for long-running operations. tweak to taste.
+settings = {
+    'delay': 2,         # seconds before the first poll
+    'max_delay': 20,    # seconds, upper bound on the gap between polls
+    'backoff': 1.5,     # the gap grows by this much each poll
+    'timeout': 3600,    # give up after this many seconds
+}
+
+# waiter name: (statuses which start the operation, success, failure)
+OPERATIONS = {
+    'stack_create_complete': (
+        ['CREATE_IN_PROGRESS'],
+        ['CREATE_COMPLETE'],
+        ['CREATE_FAILED', 'ROLLBACK_IN_PROGRESS', 'ROLLBACK_COMPLETE', 'ROLLBACK_FAILED', 'DELETE_COMPLETE', 'DELETE_FAILED'],
+    ),
+    'stack_update_complete': (
+        ['UPDATE_IN_PROGRESS'],
+        ['UPDATE_COMPLETE'],
+        ['UPDATE_FAILED', 'UPDATE_ROLLBACK_IN_PROGRESS', 'UPDATE_ROLLBACK_COMPLETE', 'UPDATE_ROLLBACK_FAILED'],
+    ),
+    'stack_delete_complete': (
+        ['DELETE_IN_PROGRESS'],
+        ['DELETE_COMPLETE'],
+        ['DELETE_FAILED'],
+    ),
+}
+
+
+class WaitResult:
+    '''
+    What a waiter saw. Truthy on success, so callers that only care about
+    True/False can keep treating it as a bool.
+    '''
+    def __init__(self, ok, status=None, resource=None, resource_type=None, reason=None):
+        self.ok = ok
+        self.status = status
+        self.resource = resource
+        self.resource_type = resource_type
+        self.reason = reason
+
+    def __bool__(self):
+        return self.ok
+    __nonzero__ = __bool__
+
+    def __repr__(self):
+        if self.ok:
+            return '<WaitResult ok {}>'.format(self.status)
+        return '<WaitResult failed {}: {} ({}) {}>'.format(self.status, self.resource, self.resource_type, self.reason)
+
+
+def new_request_token():
+    '''
+    A ClientRequestToken for one stack operation. CloudFormation stamps it on every
+    event the operation causes, which is how the waiter tells them from the last one's.
+    '''
+    return 'cfnbot-{}'.format(uuid.uuid4().hex)
+
+def _is_stack_event(e, stackname):
+    return e['ResourceType'] == 'AWS::CloudFormation::Stack' and e['LogicalResourceId'] == stackname
+
+def _does_not_exist(e):
+    try:
+        return 'does not exist' in e.response['Error']['Message']
+    except (AttributeError, KeyError):
+        return False
+
+def log_event(e):
+    msg = '{}: {} ({}) {}'.format(e['StackName'], e['LogicalResourceId'], e['ResourceType'], e['ResourceStatus'])
+    if e.get('ResourceStatusReason'):
+        msg = '{}: {}'.format(msg, e['ResourceStatusReason'])
+    if e['ResourceStatus'].endswith('_FAILED'):
+        logger.warning(msg)
+    else:
+        logger.info(msg)
+    events.emit(events.STACK_EVENT, stack=e['StackName'], stack_id=e.get('StackId'), event_id=e.get('EventId'),
+                resource=e['LogicalResourceId'], resource_type=e['ResourceType'], physical_id=e.get('PhysicalResourceId'),
+                status=e['ResourceStatus'], reason=e.get('ResourceStatusReason'), timestamp=e.get('Timestamp'))
+
+
+class EventStream:
+    '''
+    Follows describe_stack_events for one operation on one stack. Each call to
+    poll() returns only the events that haven't been seen yet, oldest first. Events
+    from before the operation started are skipped.
+
+    With a token, only a start event carrying it counts. Without one, the newest
+    start event does, which can be the previous operation's if the new one hasn't
+    shown up yet.
+    '''
+    def __init__(self, cfn, stackname, start_statuses, token=None):
+        self.cfn = cfn
+        self.stackname = stackname
+        self.start_statuses = start_statuses
+        self.token = token
+        self.started = False
+        self._last_id = None
+
+    def poll(self):
+        new = []
+        kwargs = {'StackName': self.stackname}
+        while True:
+            r = self.cfn.describe_stack_events(**kwargs)
+            for e in r['StackEvents']:
+                if e['EventId'] == self._last_id:
+                    return self._keep(new)
+                new.append(e)
+                if not self.started and self._is_start(e):
+                    self.started = True
+                    return self._keep(new)
+            # until the operation shows up, the first page is as far back as we look.
+            if 'NextToken' not in r or not self.started:
+                return self._keep(new)
+            kwargs['NextToken'] = r['NextToken']
+
+    def _is_start(self, e):
+        if not _is_stack_event(e, self.stackname) or e['ResourceStatus'] not in self.start_statuses:
+            return False
+        return self.token is None or e.get('ClientRequestToken') == self.token
+
+    def _keep(self, new):
+        '''newest first from the API, oldest first for us.'''
+        if new:
+            self._last_id = new[0]['EventId']
+        new.reverse()
+        return new
+
+
+def wait_for_stack(cfn, stackname, waiter_status, cache=None, token=None):
+    '''
+    Polls a stack's events until the operation behind waiter_status finishes,
+    logging events as they arrive. Returns a WaitResult naming the first resource
+    that failed and why, if anything did. token is the ClientRequestToken the
+    operation was started with, if it was.
+    '''
+    start_statuses, success, failure = OPERATIONS[waiter_status]
+    stream = EventStream(cfn, stackname, start_statuses, token)
+    delay = settings['delay']
+    deadline = time.time() + settings['timeout']
+    first_failure = None
+    result = None
+
+    while result is None:
+        with span('sleep', stack=stackname):
+            time.sleep(delay)
+        delay = min(settings['max_delay'], delay * settings['backoff'])
+
+        try:
+            events = stream.poll()
+        except Exception as e:
+            if not _does_not_exist(e):
+                raise
+            # the stack is gone. good news for a delete, bad news otherwise.
+            if waiter_status == 'stack_delete_complete':
+                result = WaitResult(True, 'DELETE_COMPLETE')
+            else:
+                f = first_failure or {}
+                result = WaitResult(False, 'DELETE_COMPLETE', f.get('LogicalResourceId', stackname),
+                                    f.get('ResourceType'), f.get('ResourceStatusReason', 'The stack was deleted.'))
+            break
+
+        for e in events:
+            if not stream.started:
+                continue
+            log_event(e)
+            if e['ResourceStatus'].endswith('_FAILED') and not first_failure and not _is_stack_event(e, stackname):
+                first_failure = e
+            if _is_stack_event(e, stackname):
+                if e['ResourceStatus'] in success:
+                    result = WaitResult(True, e['ResourceStatus'])
+                elif e['ResourceStatus'] in failure and e['ResourceStatus'].endswith(('_COMPLETE', '_FAILED')):
+                    f = first_failure or e
+                    result = WaitResult(False, e['ResourceStatus'], f['LogicalResourceId'],
+                                        f['ResourceType'], f.get('ResourceStatusReason'))
+            if result is not None:
+                break
+
+        if result is None and time.time() > deadline:
+            result = WaitResult(False, None, stackname, 'AWS::CloudFormation::Stack',
+                                'Timed out after {}s waiting for {}'.format(settings['timeout'], waiter_status))
+
+    if cache:
+        if waiter_status == 'stack_delete_complete' and result:
+            cache.put(stackname, None)
+        else:
+            cache.invalidate(stackname)
+
+    if result:
+        logger.debug('Success! {} obtained.'.format(waiter_status))
+    else:
+        logger.error('{} ended up {}. First failure: {} ({}): {}'.format(
+            stackname, result.status, result.resource, result.resource_type, result.reason))
+    return result
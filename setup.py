@@ -20,6 +20,7 @@ setup(
     url='https://github.com/inhumantsar/cfnbot',
     packages=['cfnbot'],
     install_requires=reqs,
+    python_requires='>=3.7',
     license=open('LICENSE').read(),
     classifiers=[
         'Development Status :: 3 - Alpha',
@@ -29,14 +30,13 @@ setup(
         'Topic :: Software Development :: Libraries',
         'Topic :: System :: Distributed Computing',
         'License :: OSI Approved :: BSD License',
-        'Programming Language :: Python :: 2',
-        'Programming Language :: Python :: 2.7',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.2',
-        'Programming Language :: Python :: 3.3',
-        'Programming Language :: Python :: 3.4',
-        'Programming Language :: Python :: 3.5',
-        'Programming Language :: Python :: 3.6',
+        'Programming Language :: Python :: 3 :: Only',
+        'Programming Language :: Python :: 3.7',
+        'Programming Language :: Python :: 3.8',
+        'Programming Language :: Python :: 3.9',
+        'Programming Language :: Python :: 3.10',
+        'Programming Language :: Python :: 3.11',
     ],
     entry_points = '''
         [console_scripts]
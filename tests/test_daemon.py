@@ -0,0 +1,87 @@
+import threading
+from cfnbot import daemon
+
+
+class FakeStack:
+    def __init__(self, name):
+        self.name = name
+        self.profile = None
+        self.region = None
+
+
+class FakeStackSet:
+    def __init__(self, *names):
+        self.name = '+'.join(names)
+        self.stacks = [FakeStack(n) for n in names]
+        self.targets = None
+        self.profile = None
+        self.region = 'us-east-1'
+
+
+def job(*names):
+    return daemon.Job('deploy', FakeStackSet(*names))
+
+def queue(*jobs):
+    q = daemon.JobQueue(workers=len(jobs))
+    for j in jobs:
+        q.submit(j)
+    return q
+
+
+### who goes next
+def test_lock_keys():
+    assert daemon.lock_keys(FakeStackSet('A', 'B')) == {(None, 'us-east-1', 'A'), (None, 'us-east-1', 'B')}
+    assert daemon.lock_keys(FakeStackSet('A', 'B'), only={'B'}) == {(None, 'us-east-1', 'B')}
+
+def test_same_stack_runs_in_arrival_order():
+    a, b = job('A'), job('A')
+    q = queue(a, b)
+    assert q.take() is a
+    assert q._next() is None
+    assert q.blockers(b) == [a.id]
+    q.release(a)
+    assert q.take() is b
+
+def test_separate_stacks_run_together():
+    a, b = job('A'), job('B')
+    q = queue(a, b)
+    assert q.take() is a
+    assert q.take() is b
+    assert a.state == b.state == daemon.RUNNING
+
+def test_no_jumping_the_queue():
+    # b is stuck behind a on A, and c wants B which b asked for first
+    a, b, c, d = job('A'), job('A', 'B'), job('B'), job('C')
+    q = queue(a, b, c, d)
+    assert q.take() is a
+    assert q.take() is d
+    assert q._next() is None
+    assert q.blockers(c) == [b.id]
+    q.release(a)
+    assert q.take() is b
+    q.release(b)
+    assert q.take() is c
+
+
+### with workers
+def test_workers(monkeypatch):
+    go = threading.Event()
+    a, b, c = job('A'), job('B'), job('A')
+    seen = {}
+    def run(self):
+        seen[self] = a.finished.is_set()
+        return go.wait(5)
+    monkeypatch.setattr(daemon.Job, 'run', run)
+
+    q = queue(a, b, c)
+    q.start()
+    try:
+        assert a.started.wait(5) and b.started.wait(5)
+        assert not c.started.is_set()
+        go.set()
+        assert all(j.finished.wait(5) for j in (a, b, c))
+        assert a.ok and b.ok and c.ok
+        # c only ran once a was done with A
+        assert seen[c]
+    finally:
+        q.stop()
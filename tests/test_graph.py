@@ -0,0 +1,113 @@
+import threading
+import time
+import pytest
+from cfnbot.graph import find_cycle, run_graph
+
+
+def recorder(fail=()):
+    '''fn for run_graph that notes the order nodes ran in and fails the ones asked.'''
+    order = []
+    lock = threading.Lock()
+    def fn(n):
+        with lock:
+            order.append(n)
+        return n not in fail
+    return fn, order
+
+
+### run_graph
+def test_deps_run_first():
+    deps = {'app': {'db', 'vpc'}, 'db': {'vpc'}}
+    fn, order = recorder()
+    r = run_graph(['app', 'db', 'vpc'], deps, fn)
+    assert order == ['vpc', 'db', 'app']
+    assert r == {'vpc': True, 'db': True, 'app': True}
+
+def test_deps_run_first_in_parallel():
+    deps = {'b': {'a'}, 'c': {'a'}, 'd': {'b', 'c'}}
+    started = {}
+    finished = {}
+    def fn(n):
+        started[n] = time.time()
+        time.sleep(0.05)
+        finished[n] = time.time()
+        return True
+    r = run_graph(['a', 'b', 'c', 'd'], deps, fn, max_parallel=4)
+    assert all(r.values()) and len(r) == 4
+    for n, ds in deps.items():
+        for d in ds:
+            assert finished[d] <= started[n]
+    # b and c don't wait on each other.
+    assert started['c'] < finished['b'] and started['b'] < finished['c']
+
+def test_list_order_without_deps():
+    fn, order = recorder()
+    run_graph(['c', 'a', 'b'], {}, fn)
+    assert order == ['c', 'a', 'b']
+
+def test_priority_goes_first():
+    fn, order = recorder()
+    run_graph(['a', 'b', 'c'], {}, fn, priority={'a': 1, 'b': 5, 'c': 3})
+    assert order == ['b', 'c', 'a']
+
+def test_failure_skips_downstream():
+    deps = {'db': {'vpc'}, 'app': {'db'}}
+    fn, order = recorder(fail={'vpc'})
+    r = run_graph(['vpc', 'db', 'app'], deps, fn)
+    assert order == ['vpc']
+    assert r == {'vpc': False}
+
+def test_failure_stops_everything_without_keep_going():
+    deps = {'app': {'db'}}
+    fn, order = recorder(fail={'db'})
+    r = run_graph(['db', 'app', 'other'], deps, fn)
+    assert r == {'db': False}
+    assert 'other' not in order
+
+def test_failure_only_skips_downstream_with_keep_going():
+    deps = {'app': {'db'}, 'web': {'app'}}
+    fn, order = recorder(fail={'db'})
+    r = run_graph(['db', 'app', 'web', 'other'], deps, fn, keep_going=True)
+    assert r == {'db': False, 'other': True}
+    assert 'app' not in order and 'web' not in order
+
+def test_keep_going_runs_the_rest_of_a_diamond():
+    deps = {'b': {'a'}, 'c': {'a'}, 'd': {'b', 'c'}}
+    fn, order = recorder(fail={'b'})
+    r = run_graph(['a', 'b', 'c', 'd'], deps, fn, keep_going=True)
+    assert r == {'a': True, 'b': False, 'c': True}
+
+def test_loops_are_refused():
+    with pytest.raises(Exception) as e:
+        run_graph(['a', 'b'], {'a': {'b'}, 'b': {'a'}}, lambda n: True)
+    assert 'Dependency loop' in str(e.value)
+
+
+### find_cycle
+def test_no_cycle():
+    assert find_cycle(['a', 'b', 'c'], {'b': {'a'}, 'c': {'a', 'b'}}) is None
+    assert find_cycle([], {}) is None
+
+def test_cycle():
+    c = find_cycle(['a', 'b', 'c'], {'a': {'b'}, 'b': {'c'}, 'c': {'a'}})
+    assert c[0] == c[-1]
+    assert set(c) == {'a', 'b', 'c'}
+
+def test_self_cycle():
+    assert find_cycle(['a'], {'a': {'a'}}) == ['a', 'a']
+
+def test_cycle_off_to_the_side():
+    c = find_cycle(['a', 'b', 'c', 'd'], {'b': {'a'}, 'c': {'d'}, 'd': {'c'}})
+    assert c[0] == c[-1]
+    assert set(c) == {'c', 'd'}
+
+def test_exceptions_are_failures():
+    deps = {'app': {'db'}}
+    def fn(n):
+        if n == 'db':
+            raise Exception('Unable to find an output named "Nope"')
+        return True
+    r = run_graph(['db', 'app', 'other'], deps, fn, max_parallel=3, keep_going=True)
+    assert r == {'db': False, 'other': True}
+    r = run_graph(['db', 'app'], deps, fn, max_parallel=3)
+    assert r == {'db': False}
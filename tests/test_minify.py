@@ -0,0 +1,67 @@
+import json
+import pytest
+from cfnbot.minify import minify
+
+
+def load(text):
+    '''A YAML template as minify would send it, back as a dict.'''
+    return json.loads(minify(text.encode('utf-8')).decode('utf-8'))
+
+
+### short-form intrinsics
+def test_ref():
+    assert load('A: !Ref Bucket') == {'A': {'Ref': 'Bucket'}}
+
+def test_sub():
+    assert load("A: !Sub '${AWS::StackName}-logs'") == {'A': {'Fn::Sub': '${AWS::StackName}-logs'}}
+
+def test_sub_with_variables():
+    assert load("A: !Sub ['${Name}-logs', {Name: !Ref Prefix}]") == \
+        {'A': {'Fn::Sub': ['${Name}-logs', {'Name': {'Ref': 'Prefix'}}]}}
+
+def test_getatt_dotted():
+    assert load('A: !GetAtt Bucket.Arn') == {'A': {'Fn::GetAtt': ['Bucket', 'Arn']}}
+
+def test_getatt_nested_attribute():
+    assert load('A: !GetAtt Db.Endpoint.Address') == {'A': {'Fn::GetAtt': ['Db', 'Endpoint.Address']}}
+
+def test_getatt_list():
+    assert load('A: !GetAtt [Bucket, Arn]') == {'A': {'Fn::GetAtt': ['Bucket', 'Arn']}}
+
+def test_nested_intrinsics():
+    assert load('A: !If [IsProd, !Ref Big, !Ref AWS::NoValue]') == \
+        {'A': {'Fn::If': ['IsProd', {'Ref': 'Big'}, {'Ref': 'AWS::NoValue'}]}}
+
+def test_condition():
+    assert load('A: !Condition IsProd') == {'A': {'Condition': 'IsProd'}}
+
+
+### scalars
+@pytest.mark.parametrize('text, value', [
+    ("'123'", '123'),           # quoted numbers stay strings
+    ("'1.5'", '1.5'),
+    ("'true'", 'true'),         # and so do quoted booleans
+    ("'no'", 'no'),
+    ('1.10', '1.10'),           # numbers that would lose something stay as written
+    ('0755', '0755'),
+    ('1e3', '1e3'),
+    ('42', 42),                 # anything else is a number
+    ('1.5', 1.5),
+    ('true', True),
+    ('false', False),
+    ('2020-01-01', '2020-01-01'),   # dates are strings in CloudFormation
+])
+def test_scalars(text, value):
+    assert load('A: {}'.format(text)) == {'A': value}
+
+def test_json_goes_through_as_is():
+    body = {'Resources': {'B': {'Type': 'AWS::S3::Bucket', 'Properties': {'Tags': [{'Key': 'n', 'Value': '1.10'}]}}}}
+    assert json.loads(minify(json.dumps(body, indent=4).encode('utf-8'))) == body
+
+def test_minified_is_smaller():
+    body = b'# a comment\nResources:\n    Bucket:\n        Type: AWS::S3::Bucket\n'
+    assert len(minify(body)) < len(body)
+
+def test_broken_templates_barf():
+    with pytest.raises(Exception):
+        minify(b'A: [unclosed')
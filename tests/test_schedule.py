@@ -0,0 +1,76 @@
+import pytest
+from cfnbot import schedule
+from cfnbot.schedule import CREATE, DELETE, LAST, MAYBE_UPDATE, REPLACE, SKIP, UPDATE, Schedule, estimate, is_known
+
+
+@pytest.fixture(autouse=True)
+def no_history(monkeypatch):
+    monkeypatch.setattr(schedule, 'load_history', lambda: {})
+
+
+### estimates
+def test_nothing_to_do():
+    assert estimate({'a': {UPDATE: 30}}, 'a', None) == 0.0
+
+def test_own_history_then_median_then_default():
+    history = {'a': {UPDATE: 30}, 'b': {UPDATE: 10}, 'c': {UPDATE: 20}}
+    assert estimate(history, 'a', UPDATE) == 30
+    assert estimate(history, 'd', UPDATE) == 20
+    assert estimate(history, 'd', CREATE) == schedule.settings['default_duration']
+
+def test_maybe_update_goes_by_last_time():
+    assert estimate({'a': {UPDATE: 30, SKIP: 0.1, LAST: SKIP}}, 'a', MAYBE_UPDATE) == 0.1
+    assert estimate({'a': {UPDATE: 30, SKIP: 0.1, LAST: UPDATE}}, 'a', MAYBE_UPDATE) == 30
+    assert estimate({}, 'a', MAYBE_UPDATE) == schedule.settings['default_duration']
+
+def test_replace_is_a_delete_and_a_create():
+    assert estimate({'a': {CREATE: 40, DELETE: 15}}, 'a', REPLACE) == 55
+    assert estimate({'a': {CREATE: 40, DELETE: 15, REPLACE: 50}}, 'a', REPLACE) == 50
+
+def test_is_known():
+    history = {'a': {CREATE: 40, DELETE: 15, LAST: CREATE}, 'b': {CREATE: 40}}
+    assert is_known(history, 'a', REPLACE) and not is_known(history, 'b', REPLACE)
+    assert is_known(history, 'a', MAYBE_UPDATE) and not is_known(history, 'b', MAYBE_UPDATE)
+    assert not is_known(history, 'a', UPDATE)
+
+
+### recording
+class S:
+    def __init__(self, name):
+        self.name = name
+
+def test_skips_are_recorded():
+    a, b, c = S('a'), S('b'), S('c')
+    ops = {a: UPDATE, b: MAYBE_UPDATE, c: None}
+    sched = Schedule([a, b, c], {}, lambda s: ops[s])
+    for s in [a, b, c]:
+        sched.start(s)
+    sched.finish(a, UPDATE)
+    sched.finish(b, None)
+    sched.finish(c, None)
+    assert set(sched.durations) == {'a', 'b'}
+    assert sched.durations['a'][LAST] == UPDATE
+    assert sched.durations['b'][LAST] == SKIP and SKIP in sched.durations['b']
+
+def test_failures_are_not_recorded():
+    a = S('a')
+    sched = Schedule([a], {}, lambda s: UPDATE)
+    sched.start(a)
+    sched.finish(a, UPDATE, ok=False)
+    assert sched.durations == {}
+
+def test_history_keeps_the_last_outcome(monkeypatch):
+    saved = {}
+    monkeypatch.setattr(schedule, 'load_history', lambda: {'a': {UPDATE: 40.0, LAST: UPDATE}})
+    monkeypatch.setattr(schedule.localcache, 'write_json', lambda data, *parts: saved.update(data))
+    schedule.save_history({'a': {SKIP: 0.2, LAST: SKIP}})
+    assert saved == {'a': {UPDATE: 40.0, SKIP: 0.2, LAST: SKIP}}
+
+def test_noop_chain_eta(monkeypatch):
+    '''A chain that turned out to have nothing to do last time shouldn't look like minutes of work.'''
+    stacks = [S('c{}'.format(i)) for i in range(5)]
+    deps = {stacks[i]: {stacks[i - 1]} for i in range(1, 5)}
+    history = {s.name: {UPDATE: 60.0, SKIP: 0.01, LAST: SKIP} for s in stacks}
+    monkeypatch.setattr(schedule, 'load_history', lambda: history)
+    sched = Schedule(stacks, deps, lambda s: MAYBE_UPDATE)
+    assert sched.eta() < 1
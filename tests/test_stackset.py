@@ -0,0 +1,70 @@
+from cfnbot import cfnbot
+from cfnbot.cfnbot import Stack, StackSet
+
+
+def stackset(tmp_path):
+    t = tmp_path / 'template.yml'
+    t.write_text('Resources: {}\n')
+    return StackSet(name='Default', profile='main', region='us-east-1', template_bucket='bucket', stacks=[
+        Stack('Here', str(t)),
+        Stack('There', str(t), profile='other', region='eu-west-1', template_bucket='other-bucket'),
+    ])
+
+
+### connection settings
+def test_uploads_use_each_stacks_account(tmp_path, monkeypatch):
+    calls = []
+    monkeypatch.setattr(cfnbot, 'is_over_50kb', lambda path: True)
+    monkeypatch.setattr(cfnbot, 'upload_template', lambda path, bucket, profile, region: calls.append((bucket, profile, region)))
+    ss = stackset(tmp_path)
+    ss.share_connection_settings()
+    assert ss.upload_templates()
+    assert sorted(calls) == [('bucket', 'main', 'us-east-1'), ('other-bucket', 'other', 'eu-west-1')]
+
+def test_validation_uses_the_stacks_account(tmp_path, monkeypatch):
+    calls = []
+    def declared_parameters(path, bucket, profile, region):
+        calls.append((bucket, profile, region))
+        return {}
+    monkeypatch.setattr(cfnbot, 'declared_parameters', declared_parameters)
+    ss = stackset(tmp_path)
+    ss.stacks = ss.stacks[1:]
+    ss.share_connection_settings()
+    assert ss.validate_templates()
+    assert calls == [('other-bucket', 'other', 'eu-west-1')]
+
+
+### targets
+def test_for_target_after_the_output_index_is_built(tmp_path):
+    ss = stackset(tmp_path)
+    ss.stacks[1].parameters = {'HereBucket': 'cfnbotOutputs.Here.Bucket'}
+    # --changed-since builds the index before fanning out.
+    assert ss.downstream(set(ss.stacks[:1])) == set(ss.stacks)
+    assert ss._index is not None
+
+    t = ss.for_target('prod', 'ap-southeast-2')
+    assert t._index is None
+    assert [(s.name, s.profile, s.region) for s in t.stacks] == [('Here', 'prod', 'ap-southeast-2'), ('There', 'prod', 'ap-southeast-2')]
+    assert t.dependencies() == {t.stacks[0]: set(), t.stacks[1]: {t.stacks[0]}}
+    assert t.output_index is not ss.output_index
+    # the original is left alone.
+    assert ss.stacks[0].profile is None and ss.stacks[1].profile == 'other'
+
+
+### outputs
+def test_outputs_are_resolved_again(tmp_path):
+    ss = stackset(tmp_path)
+    there = ss.stacks[1]
+    there.parameters = {'HereBucket': 'cfnbotOutputs.Here.Bucket'}
+    ss.known_outputs['Here'] = {'Bucket': 'old'}
+    # eg: while working out what a deploy will do, before Here is deployed
+    there.resolve_outputs(ss)
+    assert there.parameters == {'HereBucket': 'old'}
+    before = there.fingerprint
+
+    # Here is deployed again and its output changes.
+    ss.known_outputs['Here'] = {'Bucket': 'new'}
+    there.resolve_outputs(ss)
+    assert there.parameters == {'HereBucket': 'new'}
+    assert there.fingerprint != before
+    assert there.output_refs == {'HereBucket': 'cfnbotOutputs.Here.Bucket'}
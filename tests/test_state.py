@@ -0,0 +1,94 @@
+import datetime
+import pytest
+from cfnbot import state
+
+
+def at(minute):
+    return datetime.datetime(2024, 1, 1, 12, minute, tzinfo=datetime.timezone.utc)
+
+def stack(name, minute=0, status='CREATE_COMPLETE', outputs=None):
+    return {'StackName': name, 'StackId': 'id-{}'.format(name), 'StackStatus': status,
+            'CreationTime': at(0), 'LastUpdatedTime': at(minute), 'Tags': [],
+            'Outputs': [{'OutputKey': k, 'OutputValue': v} for k, v in (outputs or {}).items()]}
+
+
+class FakeCFN:
+    '''list_stacks and describe_stacks over a dict of descriptions, counting describes.'''
+    def __init__(self, *stacks):
+        self.stacks = {s['StackName']: s for s in stacks}
+        self.described = []
+
+    def get_paginator(self, name):
+        assert name == 'list_stacks'
+        return self
+
+    def paginate(self, StackStatusFilter):
+        summaries = [{k: s[k] for k in ['StackName', 'StackId', 'StackStatus', 'CreationTime', 'LastUpdatedTime']}
+                     for s in self.stacks.values() if s['StackStatus'] in StackStatusFilter]
+        # two pages, to be sure they're all read
+        return [{'StackSummaries': summaries[:1]}, {'StackSummaries': summaries[1:]}]
+
+    def describe_stacks(self, StackName):
+        self.described.append(StackName)
+        for s in self.stacks.values():
+            if s['StackId'] == StackName:
+                return {'Stacks': [s]}
+        raise Exception('Stack with id {} does not exist'.format(StackName))
+
+
+@pytest.fixture
+def st(tmp_path):
+    return state.StateStore(str(tmp_path / 'state.sqlite'))
+
+
+### the store
+def test_round_trip(st):
+    st.save('default', 'us-east-1', [stack('A', outputs={'Out': 'x'})])
+    (v, d), = st.load(None, 'us-east-1').values()
+    assert d == stack('A', outputs={'Out': 'x'})
+    assert v == ['id-A', 'CREATE_COMPLETE', at(0).isoformat()]
+    assert st.load('other', 'us-east-1') == {}
+
+def test_replace_and_forget(st):
+    st.save(None, 'r', [stack('A'), stack('B')])
+    st.forget(None, 'r', ['A'])
+    assert list(st.load(None, 'r')) == ['B']
+    st.save(None, 'r', [stack('C')], replace=True)
+    assert list(st.load(None, 'r')) == ['C']
+
+
+### revalidate
+def test_nothing_stored_means_sweep(st):
+    assert state.revalidate(FakeCFN(stack('A')), None, 'r', st) is None
+
+def test_unchanged_stacks_come_from_the_store(st):
+    cfn = FakeCFN(stack('A'), stack('B'))
+    st.save(None, 'r', cfn.stacks.values())
+    found = state.revalidate(cfn, None, 'r', st)
+    assert found == cfn.stacks
+    assert cfn.described == []
+
+def test_changed_stacks_are_described_again(st):
+    st.save(None, 'r', [stack('A'), stack('B')])
+    cfn = FakeCFN(stack('A'), stack('B', minute=5, status='UPDATE_COMPLETE', outputs={'Out': 'new'}), stack('C'))
+    found = state.revalidate(cfn, None, 'r', st)
+    assert sorted(cfn.described) == ['id-B', 'id-C']
+    assert found['B']['Outputs'] == [{'OutputKey': 'Out', 'OutputValue': 'new'}]
+    assert sorted(found) == ['A', 'B', 'C']
+    # and stored, so next time they're unchanged
+    cfn.described = []
+    state.revalidate(cfn, None, 'r', st)
+    assert cfn.described == []
+
+def test_deleted_stacks_are_forgotten(st):
+    st.save(None, 'r', [stack('A'), stack('B')])
+    cfn = FakeCFN(stack('A'), stack('B', status='DELETE_COMPLETE'))
+    assert list(state.revalidate(cfn, None, 'r', st)) == ['A']
+    assert list(st.load(None, 'r')) == ['A']
+
+def test_too_many_changes_means_sweep(st, monkeypatch):
+    monkeypatch.setitem(state.settings, 'max_describes', 1)
+    st.save(None, 'r', [stack('A')])
+    cfn = FakeCFN(stack('A'), stack('B'), stack('C'))
+    assert state.revalidate(cfn, None, 'r', st) is None
+    assert cfn.described == []
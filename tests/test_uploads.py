@@ -0,0 +1,49 @@
+import botocore.exceptions
+import pytest
+from cfnbot import uploads
+
+
+class FakeS3:
+    def __init__(self, keys=()):
+        self.keys = set(keys)
+        self.heads = 0
+
+    def head_object(self, Bucket, Key):
+        self.heads += 1
+        if (Bucket, Key) not in self.keys:
+            raise botocore.exceptions.ClientError({'Error': {'Code': '404', 'Message': 'Not Found'}}, 'HeadObject')
+        return {}
+
+    def put(self, bucket, key):
+        self.keys.add((bucket, key))
+
+
+@pytest.fixture(autouse=True)
+def forget():
+    uploads.forget()
+    yield
+    uploads.forget()
+
+def test_each_object_goes_up_once():
+    s3 = FakeS3()
+    puts = []
+    for _ in range(3):
+        uploads.ensure(s3, 'b', 'k', lambda: puts.append(s3.put('b', 'k')))
+    assert len(puts) == 1
+    assert s3.heads == 1
+
+def test_objects_already_there_are_left_alone():
+    s3 = FakeS3([('b', 'k')])
+    assert not uploads.ensure(s3, 'b', 'k', lambda: pytest.fail('uploaded again'))
+    assert uploads.exists(s3, 'b', 'k')
+    assert s3.heads == 1
+
+def test_other_errors_barf():
+    class Denied(FakeS3):
+        def head_object(self, Bucket, Key):
+            raise botocore.exceptions.ClientError({'Error': {'Code': '403', 'Message': 'Forbidden'}}, 'HeadObject')
+    with pytest.raises(botocore.exceptions.ClientError):
+        uploads.ensure(Denied(), 'b', 'k', lambda: None)
+
+def test_template_keys():
+    assert uploads.template_key('abc', '/some/where/main.yml') == 'cfnbot/templates/abc/main.yml'
@@ -0,0 +1,116 @@
+import itertools
+import botocore.exceptions
+import pytest
+from cfnbot import waiter
+
+STACK = 'AWS::CloudFormation::Stack'
+_ids = itertools.count()
+
+
+def ev(status, logical='s', rtype=STACK, token='new', reason=None):
+    return {'StackName': 's', 'StackId': 'id-s', 'EventId': str(next(_ids)), 'LogicalResourceId': logical,
+            'ResourceType': rtype, 'ResourceStatus': status, 'ResourceStatusReason': reason, 'ClientRequestToken': token}
+
+
+class FakeCFN:
+    '''
+    describe_stack_events over a list of events, newest first like the real thing.
+    Each poll (a call without NextToken) first adds the next batch from script.
+    '''
+    def __init__(self, events=(), script=(), page_size=100):
+        self.events = list(events)
+        self.script = [list(batch) for batch in script]
+        self.page_size = page_size
+        self.polls = 0
+
+    def describe_stack_events(self, StackName, NextToken=None):
+        if NextToken is None:
+            self.polls += 1
+            for e in self.script.pop(0) if self.script else []:
+                self.events.insert(0, e)
+        start = int(NextToken or 0)
+        r = {'StackEvents': self.events[start:start + self.page_size]}
+        if start + self.page_size < len(self.events):
+            r['NextToken'] = str(start + self.page_size)
+        return r
+
+
+class Gone:
+    def describe_stack_events(self, StackName, NextToken=None):
+        raise botocore.exceptions.ClientError(
+            {'Error': {'Code': 'ValidationError', 'Message': 'Stack with id s does not exist'}}, 'DescribeStackEvents')
+
+
+@pytest.fixture(autouse=True)
+def quick(monkeypatch):
+    monkeypatch.setitem(waiter.settings, 'delay', 0)
+    monkeypatch.setitem(waiter.settings, 'max_delay', 0)
+
+# the last update, which went fine
+previous = [ev('UPDATE_COMPLETE', token='old'), ev('UPDATE_COMPLETE', 'Res', 'AWS::SNS::Topic', token='old'),
+            ev('UPDATE_IN_PROGRESS', token='old')]
+
+
+### picking out the operation
+def test_previous_operations_are_ignored():
+    # the new update's events don't show up until the second poll, and it fails
+    cfn = FakeCFN(previous, [[], [
+        ev('UPDATE_IN_PROGRESS'),
+        ev('UPDATE_FAILED', 'Res', 'AWS::SNS::Topic', reason='Nope'),
+        ev('UPDATE_ROLLBACK_IN_PROGRESS'),
+        ev('UPDATE_ROLLBACK_COMPLETE'),
+    ]])
+    r = waiter.wait_for_stack(cfn, 's', 'stack_update_complete', token='new')
+    assert not r
+    assert (r.status, r.resource, r.reason) == ('UPDATE_ROLLBACK_COMPLETE', 'Res', 'Nope')
+    assert cfn.polls == 2
+
+def test_without_a_token_the_newest_start_counts():
+    stream = waiter.EventStream(FakeCFN(previous), 's', ['UPDATE_IN_PROGRESS'])
+    stream.poll()
+    assert stream.started
+
+def test_stream_only_starts_on_its_token():
+    stream = waiter.EventStream(FakeCFN(previous, [[], [ev('UPDATE_IN_PROGRESS')]]), 's', ['UPDATE_IN_PROGRESS'], 'new')
+    stream.poll()
+    assert not stream.started
+    assert [e['ResourceStatus'] for e in stream.poll()] == ['UPDATE_IN_PROGRESS']
+    assert stream.started
+
+def test_pages_back_to_the_last_event_seen():
+    batch = [ev('UPDATE_IN_PROGRESS', 'R{}'.format(i), 'AWS::SNS::Topic') for i in range(5)]
+    cfn = FakeCFN(previous, [[ev('UPDATE_IN_PROGRESS')], batch], page_size=2)
+    stream = waiter.EventStream(cfn, 's', ['UPDATE_IN_PROGRESS'], 'new')
+    assert len(stream.poll()) == 1
+    # oldest first, nothing skipped and nothing repeated
+    assert [e['LogicalResourceId'] for e in stream.poll()] == ['R0', 'R1', 'R2', 'R3', 'R4']
+    assert stream.poll() == []
+
+
+### how it ends
+def test_success():
+    cfn = FakeCFN(previous, [[ev('CREATE_IN_PROGRESS'), ev('CREATE_COMPLETE', 'Res', 'AWS::SNS::Topic'), ev('CREATE_COMPLETE')]])
+    r = waiter.wait_for_stack(cfn, 's', 'stack_create_complete', token='new')
+    assert r and r.status == 'CREATE_COMPLETE'
+
+def test_first_failure_is_the_one_reported():
+    cfn = FakeCFN(script=[[
+        ev('CREATE_IN_PROGRESS'),
+        ev('CREATE_FAILED', 'First', 'AWS::SNS::Topic', reason='Broken'),
+        ev('CREATE_FAILED', 'Second', 'AWS::SQS::Queue', reason='Resource creation cancelled'),
+        ev('ROLLBACK_IN_PROGRESS', reason='The following resource(s) failed to create: [First, Second].'),
+        ev('ROLLBACK_COMPLETE'),
+    ]])
+    r = waiter.wait_for_stack(cfn, 's', 'stack_create_complete', token='new')
+    assert not r
+    assert (r.status, r.resource, r.resource_type, r.reason) == ('ROLLBACK_COMPLETE', 'First', 'AWS::SNS::Topic', 'Broken')
+
+def test_a_stack_that_is_gone():
+    assert waiter.wait_for_stack(Gone(), 's', 'stack_delete_complete')
+    r = waiter.wait_for_stack(Gone(), 's', 'stack_create_complete')
+    assert not r and r.status == 'DELETE_COMPLETE'
+
+def test_timeout(monkeypatch):
+    monkeypatch.setitem(waiter.settings, 'timeout', -1)
+    r = waiter.wait_for_stack(FakeCFN(previous), 's', 'stack_update_complete', token='new')
+    assert not r and 'Timed out' in r.reason